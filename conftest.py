@@ -0,0 +1,66 @@
+import pytest
+
+
+def make_paragraph(text, bullet=None, style=None):
+    paragraph = {
+        "paragraphStyle": {"namedStyleType": "NORMAL_TEXT"},
+        "elements": [{"textRun": {"content": text, "textStyle": style or {}}}],
+    }
+    if bullet:
+        paragraph["bullet"] = bullet
+    return {"paragraph": paragraph}
+
+
+@pytest.fixture
+def document():
+    return {
+        "documentId": "doc-1",
+        "revisionId": "rev-1",
+        "body": {
+            "content": [
+                {"sectionBreak": {"sectionStyle": {}}},
+                make_paragraph("Intro \u00e9\u4e2d\n", style={"bold": True}),
+                make_paragraph("one\n", bullet={"listId": "2"}),
+                make_paragraph("two\n", bullet={"listId": "2", "nestingLevel": 1}),
+                make_paragraph("\n"),
+                make_paragraph("three\n", bullet={"listId": "1"}),
+                {
+                    "table": {
+                        "tableRows": [
+                            {
+                                "tableCells": [
+                                    {"content": [make_paragraph("head\n")]},
+                                    {
+                                        "content": [make_paragraph("wide\n")],
+                                        "tableCellStyle": {"colSpan": 2},
+                                    },
+                                ]
+                            },
+                            {
+                                "tableCells": [
+                                    {"content": [make_paragraph("a\n")]},
+                                    {"content": [make_paragraph("\n")]},
+                                    {
+                                        "content": [
+                                            make_paragraph("x\n", bullet={"listId": "1"}),
+                                            make_paragraph("y 1.5e3\n"),
+                                        ]
+                                    },
+                                ]
+                            },
+                        ]
+                    }
+                },
+                make_paragraph("Outro\n"),
+            ]
+        },
+        "lists": {
+            "1": {"listProperties": {"nestingLevels": [{}, {}]}},
+            "2": {
+                "listProperties": {
+                    "nestingLevels": [{"glyphType": "DECIMAL"}, {"glyphType": "ALPHA"}]
+                }
+            },
+        },
+    }
+
@@ -1,11 +1,41 @@
+import argparse
+import codecs
+import contextlib
+import functools
+import hashlib
+import io
 import json
+import mmap
 import os
 import re
-from dataclasses import dataclass
+import sys
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextvars import ContextVar
+from dataclasses import dataclass, field
 from typing import Optional
 
+# optional faster JSON libraries, used for decoding and fingerprints when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
 
-@dataclass
+# bump whenever the rendered output changes, so cached conversions made by an
+# older converter are never served
+CONVERTER_VERSION = "2"
+
+
+# nodes are slotted: large documents keep millions of them alive at once, and
+# a per-instance __dict__ would dominate their size
+@dataclass(slots=True)
 class ParagraphNode:
     text: str
     is_list_item: bool
@@ -13,114 +43,571 @@ class ParagraphNode:
     nesting_level: int
 
 
-@dataclass
+@dataclass(slots=True)
 class TableCellNode:
     nodes: list[ParagraphNode]
     col_span: int = 1
     row_span: int = 1
 
 
-@dataclass
+@dataclass(slots=True)
 class TableRowNode:
     cells: list[TableCellNode]
 
 
-@dataclass
+@dataclass(slots=True)
 class TableNode:
     rows: list[TableRowNode]
 
 
+# a paragraph parsed for several output formats at once; text is the HTML, so
+# it renders anywhere a ParagraphNode does
+@dataclass(slots=True)
+class FormattedParagraph:
+    text: str
+    markdown: str
+    plain: str
+    is_list_item: bool
+    list_id: Optional[str]
+    nesting_level: int
+
+
+@dataclass
+class ConversionStats:
+    """
+    Counters and per-stage timings for one conversion. Stage times are
+    inclusive: parse_table contains the parse_paragraph time of its cells,
+    and nested tables count towards every enclosing table.
+    """
+
+    document: Optional[str] = None
+    paragraphs: int = 0
+    runs: int = 0
+    list_items: int = 0
+    tables: int = 0
+    cells: int = 0
+    max_table_depth: int = 0
+    table_depth: int = 0
+    stage_seconds: dict[str, float] = field(default_factory=dict)
+
+    def add_time(self, stage: str, seconds: float):
+        self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+
+    def to_record(self) -> dict:
+        return {
+            "document": self.document,
+            "paragraphs": self.paragraphs,
+            "runs": self.runs,
+            "list_items": self.list_items,
+            "tables": self.tables,
+            "cells": self.cells,
+            "max_table_depth": self.max_table_depth,
+            "stage_seconds": dict(self.stage_seconds),
+        }
+
+
+# the stats of the conversion running in this thread/task, if instrumented
+_active_stats: ContextVar[Optional[ConversionStats]] = ContextVar(
+    "docs_to_md_stats", default=None
+)
+_collectors = []
+
+
+def register_collector(collector):
+    """
+    Call collector(record) with the to_record() dict of every instrumented
+    conversion, e.g. JsonLinesCollector(open("stats.jsonl", "a")).
+    """
+    _collectors.append(collector)
+
+
+def unregister_collector(collector):
+    _collectors.remove(collector)
+
+
+class JsonLinesCollector:
+    def __init__(self, stream):
+        self._stream = stream
+
+    def __call__(self, record: dict):
+        self._stream.write(json.dumps(record) + "\n")
+
+
+@contextlib.contextmanager
+def instrumented(document: Optional[str] = None):
+    """
+    Collect ConversionStats for every conversion step run inside the block,
+    then hand the record to the registered collectors. Outside such a block
+    the instrumentation costs one context variable lookup per step.
+    """
+    stats = ConversionStats(document=document)
+    token = _active_stats.set(stats)
+    start = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        total = time.perf_counter() - start
+        stats.add_time("total", total)
+        # everything that is not decoding is rendering, even when interleaved
+        stats.add_time("render", total - stats.stage_seconds.get("decode", 0.0))
+        _active_stats.reset(token)
+        record = stats.to_record()
+        for collector in list(_collectors):
+            collector(record)
+
+
+def _timed(stage: str):
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stats = _active_stats.get()
+            if stats is None:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.add_time(stage, time.perf_counter() - start)
+
+        return wrapper
+
+    return decorate
+
+
+class MemoryBudgetExceeded(MemoryError):
+    def __init__(self, used: int, budget: int, stage: str, item: Optional[int] = None):
+        where = stage if item is None else f"{stage} of body item {item}"
+        super().__init__(f"{used} bytes allocated during {where}, over the budget of {budget}")
+        self.used = used
+        self.budget = budget
+        self.stage = stage
+        self.item = item
+
+
+@dataclass
+class MemoryUsage:
+    """
+    Memory traced by track_memory, in bytes allocated since the block was
+    entered. retained_bytes is what was still allocated when it was left:
+    caches that grew, or a leak.
+    """
+
+    budget: Optional[int] = None
+    baseline: int = 0
+    peak_bytes: int = 0
+    retained_bytes: int = 0
+    # the document went over budget on the fast path and was streamed instead
+    fallback: bool = False
+
+    def check(self, stage: str, item: Optional[int] = None):
+        if self.budget is None:
+            return
+        # the peak, so that spikes freed again before the check still count
+        used = tracemalloc.get_traced_memory()[1] - self.baseline
+        if used > self.budget:
+            raise MemoryBudgetExceeded(used, self.budget, stage, item)
+
+    def restart(self):
+        """
+        Begin a new attempt within the budget, e.g. streaming after the
+        decoded document went over it: keep the peak so far for peak_bytes,
+        and check later stages against allocations from here on only.
+        """
+        self.peak_bytes = max(self.peak_bytes, tracemalloc.get_traced_memory()[1] - self.baseline)
+        tracemalloc.reset_peak()
+
+    def to_record(self) -> dict:
+        return {
+            "memory_budget": self.budget,
+            "peak_bytes": self.peak_bytes,
+            "retained_bytes": self.retained_bytes,
+            "memory_fallback": self.fallback,
+        }
+
+
+_active_memory: ContextVar[Optional[MemoryUsage]] = ContextVar(
+    "docs_to_md_memory", default=None
+)
+
+
+@contextlib.contextmanager
+def track_memory(budget: Optional[int] = None):
+    """
+    Trace the allocations of the conversion run inside the block with
+    tracemalloc (started for the block if it isn't running already), and
+    fill in the yielded MemoryUsage when the block ends. With a budget,
+    decoding, parse_content and rendering raise MemoryBudgetExceeded as soon
+    as traced memory has peaked more than budget bytes above where it was on
+    entry, counting spikes that were freed again in between; render_file
+    falls back to streaming first where it can.
+
+    Tracing slows conversion down several times, so only use it to size
+    workers or to guard against pathological documents.
+    """
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    usage = MemoryUsage(budget=budget, baseline=tracemalloc.get_traced_memory()[0])
+    token = _active_memory.set(usage)
+    try:
+        yield usage
+    finally:
+        _active_memory.reset(token)
+        current, peak = tracemalloc.get_traced_memory()
+        usage.peak_bytes = max(usage.peak_bytes, peak - usage.baseline, 0)
+        usage.retained_bytes = max(current - usage.baseline, 0)
+        if started:
+            tracemalloc.stop()
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_text_style(signature) -> tuple[str, str]:
+    """
+    Build the (prefix, suffix) tags that wrap a run with the given style
+    signature. Documents reuse a handful of styles, so this is memoized;
+    compile_text_style.cache_info() reports hits and misses.
+    """
+    link, baseline_offset, background, underline, bold, italic, strikethrough = signature
+    # innermost first
+    wrappers = []
+    if link:
+        wrappers.append((f'<a href="{link}">', "</a>"))
+    match baseline_offset:
+        case "SUPERSCRIPT":
+            wrappers.append(("<sup>", "</sup>"))
+        case "SUBSCRIPT":
+            wrappers.append(("<sub>", "</sub>"))
+    if background:
+        red, green, blue = background
+        wrappers.append(
+            (
+                f'<mark style="background-color: rgb({red}% {green}% {blue}%)">',
+                "</mark>",
+            )
+        )
+    if underline:
+        wrappers.append(("<ins>", "</ins>"))
+    if bold:
+        wrappers.append(("<b>", "</b>"))
+    if italic:
+        wrappers.append(("<i>", "</i>"))
+    if strikethrough:
+        wrappers.append(("<s>", "</s>"))
+
+    prefix = "".join(open_tag for open_tag, _ in reversed(wrappers))
+    suffix = "".join(close_tag for _, close_tag in wrappers)
+    return prefix, suffix
+
+
+def style_key_signature(key) -> tuple:
+    """
+    Reduce a style key, flag bits (bold 1, italic 2, underline 4,
+    strikethrough 8) or (bits, url, baseline offset, rgb) with the raw
+    values of the textStyle, to the signature compile_text_style takes:
+    the subset that affects rendering, with colours as the whole percentages
+    they render as.
+    """
+    bits, link, baseline_offset, rgb = (key, None, None, None) if type(key) is int else key
+    return (
+        link or None,
+        baseline_offset if baseline_offset in ("SUPERSCRIPT", "SUBSCRIPT") else None,
+        rgb and tuple(int(channel * 100) for channel in rgb),
+        bool(bits & 4),
+        bool(bits & 1),
+        bool(bits & 2),
+        bool(bits & 8),
+    )
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_style_key(key) -> tuple[str, str]:
+    """
+    compile_text_style for a style key, which is cheap to build per run:
+    the signature is only derived for keys not seen before.
+    compile_style_key.cache_info() reports hits and misses.
+    """
+    return compile_text_style(style_key_signature(key))
+
+
+# styles that only set flags never need a cache lookup
+_FLAG_TAGS = [compile_text_style(style_key_signature(bits)) for bits in range(16)]
+
+
+def text_style_tags(text_style, flag_tags=_FLAG_TAGS, compile_key=compile_style_key):
+    """
+    The (prefix, suffix) tags of a textStyle for the cost of a few dict
+    lookups: flag_tags indexed by the flag bits, or compile_key of the style
+    key when there is a link, baseline offset or background.
+    """
+    bits = (
+        (1 if text_style.get("bold") else 0)
+        | (2 if text_style.get("italic") else 0)
+        | (4 if text_style.get("underline") else 0)
+        | (8 if text_style.get("strikethrough") else 0)
+    )
+    link = text_style.get("link")
+    baseline_offset = text_style.get("baselineOffset")
+    background = text_style.get("backgroundColor")
+    if not (link or baseline_offset or background):
+        return flag_tags[bits]
+    rgb = None
+    if background:
+        color = background["color"]["rgbColor"]
+        rgb = (color.get("red", 0), color.get("green", 0), color.get("blue", 0))
+    return compile_key((bits, link and link.get("url"), baseline_offset, rgb))
+
+
+_PLAIN_TAGS = _FLAG_TAGS[0]
+
+
 def apply_inline_text_styles(content, text_style):
     content = content.strip("\n")
+    if not text_style:
+        return content
+    prefix, suffix = text_style_tags(text_style)
+    return f"{prefix}{content}{suffix}"
 
-    if text_style.get("link", {}).get("url"):
-        content = f'<a href="{text_style["link"]["url"]}">{content}</a>'
-
-    if text_style.get("baselineOffset"):
-        match text_style["baselineOffset"]:
-            case "SUPERSCRIPT":
-                content = f"<sup>{content}</sup>"
-            case "SUBSCRIPT":
-                content = f"<sub>{content}</sub>"
-
-    if text_style.get("backgroundColor"):
-        rgb_color = text_style["backgroundColor"]["color"]["rgbColor"]
-        content = (
-            f'<mark style="background-color: rgb('
-            f'{int(rgb_color.get("red", 0) * 100)}% '
-            f'{int(rgb_color.get("green", 0) * 100)}% '
-            f'{int(rgb_color.get("blue", 0) * 100)}%)">'
-            f"{content}</mark>"
-        )
 
-    if text_style.get("underline"):
-        content = f"<ins>{content}</ins>"
-    if text_style.get("bold"):
-        content = f"<b>{content}</b>"
-    if text_style.get("italic"):
-        content = f"<i>{content}</i>"
-    if text_style.get("strikethrough"):
-        content = f"<s>{content}</s>"
+_MARKDOWN_SPECIAL = re.compile(r"([\\`*_\[\]|~])")
 
-    return content
 
+def escape_markdown(text: str) -> str:
+    return _MARKDOWN_SPECIAL.sub(r"\\\1", text)
 
-def parse_paragraph(paragraph) -> ParagraphNode:
-    headings = {
-        "HEADING_1": "# ",
-        "HEADING_2": "## ",
-        "HEADING_3": "### ",
-        "HEADING_4": "#### ",
-        "HEADING_5": "##### ",
-        "HEADING_6": "###### ",
-    }
-    paragraph_style = paragraph["paragraphStyle"]
-    is_heading = paragraph_style["namedStyleType"] in headings
 
-    text = ""
-    for item in paragraph["elements"]:
+# "#", ">", "-" and "+" at the start of a line, or a number followed by "." or ")"
+# and a space, would turn a plain line into a heading, quote or list item
+_MARKDOWN_BLOCK_START = re.compile(r"^([ \t]*)([#>+-]|\d+[.)](?=\s|$))", re.MULTILINE)
+
+
+def escape_markdown_blocks(text: str) -> str:
+    return _MARKDOWN_BLOCK_START.sub(
+        lambda match: match[1] + match[2][:-1] + "\\" + match[2][-1], text
+    )
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_markdown_style(signature) -> tuple[str, str]:
+    """
+    The Markdown counterpart of compile_text_style. Underline and highlight
+    have no Markdown syntax and are dropped; super- and subscript stay HTML.
+    """
+    link, baseline_offset, _, _, bold, italic, strikethrough = signature
+    # innermost first
+    wrappers = []
+    if link:
+        wrappers.append(("[", f"]({link})"))
+    match baseline_offset:
+        case "SUPERSCRIPT":
+            wrappers.append(("<sup>", "</sup>"))
+        case "SUBSCRIPT":
+            wrappers.append(("<sub>", "</sub>"))
+    if strikethrough:
+        wrappers.append(("~~", "~~"))
+    if italic:
+        wrappers.append(("_", "_"))
+    if bold:
+        wrappers.append(("**", "**"))
+
+    prefix = "".join(open_mark for open_mark, _ in reversed(wrappers))
+    suffix = "".join(close_mark for _, close_mark in wrappers)
+    return prefix, suffix
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_markdown_key(key) -> tuple[str, str]:
+    return compile_markdown_style(style_key_signature(key))
+
+
+_MARKDOWN_FLAG_TAGS = [compile_markdown_style(style_key_signature(bits)) for bits in range(16)]
+
+
+def _markdown_style_tags(text_style) -> tuple[str, str]:
+    return text_style_tags(text_style, _MARKDOWN_FLAG_TAGS, compile_markdown_key)
+
+
+def apply_markdown_text_styles(content, text_style):
+    return _markdown_styled(content, _markdown_style_tags(text_style))
+
+
+def _markdown_styled(content: str, tags) -> str:
+    content = escape_markdown(content.strip("\n"))
+    body = content.strip()
+    if tags == _PLAIN_TAGS or not body:
+        return content
+    prefix, suffix = tags
+    # emphasis markers must hug the text: "** bold**" is not bold
+    start = len(content) - len(content.lstrip())
+    return content[:start] + prefix + body + suffix + content[start + len(body) :]
+
+
+def coalesce_text_runs(elements, style_tags) -> list[tuple[tuple, list]]:
+    """
+    Group the textRuns of a paragraph into ((prefix, suffix), contents)
+    pairs, so that neighbouring runs that render the same are styled once.
+    A run whose textStyle equals the one before costs a dict comparison;
+    otherwise its tags come from style_tags, and it still joins the group
+    before when they match, as when the textStyles differ only in keys the
+    output ignores (fontSize, foregroundColor, ...).
+    """
+    runs = []
+    last_style = last_tags = contents = None
+    for item in elements:
+        text_run = item.get("textRun")
+        if not text_run:
+            continue
+        text_style = text_run["textStyle"]
+        if text_style != last_style:
+            last_style = text_style
+            tags = style_tags(text_style) if text_style else _PLAIN_TAGS
+            if tags != last_tags:
+                last_tags = tags
+                contents = []
+                runs.append((tags, contents))
+        contents.append(text_run["content"])
+    return runs
+
+
+HEADINGS = {
+    "HEADING_1": "# ",
+    "HEADING_2": "## ",
+    "HEADING_3": "### ",
+    "HEADING_4": "#### ",
+    "HEADING_5": "##### ",
+    "HEADING_6": "###### ",
+}
+_HEADING_NUMBER = re.compile(r"^\d+(\.\d+)*\.*\s+")
+
+
+def _count_paragraph(paragraph):
+    stats = _active_stats.get()
+    if stats is not None:
+        stats.paragraphs += 1
+        stats.runs += sum("textRun" in item for item in paragraph["elements"])
+
+
+def _inline_html(elements, style_tags) -> str:
+    """
+    The styled text of a paragraph's textRuns, grouped the way
+    coalesce_text_runs groups them but written out in the same pass: tags
+    are only closed and reopened where they change.
+    """
+    parts = []
+    last_style = last_tags = None
+    suffix = ""
+    for item in elements:
         text_run = item.get("textRun")
-        if text_run:
-            content = text_run["content"]
-            text_style = text_run["textStyle"]
-            if not is_heading:
-                content = apply_inline_text_styles(content, text_style)
-            text += content
+        if not text_run:
+            continue
+        text_style = text_run["textStyle"]
+        if text_style != last_style:
+            last_style = text_style
+            tags = style_tags(text_style) if text_style else _PLAIN_TAGS
+            if tags != last_tags:
+                last_tags = tags
+                parts.append(suffix)
+                prefix, suffix = tags
+                parts.append(prefix)
+        parts.append(text_run["content"].strip("\n"))
+    parts.append(suffix)
+    return "".join(parts)
+
+
+def _paragraph_html(elements, paragraph_style, style_tags) -> str:
+    is_heading = paragraph_style["namedStyleType"] in HEADINGS
+    if is_heading:
+        text = "".join([item["textRun"]["content"] for item in elements if item.get("textRun")])
+    else:
+        text = _inline_html(elements, style_tags)
 
     # no point in having empty tags, will make the doc messier
     if not text.strip():
-        return ParagraphNode(
-            text="",
-            is_list_item=False,
-            list_id=None,
-            nesting_level=0,
-        )
+        return ""
 
     # check if the paragraph has a heading, and remove the number labelling if it exists
     if is_heading:
-        text = headings[paragraph_style["namedStyleType"]] + re.sub(
-            r"^\d+(\.\d+)*\.*\s+", "", text
-        )
-    else:
-        match paragraph_style.get("alignment"):
-            case "CENTER":
-                text = f'<p align="center">{text.strip("\n")}</p>'
-            case "END":
-                text = f'<p align="right">{text.strip("\n")}</p>'
-            case "JUSTIFIED":
-                text = f'<p align="justify">{text.strip("\n")}</p>'
-            case "START":
-                text = f'<p align="left">{text.strip("\n")}</p>'
-            case _:
-                text = f'<p>{text.strip("\n")}</p>'
+        return HEADINGS[paragraph_style["namedStyleType"]] + _HEADING_NUMBER.sub("", text)
+    match paragraph_style.get("alignment"):
+        case "CENTER":
+            return f'<p align="center">{text.strip("\n")}</p>'
+        case "END":
+            return f'<p align="right">{text.strip("\n")}</p>'
+        case "JUSTIFIED":
+            return f'<p align="justify">{text.strip("\n")}</p>'
+        case "START":
+            return f'<p align="left">{text.strip("\n")}</p>'
+        case _:
+            return f'<p>{text.strip("\n")}</p>'
+
+
+def _paragraph_markdown(runs, paragraph_style) -> str:
+    named_style = paragraph_style["namedStyleType"]
+    if named_style in HEADINGS:
+        text = "".join(piece for _, pieces in runs for piece in pieces)
+        return HEADINGS[named_style] + escape_markdown(_HEADING_NUMBER.sub("", text).strip())
+    return escape_markdown_blocks(
+        "".join(_markdown_styled("".join(pieces), tags) for tags, pieces in runs).strip()
+    )
+
+
+def _paragraph_plain(elements, paragraph_style) -> str:
+    text = "".join(
+        item["textRun"]["content"].strip("\n") for item in elements if item.get("textRun")
+    )
+    if paragraph_style["namedStyleType"] in HEADINGS:
+        text = _HEADING_NUMBER.sub("", text)
+    return text.strip()
+
 
+def _list_fields(paragraph, text: str) -> tuple[bool, Optional[str], int]:
     bullet_info = paragraph.get("bullet")
-    is_list_item = bullet_info is not None
+    if not text or bullet_info is None:
+        return False, None, 0
+    # list ids repeat on every item, share one string per id
+    return True, sys.intern(bullet_info["listId"]), bullet_info.get("nestingLevel", 0)
+
+
+@_timed("parse_paragraph")
+def parse_paragraph(paragraph) -> ParagraphNode:
+    _count_paragraph(paragraph)
+    text = _paragraph_html(paragraph["elements"], paragraph["paragraphStyle"], text_style_tags)
+    is_list_item, list_id, nesting_level = _list_fields(paragraph, text)
     return ParagraphNode(
         text=text,
         is_list_item=is_list_item,
-        list_id=bullet_info["listId"] if is_list_item else None,
-        nesting_level=bullet_info.get("nestingLevel", 0) if is_list_item else 0,
+        list_id=list_id,
+        nesting_level=nesting_level,
+    )
+
+
+@_timed("parse_paragraph")
+def parse_paragraph_formats(
+    paragraph, formats=frozenset({"markdown", "text"})
+) -> FormattedParagraph:
+    """
+    Parse a paragraph once and render it as HTML plus each of the
+    other formats asked for; formats left out come back as "".
+    """
+    _count_paragraph(paragraph)
+    elements = paragraph["elements"]
+    paragraph_style = paragraph["paragraphStyle"]
+    text = _paragraph_html(elements, paragraph_style, text_style_tags)
+    is_list_item, list_id, nesting_level = _list_fields(paragraph, text)
+    markdown = plain = ""
+    if text and "markdown" in formats:
+        # Markdown drops underline and highlight, so its runs group differently
+        markdown_runs = coalesce_text_runs(elements, _markdown_style_tags)
+        markdown = _paragraph_markdown(markdown_runs, paragraph_style)
+    if text and "text" in formats:
+        plain = _paragraph_plain(elements, paragraph_style)
+    return FormattedParagraph(
+        text=text,
+        markdown=markdown,
+        plain=plain,
+        is_list_item=is_list_item,
+        list_id=list_id,
+        nesting_level=nesting_level,
     )
 
 
@@ -161,102 +648,601 @@ def close_list_item():
     return "</li>"
 
 
-def generate_table_html(table_data: TableNode, lists) -> str:
-    output = []
-    output.append("<table>")
-    for idx, row in enumerate(table_data.rows):
-        output.append("<tr>")
-        for cell in row.cells:
-            cell_html = generate_html(cell.nodes, lists)
-
-            attrs = []
-            if cell.row_span > 1:
-                attrs.append(f'rowspan="{cell.row_span}"')
-            if cell.col_span > 1:
-                attrs.append(f'colspan="{cell.col_span}"')
-            attr_str = " " + " ".join(attrs) if attrs else ""
-
-            output.append(f"<th{attr_str}>" if idx == 0 else f"<td{attr_str}>")
-            output.append(cell_html)
-            output.append("</th>" if idx == 0 else "</td>")
-        output.append("</tr>")
-    output.append("</table>")
-    return "\n".join(output)
+class FragmentWriter:
+    """
+    Writes rendered fragments straight to a sink, putting the separator
+    between them, so the output matches "\n".join() of the same fragments
+    without building any intermediate strings.
+    The sink is anything with a write() method, or a plain callable.
+    """
 
+    def __init__(self, sink, separator: str = "\n"):
+        self._write = sink.write if hasattr(sink, "write") else sink
+        self._separator = separator
+        self.count = 0
 
-def generate_list_html(node, lists, list_stack) -> str:
-    output = []
-    list_props = lists[node.list_id]["listProperties"]
-    level_props = list_props["nestingLevels"][node.nesting_level]
-    list_type = "ol" if "glyphType" in level_props else "ul"
-    style_type = (
-        glyph_type_to_css(level_props["glyphType"])
-        if "glyphType" in level_props
-        else ""
-    )
+    def fragment(self, text: str):
+        if self.count:
+            self._write(self._separator)
+        self._write(text)
+        self.count += 1
+
+
+# neighbouring runs that share their outermost style, e.g. "<b>x</b><b>y</b>"
+_ADJACENT_INLINE_TAGS = re.compile(r"</(b|i|s|ins|sub|sup)><\1>")
+
+
+class MinifiedWriter(FragmentWriter):
+    """
+    FragmentWriter for minified HTML: no separator between fragments, a
+    list item or table cell holding nothing but one plain paragraph loses
+    the paragraph's <p>, and neighbouring identical inline tags are merged,
+    so "<b>x</b><b>y</b>" becomes "<b>xy</b>". Markdown heading lines keep
+    a line of their own, or they would stop being headings.
+    """
+
+    def __init__(self, sink):
+        super().__init__(sink, separator="")
+        # the last fragment opened a list item or cell
+        self._opened = False
+        # a plain paragraph right after such an opening, until we know
+        # whether it is the only thing inside
+        self._pending = None
+        self._line_start = True
+
+    def fragment(self, text: str):
+        # count what was asked for, pending or not: cells check it for content
+        self.count += 1
+        if text.startswith("<p"):
+            text = _ADJACENT_INLINE_TAGS.sub("", text)
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            if text in ("</li>", "</td>", "</th>"):
+                pending = pending[3:-4]
+            self._emit(pending)
+        elif self._opened and text.startswith("<p>") and text.endswith("</p>"):
+            self._pending = text
+            return
+        self._opened = text.startswith(("<li>", "<td", "<th"))
+        self._emit(text)
+
+    def _emit(self, text: str):
+        if text.startswith("#"):
+            # a Markdown heading only works at the start of a line
+            if not self._line_start:
+                self._write("\n")
+            if not text.endswith("\n"):
+                text += "\n"
+        if text:
+            self._write(text)
+            self._line_start = text.endswith("\n")
+
+
+class ListIndex:
+    """
+    The open and close tags of every (listId, nestingLevel) in a document's
+    lists, resolved once up front. Each level gets a small integer id, so
+    rendering a list item is one dict lookup and no string formatting.
+    """
+
+    __slots__ = ("ids", "open_tags", "close_tags")
+
+    def __init__(self, lists):
+        self.ids = {}
+        self.open_tags = []
+        self.close_tags = []
+        for list_id, list_entry in lists.items():
+            levels = list_entry.get("listProperties", {}).get("nestingLevels", [])
+            for nesting_level, level_props in enumerate(levels):
+                if "glyphType" in level_props:
+                    list_type = "ol"
+                    style_type = glyph_type_to_css(level_props["glyphType"])
+                else:
+                    list_type = "ul"
+                    style_type = ""
+                self.ids[(list_id, nesting_level)] = len(self.open_tags)
+                self.open_tags.append(open_list_tag(list_type, style_type))
+                self.close_tags.append(close_list_tag(list_type))
+
+
+def _list_index(lists) -> ListIndex:
+    return lists if isinstance(lists, ListIndex) else ListIndex(lists)
+
+
+# list_stack holds the close tag of every open list, innermost last
+def _close_lists(list_stack, out: FragmentWriter):
+    while list_stack:
+        out.fragment(list_stack.pop())
+
+
+class _ContentFrame:
+    # the body, or one table cell, being walked
+    __slots__ = ("items", "cell", "opened")
+
+    def __init__(self, items, cell=None, opened=False):
+        self.items = items
+        # (header, row_span, col_span) of the cell this content fills
+        self.cell = cell
+        # raw cells are only announced once something in them renders
+        self.opened = opened
+
+
+class _TableFrame:
+    __slots__ = ("rows", "cells", "header", "raw", "started")
+
+    def __init__(self, table, raw: bool, started: float):
+        self.rows = iter(table["tableRows"] if raw else table.rows)
+        self.cells = None
+        self.header = False
+        self.raw = raw
+        self.started = started
+
+
+def _cell_tags(header: bool, row_span: int, col_span: int) -> tuple[str, str]:
+    attrs = []
+    if row_span > 1:
+        attrs.append(f'rowspan="{row_span}"')
+    if col_span > 1:
+        attrs.append(f'colspan="{col_span}"')
+    attr_str = " " + " ".join(attrs) if attrs else ""
+    if header:
+        return f"<th{attr_str}>", "</th>"
+    return f"<td{attr_str}>", "</td>"
+
+
+def _iter_shallow_nodes(elements):
+    # like iter_content_nodes, but tables are passed on unparsed
+    for value in elements:
+        if "paragraph" in value:
+            paragraph_node = parse_paragraph(value["paragraph"])
+            if paragraph_node.text.strip():
+                yield paragraph_node
+        if "table" in value:
+            yield value["table"]
+
+
+def _walk(items, target, parse_elements=_iter_shallow_nodes):
+    """
+    Walk a content sequence, and every table nested in it, with an explicit
+    stack instead of recursion, reporting what it finds to target as events:
+    paragraph(node), table_start(), row_start(), cell_start(header, row_span,
+    col_span), cell_end(), cell_skipped(header, row_span, col_span),
+    row_end(), table_end() and finally end().
+
+    Items are paragraph nodes, TableNodes or raw "table" dicts from the
+    export; raw tables are parsed cell by cell with parse_elements as they
+    are reached, so memory grows with the nesting depth rather than with the
+    size of the table. Raw cells that render nothing produce a single
+    cell_skipped() in place of cell_start() and cell_end().
+    """
+    stats = _active_stats.get()
+    memory = _active_memory.get()
+    body_items = 0
+    stack = [_ContentFrame(iter(items))]
+
+    try:
+        while stack:
+            frame = stack[-1]
+
+            if type(frame) is _TableFrame:
+                cell = next(frame.cells, None) if frame.cells is not None else None
+                if cell is None:
+                    if frame.cells is not None:
+                        target.row_end()
+                    row = next(frame.rows, None)
+                    if row is None:
+                        target.table_end()
+                        stack.pop()
+                        if stats is not None:
+                            stats.add_time("table_html", time.perf_counter() - frame.started)
+                            stats.table_depth -= 1
+                        continue
+                    # only the first row is a header row
+                    frame.header = frame.cells is None
+                    cells = row["tableCells"] if frame.raw else row.cells
+                    if stats is not None and frame.raw:
+                        stats.cells += len(cells)
+                    frame.cells = iter(cells)
+                    target.row_start()
+                    continue
+
+                if frame.raw:
+                    cell_style = cell.get("tableCellStyle", {})
+                    span = (
+                        frame.header,
+                        cell_style.get("rowSpan", 1),
+                        cell_style.get("colSpan", 1),
+                    )
+                    stack.append(_ContentFrame(parse_elements(cell["content"]), span))
+                else:
+                    span = (frame.header, cell.row_span, cell.col_span)
+                    target.cell_start(*span)
+                    stack.append(_ContentFrame(iter(cell.nodes), span, opened=True))
+                continue
+
+            node = next(frame.items, None)
+            if node is None:
+                stack.pop()
+                if frame.opened:
+                    target.cell_end()
+                elif frame.cell is not None:
+                    target.cell_skipped(*frame.cell)
+                continue
+            if memory is not None:
+                if len(stack) == 1:
+                    body_items += 1
+                memory.check("render", body_items)
+
+            if frame.cell is not None and not frame.opened:
+                target.cell_start(*frame.cell)
+                frame.opened = True
+
+            raw = type(node) is dict
+            if not raw and type(node) is not TableNode:
+                target.paragraph(node)
+                continue
+
+            target.table_start()
+            started = 0.0
+            if stats is not None:
+                started = time.perf_counter()
+                stats.table_depth += 1
+                if raw:
+                    stats.tables += 1
+                    stats.max_table_depth = max(stats.max_table_depth, stats.table_depth)
+            stack.append(_TableFrame(node, raw, started))
+    finally:
+        if stats is not None:
+            # tables an exception left open, such as a blown memory budget
+            stats.table_depth -= sum(type(frame) is _TableFrame for frame in stack)
+
+    target.end()
+
+
+class _HtmlTarget:
+    """
+    Renders _walk events as HTML fragments. If list_stack is given, lists
+    still open at the end are left open in it.
+    """
+
+    def __init__(self, lists, out: FragmentWriter, list_stack=None):
+        self.index = _list_index(lists)
+        self.out = out
+        self.keep_open = list_stack is not None
+        # one list stack for the body and one per open cell
+        self.list_stacks = [[] if list_stack is None else list_stack]
+        self.cells = []
+
+    def paragraph(self, node):
+        if node.is_list_item:
+            write_list_html(node, self.index, self.list_stacks[-1], self.out)
+        else:
+            # Not a list item => close all open lists
+            _close_lists(self.list_stacks[-1], self.out)
+            self.out.fragment(node.text)
+
+    def table_start(self):
+        # close out any lists
+        _close_lists(self.list_stacks[-1], self.out)
+        self.out.fragment("<table>")
+
+    def row_start(self):
+        self.out.fragment("<tr>")
+
+    def cell_start(self, header: bool, row_span: int, col_span: int):
+        open_tag, close_tag = _cell_tags(header, row_span, col_span)
+        self.out.fragment(open_tag)
+        self.cells.append((close_tag, self.out.count))
+        self.list_stacks.append([])
+
+    def cell_end(self):
+        _close_lists(self.list_stacks.pop(), self.out)
+        close_tag, written = self.cells.pop()
+        if self.out.count == written:
+            # an empty cell still takes its own (blank) line
+            self.out.fragment("")
+        self.out.fragment(close_tag)
+
+    def cell_skipped(self, header: bool, row_span: int, col_span: int):
+        # the HTML has always left out cells with nothing to render
+        pass
+
+    def row_end(self):
+        self.out.fragment("</tr>")
+
+    def table_end(self):
+        self.out.fragment("</table>")
+
+    def end(self):
+        if not self.keep_open:
+            # make sure that any lists that are still open are closed
+            _close_lists(self.list_stacks[0], self.out)
+
+
+def _render_items(items, lists, out, list_stack=None):
+    _walk(items, _HtmlTarget(lists, out, list_stack))
+
+
+class _MarkdownTarget:
+    """
+    Renders _walk events as Markdown. Pipe tables cannot nest or span, so a
+    cell's paragraphs are joined with <br>, nested tables are flattened into
+    the cell holding them, column spans are padded with empty cells and row
+    spans are ignored.
+    """
+
+    def __init__(self, lists):
+        self.index = _list_index(lists)
+        # blocks are separated by blank lines, the lines of one block are not
+        self.blocks = []
+        self.in_list = False
+        self.depth = 0
+        self.rows = None
+        self.cell_lines = None
+        self.col_span = 1
 
-    if len(list_stack) < node.nesting_level + 1:
+    def _marker(self, node) -> str:
+        level_id = self.index.ids[(node.list_id, node.nesting_level)]
+        return "1. " if self.index.close_tags[level_id] == "</ol>" else "- "
+
+    def paragraph(self, node):
+        if self.depth:
+            self.cell_lines.append(
+                self._marker(node) + node.markdown if node.is_list_item else node.markdown
+            )
+        elif node.is_list_item:
+            line = "    " * node.nesting_level + self._marker(node) + node.markdown
+            if self.in_list:
+                self.blocks[-1].append(line)
+            else:
+                self.blocks.append([line])
+                self.in_list = True
+        else:
+            self.blocks.append([node.markdown])
+            self.in_list = False
+
+    def table_start(self):
+        self.depth += 1
+        if self.depth == 1:
+            self.rows = []
+            self.in_list = False
+
+    def row_start(self):
+        if self.depth == 1:
+            self.rows.append([])
+
+    def cell_start(self, header: bool, row_span: int, col_span: int):
+        if self.depth == 1:
+            self.cell_lines = []
+            self.col_span = col_span
+
+    def cell_end(self):
+        if self.depth == 1:
+            row = self.rows[-1]
+            row.append("<br>".join(self.cell_lines))
+            row.extend([""] * (self.col_span - 1))
+
+    def cell_skipped(self, header: bool, row_span: int, col_span: int):
+        # keep the columns after an empty cell in place
+        if self.depth == 1:
+            self.rows[-1].extend([""] * col_span)
+
+    def row_end(self):
+        pass
+
+    def table_end(self):
+        self.depth -= 1
+        if self.depth == 0 and self.rows:
+            width = max(max(len(row) for row in self.rows), 1)
+            lines = []
+            for row in self.rows:
+                cells = row + [""] * (width - len(row))
+                lines.append("| " + " | ".join(cells) + " |")
+                if len(lines) == 1:
+                    # the first row is the header row
+                    lines.append("|" + " --- |" * width)
+            self.blocks.append(lines)
+
+    def end(self):
+        pass
+
+    def result(self) -> str:
+        return "\n\n".join("\n".join(lines) for lines in self.blocks)
+
+
+class _TextTarget:
+    """
+    Renders _walk events as plain text: one line per paragraph or table row,
+    with cells separated by tabs and nested tables flattened into their cell.
+    """
+
+    def __init__(self):
+        self.lines = []
+        self.depth = 0
+        self.row = None
+        self.cell_parts = None
+
+    def paragraph(self, node):
+        if self.depth:
+            self.cell_parts.append(node.plain)
+        else:
+            self.lines.append(node.plain)
+
+    def table_start(self):
+        self.depth += 1
+
+    def row_start(self):
+        if self.depth == 1:
+            self.row = []
+
+    def cell_start(self, header: bool, row_span: int, col_span: int):
+        if self.depth == 1:
+            self.cell_parts = []
+
+    def cell_end(self):
+        if self.depth == 1:
+            self.row.append(" ".join(self.cell_parts))
+
+    def cell_skipped(self, header: bool, row_span: int, col_span: int):
+        pass
+
+    def row_end(self):
+        if self.depth == 1:
+            self.lines.append("\t".join(self.row))
+
+    def table_end(self):
+        self.depth -= 1
+
+    def end(self):
+        pass
+
+    def result(self) -> str:
+        return "\n".join(self.lines)
+
+
+class _TargetGroup:
+    # passes every _walk event on to several targets
+    def __init__(self, targets):
+        self.targets = targets
+
+    def paragraph(self, node):
+        for target in self.targets:
+            target.paragraph(node)
+
+    def table_start(self):
+        for target in self.targets:
+            target.table_start()
+
+    def row_start(self):
+        for target in self.targets:
+            target.row_start()
+
+    def cell_start(self, header: bool, row_span: int, col_span: int):
+        for target in self.targets:
+            target.cell_start(header, row_span, col_span)
+
+    def cell_end(self):
+        for target in self.targets:
+            target.cell_end()
+
+    def cell_skipped(self, header: bool, row_span: int, col_span: int):
+        for target in self.targets:
+            target.cell_skipped(header, row_span, col_span)
+
+    def row_end(self):
+        for target in self.targets:
+            target.row_end()
+
+    def table_end(self):
+        for target in self.targets:
+            target.table_end()
+
+    def end(self):
+        for target in self.targets:
+            target.end()
+
+
+def write_table_html(table_data: TableNode, lists, out: FragmentWriter):
+    _render_items([table_data], lists, out)
+
+
+@_timed("list_html")
+def write_list_html(node, lists, list_stack, out: FragmentWriter):
+    stats = _active_stats.get()
+    if stats is not None:
+        stats.list_items += 1
+
+    index = _list_index(lists)
+    level_id = index.ids[(node.list_id, node.nesting_level)]
+    open_tag = index.open_tags[level_id]
+    close_tag = index.close_tags[level_id]
+    depth = node.nesting_level + 1
+
+    if len(list_stack) < depth:
         # open new levels
-        while len(list_stack) < node.nesting_level + 1:
-            list_stack.append({"type": list_type, "level": len(list_stack)})
-            output.append(open_list_tag(list_type, style_type))
+        while len(list_stack) < depth:
+            list_stack.append(close_tag)
+            out.fragment(open_tag)
 
     # If we need to go shallower
-    elif len(list_stack) > node.nesting_level + 1:
-        while len(list_stack) > node.nesting_level + 1:
-            top = list_stack.pop()
-            output.append(close_list_tag(top["type"]))
+    elif len(list_stack) > depth:
+        while len(list_stack) > depth:
+            out.fragment(list_stack.pop())
 
     # If we remain at the same nesting level but changed from ul -> ol or vice versa
     if list_stack:
-        top_list = list_stack[-1]
-        if top_list["type"] != list_type:
+        if list_stack[-1] != close_tag:
             # close old
-            old = list_stack.pop()
-            output.append(close_list_tag(old["type"]))
+            out.fragment(list_stack.pop())
             # open new
-            list_stack.append({"type": list_type, "level": node.nesting_level})
-            output.append(open_list_tag(list_type, style_type))
+            list_stack.append(close_tag)
+            out.fragment(open_tag)
     else:
         # If stack is empty, open the list
-        list_stack.append({"type": list_type, "level": node.nesting_level})
-        output.append(open_list_tag(list_type, style_type))
+        list_stack.append(close_tag)
+        out.fragment(open_tag)
 
-    output.append(open_list_item())
-    output.append(node.text.strip())
-    output.append(close_list_item())
-    return "\n".join(output)
+    out.fragment(open_list_item())
+    out.fragment(node.text.strip())
+    out.fragment(close_list_item())
 
 
-def generate_html(nodes, lists) -> str:
-    output = []
-    list_stack = []
-
-    for node in nodes:
-        if isinstance(node, TableNode):
-            # close out any lists
-            while list_stack:
-                top = list_stack.pop()
-                output.append(close_list_tag(top["type"]))
-            output.append(generate_table_html(node, lists))
-            continue
+def write_node_html(node, lists, list_stack, out: FragmentWriter):
+    """
+    Render one node (or raw table) in the context of the lists open in
+    list_stack, leaving lists it opens open for the nodes that follow.
+    """
+    _render_items([node], lists, out, list_stack)
 
-        # the node is a paragraph node
-        if node.is_list_item:
-            output.append(generate_list_html(node, lists, list_stack))
-        else:
-            # Not a list item => close all open lists
-            while list_stack:
-                top = list_stack.pop()
-                output.append(close_list_tag(top["type"]))
-            output.append(node.text)
 
-    # make sure that any lists that are still open are closed
-    while list_stack:
-        top = list_stack.pop()
-        output.append(close_list_tag(top["type"]))
+def _writer(writer, minify: bool = False) -> FragmentWriter:
+    if hasattr(writer, "fragment"):
+        return writer
+    return MinifiedWriter(writer) if minify else FragmentWriter(writer)
+
+
+def render_to(nodes, lists, writer):
+    """
+    Render nodes into writer, a FragmentWriter or any sink accepted by one
+    (an open file, a socket's makefile(), a list's append, ...).
+    """
+    _render_items(nodes, lists, _writer(writer))
+
+
+def render_elements_to(
+    elements, lists, writer, cache: Optional["ElementCache"] = None, minify: bool = False
+):
+    """
+    Parse and render body.content elements in one pass, without building a
+    node tree: paragraphs are parsed as they are reached, tables cell by cell.
+    With an ElementCache, tables seen before are not parsed at all. minify
+    (or passing a MinifiedWriter) renders minified HTML.
+    """
+    out = _writer(writer, minify)
+    if cache is None:
+        _render_items(_iter_shallow_nodes(elements), lists, out)
+    else:
+        index = _list_index(lists)
+        minify = isinstance(out, MinifiedWriter)
+        _render_items(_iter_cached_nodes(elements, lists, index, cache, minify=minify), index, out)
+
+
+def _render_string(render, *args) -> str:
+    parts = []
+    render(*args, FragmentWriter(parts.append))
+    return "".join(parts)
+
+
+def generate_table_html(table_data: TableNode, lists) -> str:
+    return _render_string(write_table_html, table_data, lists)
+
+
+def generate_list_html(node, lists, list_stack) -> str:
+    return _render_string(write_list_html, node, lists, list_stack)
 
-    return "\n".join(output)
+
+def generate_html(nodes, lists) -> str:
+    return _render_string(render_to, nodes, lists)
 
 
 def parse_table_cell(table_cell) -> TableCellNode:
@@ -269,47 +1255,786 @@ def parse_table_cell(table_cell) -> TableCellNode:
     )
 
 
+@_timed("parse_table")
 def parse_table(table_elem) -> TableNode:
+    stats = _active_stats.get()
+    if stats is not None:
+        stats.tables += 1
+        stats.table_depth += 1
+        stats.max_table_depth = max(stats.max_table_depth, stats.table_depth)
+
     # TODO: handle the blockquote thing
     rows = []
-    for table_row in table_elem["tableRows"]:
-        cells = []
-        for table_cell in table_row["tableCells"]:
-            cell_node = parse_table_cell(table_cell)
-            if cell_node.nodes:
-                cells.append(cell_node)
-        rows.append(TableRowNode(cells=cells))
+    try:
+        for table_row in table_elem["tableRows"]:
+            cells = []
+            for table_cell in table_row["tableCells"]:
+                cell_node = parse_table_cell(table_cell)
+                if cell_node.nodes:
+                    cells.append(cell_node)
+            rows.append(TableRowNode(cells=cells))
+    finally:
+        if stats is not None:
+            stats.table_depth -= 1
+
+    if stats is not None:
+        stats.cells += sum(len(row["tableCells"]) for row in table_elem["tableRows"])
     return TableNode(rows=rows)
 
 
-def parse_content(body):
-    nodes = []
-    for value in body["content"]:
+def iter_content_nodes(elements):
+    memory = _active_memory.get()
+    for position, value in enumerate(elements):
+        if memory is not None:
+            memory.check("parse", position + 1)
         if "paragraph" in value:
             paragraph_node = parse_paragraph(value["paragraph"])
             if paragraph_node.text.strip():
-                nodes.append(paragraph_node)
+                yield paragraph_node
         if "table" in value:
-            nodes.append(parse_table(value["table"]))
-    return nodes
+            yield parse_table(value["table"])
+
+
+def parse_content(body):
+    return list(iter_content_nodes(body["content"]))
+
+
+def parse_doc_body(data, cache: Optional["ElementCache"] = None, minify: bool = False) -> str:
+    parts = []
+    render_elements_to(data["body"]["content"], data["lists"], parts.append, cache, minify)
+    return "".join(parts)
+
+
+OUTPUT_FORMATS = ("html", "markdown", "text")
+
+
+def _iter_formatted_nodes(elements, formats):
+    for value in elements:
+        if "paragraph" in value:
+            paragraph_node = parse_paragraph_formats(value["paragraph"], formats)
+            if paragraph_node.text.strip():
+                yield paragraph_node
+        if "table" in value:
+            yield value["table"]
+
+
+def parse_doc_body_formats(data, formats=OUTPUT_FORMATS) -> dict[str, str]:
+    """
+    Convert a document to several formats in one pass over body.content:
+    every paragraph's runs are parsed once and each format renders from the
+    same walk. formats are any of "html" (as parse_doc_body), "markdown"
+    (pipe tables, "-"/"1." lists, **bold**, _italic_) and "text" (plain
+    text, e.g. for a search index). Returns {format: output}.
+    """
+    unknown = set(formats) - set(OUTPUT_FORMATS)
+    if unknown:
+        raise ValueError(f"Unknown output formats: {', '.join(sorted(unknown))}")
+
+    index = ListIndex(data["lists"])
+    html_parts = []
+    targets = {}
+    for output_format in formats:
+        match output_format:
+            case "html":
+                targets["html"] = _HtmlTarget(index, FragmentWriter(html_parts.append))
+            case "markdown":
+                targets["markdown"] = _MarkdownTarget(index)
+            case "text":
+                targets["text"] = _TextTarget()
+
+    parse_elements = functools.partial(_iter_formatted_nodes, formats=frozenset(formats))
+    _walk(
+        parse_elements(data["body"]["content"]),
+        _TargetGroup(list(targets.values())),
+        parse_elements,
+    )
+    return {
+        output_format: "".join(html_parts) if output_format == "html" else target.result()
+        for output_format, target in targets.items()
+    }
+
+
+def _closes_lists(element) -> bool:
+    # tables and visible non-list paragraphs always close every open list;
+    # blank paragraphs are dropped, so they don't
+    if "table" in element:
+        return True
+    paragraph = element.get("paragraph")
+    if paragraph is None or "bullet" in paragraph:
+        return False
+    return any(
+        item.get("textRun", {}).get("content", "").strip()
+        for item in paragraph["elements"]
+    )
+
+
+def split_content(elements, chunks: int) -> list[list]:
+    """
+    Split body.content into about `chunks` runs of elements, only cutting
+    before an element that closes every open list, so each run renders the
+    same on its own as it does in place.
+    """
+    target = max(len(elements) // max(chunks, 1), 1)
+    runs = [[]]
+    for element in elements:
+        if len(runs[-1]) >= target and _closes_lists(element):
+            runs.append([])
+        runs[-1].append(element)
+    return runs
+
+
+def _render_elements(elements, lists) -> str:
+    return _render_string(render_elements_to, elements, lists)
+
+
+def parse_doc_body_parallel(
+    data, workers: Optional[int] = None, min_chunk_elements: int = 512, executor=None
+) -> str:
+    """
+    Same output as parse_doc_body, with body.content split at list-free
+    boundaries and each piece parsed and rendered in a worker process.
+    Pass an executor to reuse a pool across documents.
+    """
+    elements = data["body"]["content"]
+    workers = workers or os.cpu_count() or 1
+    # a few chunks per worker keeps them busy when chunks are uneven
+    chunks = min(workers * 4, len(elements) // max(min_chunk_elements, 1))
+    runs = split_content(elements, chunks)
+    if len(runs) < 2:
+        return parse_doc_body(data)
+
+    lists = [data["lists"]] * len(runs)
+    if executor is not None:
+        pieces = executor.map(_render_elements, runs, lists)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pieces = list(pool.map(_render_elements, runs, lists))
+    # a run of blank paragraphs renders to nothing and takes no line
+    return "\n".join(piece for piece in pieces if piece)
+
 
+_LIST_ID = re.compile(rb'"listId"\s*:\s*"((?:[^"\\]|\\.)*)"')
+_compact_encoder = json.JSONEncoder(
+    separators=(",", ":"), ensure_ascii=False, check_circular=False
+)
 
-def parse_doc_body(data) -> str:
-    return generate_html(parse_content(data["body"]), data["lists"])
 
+def element_fingerprint(element, lists) -> str:
+    """
+    Hash of a structural element together with the lists entries it uses.
+    Keys are hashed in export order, not sorted: the same element with its
+    keys reordered gets another fingerprint, which only ever costs a miss.
+    """
+    if orjson is not None:
+        payload = orjson.dumps(element)
+    else:
+        payload = _compact_encoder.encode(element).encode()
+    return _fingerprint_json(payload, lists)
+
+
+def _fingerprint_json(payload: bytes, lists) -> str:
+    # payload is the element's JSON text, as exported or re-encoded
+    fingerprint = hashlib.blake2b(payload, digest_size=16)
+    list_ids = sorted(set(_LIST_ID.findall(payload)))
+    if list_ids:
+        referenced = [lists.get(json.loads(b'"' + list_id + b'"')) for list_id in list_ids]
+        fingerprint.update(json.dumps(referenced, sort_keys=True).encode())
+    return fingerprint.hexdigest()
+
+
+class ElementCache:
+    """
+    Rendered HTML of top-level tables keyed by element_fingerprint, so the
+    same template table in many documents is parsed and rendered once per
+    process. Holds at most max_bytes of HTML, evicting the least recently
+    used entries first; hits, misses and hit_rate() report how well it does.
+    """
+
+    def __init__(self, max_bytes: int = 64 << 20):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            html = self._entries.get(key)
+            if html is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return html
+
+    def put(self, key: str, html: str):
+        size = len(html) + len(key)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = html
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                old_key, old_html = self._entries.popitem(last=False)
+                self.bytes -= len(old_html) + len(old_key)
+                self.evictions += 1
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def info(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hit_rate(), 4),
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "evictions": self.evictions,
+            }
+
+
+def _iter_cached_nodes(
+    elements, lists, index: ListIndex, cache: ElementCache, element_text=None, minify=False
+):
+    # _iter_shallow_nodes, with each top-level table served from the cache as
+    # one pre-rendered non-list node: like the table it stands for, it closes
+    # open lists and leaves none open. element_text(), if given, returns the
+    # JSON text of the element just yielded by elements, which is far cheaper
+    # to hash than re-encoding the element
+    for value in elements:
+        if "table" not in value:
+            yield from _iter_shallow_nodes((value,))
+            continue
+        if element_text is None:
+            key = element_fingerprint(value, lists)
+        else:
+            key = _fingerprint_json(element_text().encode(), lists)
+        if minify:
+            key += ":minified"
+        html = cache.get(key)
+        if html is None:
+            parts = []
+            _render_items([value["table"]], index, _writer(parts.append, minify))
+            html = "".join(parts)
+            cache.put(key, html)
+        yield ParagraphNode(text=html, is_list_item=False, list_id=None, nesting_level=0)
+
+
+class _FragmentList:
+    # FragmentWriter stand-in that keeps each fragment separately
+    def __init__(self):
+        self.fragments = []
+
+    @property
+    def count(self) -> int:
+        return len(self.fragments)
+
+    def fragment(self, text: str):
+        self.fragments.append(text)
+
+
+class IncrementalRenderer:
+    """
+    Renders successive revisions of the same document, reusing the HTML of
+    every top-level element whose fingerprint and incoming list nesting are
+    unchanged since the previous render. Only edited elements, plus any
+    neighbour whose list open/close boundary moved, are parsed and rendered
+    again. Output is identical to parse_doc_body.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self.rendered = 0
+        self.reused = 0
+
+    def render(self, data) -> str:
+        lists = data["lists"]
+        index = ListIndex(lists)
+        entries = {}
+        fragments = []
+        list_stack = []
+
+        for element in data["body"]["content"]:
+            key = (
+                element_fingerprint(element, lists),
+                tuple(list_stack),
+            )
+            entry = self._entries.get(key) or entries.get(key)
+            if entry is None:
+                out = _FragmentList()
+                _render_items(_iter_shallow_nodes([element]), index, out, list_stack)
+                entry = (out.fragments, tuple(list_stack))
+                self.rendered += 1
+            else:
+                list_stack = list(entry[1])
+                self.reused += 1
+            entries[key] = entry
+            fragments.extend(entry[0])
+
+        out = _FragmentList()
+        _close_lists(list_stack, out)
+        fragments.extend(out.fragments)
+
+        # only the latest revision is worth keeping
+        self._entries = entries
+        return "\n".join(fragments)
+
+
+_JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+class JsonStreamReader:
+    """
+    Pull-based reader over a JSON text or byte stream.
+
+    Values are decoded one at a time with ``json.JSONDecoder.raw_decode``, and
+    containers can be walked key by key or item by item, so only the value
+    currently being decoded has to be held in memory.
+    """
+
+    def __init__(self, stream, chunk_size: int = 1 << 16):
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = None
+        self._buf = ""
+        self._pos = 0
+        self._value_start = 0
+        self._eof = False
+
+    def _fill(self) -> bool:
+        if self._eof:
+            return False
+        # grow reads with the pending value so retried decodes stay linear
+        raw = self._stream.read(max(self._chunk_size, len(self._buf) - self._pos))
+        if not raw:
+            self._eof = True
+            chunk = self._text_decoder.decode(b"", final=True) if self._text_decoder else ""
+        elif isinstance(raw, str):
+            chunk = raw
+        else:
+            if self._text_decoder is None:
+                self._text_decoder = codecs.getincrementaldecoder("utf-8-sig")()
+            chunk = self._text_decoder.decode(raw)
+        self._buf = self._buf[self._pos :] + chunk
+        self._pos = 0
+        return bool(raw)
+
+    def _error(self, msg):
+        return json.JSONDecodeError(msg, self._buf, self._pos)
+
+    def peek(self) -> str:
+        """
+        Skip whitespace and return the next character, or "" at the end.
+        """
+        while True:
+            self._pos = _JSON_WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ""
+
+    def _expect(self, char):
+        if self.peek() != char:
+            raise self._error(f"Expecting {char!r}")
+        self._pos += 1
+
+    @_timed("decode")
+    def read_value(self):
+        return self._decode_value()
+
+    def _decode_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # a number touching the end of the buffer may continue past it
+            if end == len(self._buf) and self._fill():
+                continue
+            self._value_start = self._pos
+            self._pos = end
+            return value
+
+    def last_value_text(self) -> str:
+        """
+        The JSON text of the value read last, until the reader moves on.
+        """
+        return self._buf[self._value_start : self._pos]
+
+    @_timed("decode")
+    def skip_value(self):
+        """
+        Step over the next value without keeping it. The two outer levels of a
+        container are walked key by key or item by item, and anything deeper
+        is decoded by the C decoder and dropped at once: skipping "body" holds
+        one body.content element at a time, never the whole body.
+        """
+        self._skip(2)
+
+    def _skip(self, levels):
+        char = self.peek()
+        if levels and char == "{":
+            for _ in self.iter_keys():
+                self._skip(levels - 1)
+        elif levels and char == "[":
+            for _ in self._iter_array(lambda: self._skip(levels - 1)):
+                pass
+        else:
+            self._decode_value()
+
+    def iter_keys(self):
+        """
+        Walk an object, yielding each key. The caller must read or skip the
+        matching value before asking for the next key.
+        """
+        self._expect("{")
+        if self.peek() == "}":
+            self._pos += 1
+            return
+        while True:
+            if self.peek() != '"':
+                raise self._error("Expecting property name enclosed in double quotes")
+            key = self._decode_value()
+            self._expect(":")
+            yield key
+            char = self.peek()
+            self._pos += 1
+            if char == "}":
+                return
+            if char != ",":
+                raise self._error("Expecting ',' delimiter")
+
+    def iter_items(self):
+        """
+        Walk an array, decoding and yielding one item at a time.
+        """
+        return self._iter_array(self.read_value)
+
+    def _iter_array(self, read):
+        self._expect("[")
+        if self.peek() == "]":
+            self._pos += 1
+            return
+        while True:
+            yield read()
+            char = self.peek()
+            self._pos += 1
+            if char == "]":
+                return
+            if char != ",":
+                raise self._error("Expecting ',' delimiter")
+
+
+def _read_lists(stream, chunk_size):
+    reader = JsonStreamReader(stream, chunk_size)
+    for key in reader.iter_keys():
+        if key == "lists":
+            return reader.read_value()
+        reader.skip_value()
+    return None
 
-def main():
-    directory = "inputs/"
-    # file = "headings_and_paragraphs_tables.json"
-    file = "12b_notes_no_questions.json"
 
-    json_file_path = os.path.join(directory, file)
-    # print("Running Parser")
-    # print(json_file_path)
+_TRAILING_ID = re.compile(rb'"(?:documentId|revisionId)"[ \t\n\r]*:')
+_member_decoder = json.JSONDecoder()
 
-    with open(json_file_path, "r") as file:
-        data = json.load(file)
-        print(parse_doc_body(data))
+
+def _trailing_members(text: str) -> Optional[dict]:
+    # the members from a key of the top-level object to its end, or None if
+    # text doesn't parse as exactly that
+    members = {}
+    pos = 0
+    try:
+        while True:
+            key, pos = _member_decoder.raw_decode(text, pos)
+            pos = _JSON_WHITESPACE.match(text, pos).end()
+            if type(key) is not str or text[pos : pos + 1] != ":":
+                return None
+            pos = _JSON_WHITESPACE.match(text, pos + 1).end()
+            members[key], pos = _member_decoder.raw_decode(text, pos)
+            pos = _JSON_WHITESPACE.match(text, pos).end()
+            char = text[pos : pos + 1]
+            pos = _JSON_WHITESPACE.match(text, pos + 1).end()
+            if char == "}":
+                return members if pos == len(text) else None
+            if char != ",":
+                return None
+    except json.JSONDecodeError:
+        return None
+
+
+def _read_trailing_ids(file, tail_bytes: int) -> Optional[tuple]:
+    position = file.tell()
+    size = file.seek(0, os.SEEK_END)
+    file.seek(max(size - tail_bytes, position))
+    tail = file.read()
+    file.seek(position)
+    for match in _TRAILING_ID.finditer(tail):
+        start = match.start()
+        if (start - len(tail[:start].rstrip(b"\\"))) % 2:
+            # the quote is escaped, so this is inside a string
+            continue
+        try:
+            members = _trailing_members(tail[start:].decode("utf-8"))
+        except UnicodeDecodeError:
+            return None
+        if members is not None:
+            if "documentId" in members and "revisionId" in members:
+                return members["documentId"], members["revisionId"]
+            return None
+    return None
+
+
+def read_document_ids(stream, chunk_size: int = 1 << 16, tail_bytes: int = 1 << 16):
+    """
+    Return (documentId, revisionId) of an export, either of which may be
+    None, skipping over the body without decoding it. Docs exports put
+    both after the body, so a seekable binary stream is first searched in
+    its last tail_bytes: ids found there as keys of the top-level object,
+    parsed through to its closing brace, are returned without reading the
+    rest. Otherwise the whole export is walked.
+    """
+    if isinstance(stream, io.BufferedIOBase) and stream.seekable():
+        ids = _read_trailing_ids(stream, tail_bytes)
+        if ids is not None:
+            return ids
+    reader = JsonStreamReader(stream, chunk_size)
+    ids = {}
+    for key in reader.iter_keys():
+        if key in ("documentId", "revisionId"):
+            ids[key] = reader.read_value()
+            if len(ids) == 2:
+                break
+        else:
+            reader.skip_value()
+    return ids.get("documentId"), ids.get("revisionId")
+
+
+def _iter_body_elements(reader):
+    for key in reader.iter_keys():
+        if key == "content":
+            yield from reader.iter_items()
+        else:
+            reader.skip_value()
+
+
+def parse_doc_stream(
+    stream,
+    chunk_size: int = 1 << 16,
+    writer=None,
+    cache: Optional[ElementCache] = None,
+    ids: Optional[dict] = None,
+    minify: bool = False,
+):
+    """
+    Same output as parse_doc_body, but reads the export incrementally from a
+    text or binary stream and renders each body.content element as it is
+    decoded, so the full document is never materialized.
+
+    When "lists" comes after "body" it is fetched with a cheap skipping pass
+    if the stream is seekable; otherwise the parsed nodes are buffered until
+    "lists" arrives.
+
+    If writer is given the HTML is rendered into it and None is returned.
+    cache is an optional ElementCache, used once "lists" is known. If ids
+    is given, the top-level "documentId" and "revisionId" are stored in it.
+    minify renders minified HTML.
+    """
+    parts = [] if writer is None else None
+    out = _writer(parts.append if writer is None else writer, minify)
+    start = stream.tell() if stream.seekable() else None
+    reader = JsonStreamReader(stream, chunk_size)
+    lists = None
+    pending_nodes = None
+
+    for key in reader.iter_keys():
+        if key == "lists":
+            if lists is None:
+                lists = reader.read_value()
+            else:
+                reader.skip_value()
+        elif key == "body":
+            if lists is None and start is not None:
+                resume = stream.tell()
+                stream.seek(start)
+                lists = _read_lists(stream, chunk_size) or {}
+                stream.seek(resume)
+            if lists is None:
+                pending_nodes = list(_iter_shallow_nodes(_iter_body_elements(reader)))
+            else:
+                elements = _iter_body_elements(reader)
+                if cache is None:
+                    _render_items(_iter_shallow_nodes(elements), lists, out)
+                else:
+                    index = ListIndex(lists)
+                    nodes = _iter_cached_nodes(
+                        elements, lists, index, cache, reader.last_value_text, minify
+                    )
+                    _render_items(nodes, index, out)
+        elif ids is not None and key in ("documentId", "revisionId"):
+            ids[key] = reader.read_value()
+        else:
+            reader.skip_value()
+
+    if pending_nodes is not None:
+        _render_items(pending_nodes, lists if lists is not None else {}, out)
+    return "".join(parts) if parts is not None else None
+
+
+def json_backend() -> str:
+    """
+    Name of the decoder decode_json uses: "orjson", "simdjson" or "json".
+    """
+    if orjson is not None:
+        return "orjson"
+    if simdjson is not None:
+        return "simdjson"
+    return "json"
+
+
+@_timed("decode")
+def decode_json(payload):
+    """
+    Decode a whole JSON document from bytes, bytearray, a memoryview (of an
+    mmap, say) or str, with the fastest installed backend. Buffers are
+    decoded where they are instead of being copied to bytes first.
+    """
+    if isinstance(payload, str):
+        return orjson.loads(payload) if orjson is not None else json.loads(payload)
+
+    with memoryview(payload) as view:
+        start = 3 if view[:3] == codecs.BOM_UTF8 else 0
+        if orjson is not None:
+            return orjson.loads(view[start:])
+        if simdjson is not None:
+            try:
+                return simdjson.Parser().parse(view[start:], True)
+            except ValueError as exc:
+                # callers only need to handle the stdlib error
+                raise json.JSONDecodeError(str(exc), "", 0) from exc
+        return json.loads(str(view[start:], "utf-8"))
+
+
+def load_document(path) -> dict:
+    """
+    Decode the export at path through a read-only memory map, so the file is
+    never read into an intermediate bytes object.
+    """
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            # empty files can't be mapped; let the decoder reject them
+            return decode_json(b"")
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return decode_json(mapped)
+
+
+def parse_doc_buffer(payload) -> str:
+    """
+    parse_doc_body for an export still in its encoded form, e.g. an HTTP
+    response body; see decode_json for the accepted types.
+    """
+    return parse_doc_body(decode_json(payload))
+
+
+def _render_decoded(path, writer, cache, minify):
+    memory = _active_memory.get()
+    data = load_document(path)
+    if memory is not None:
+        memory.check("decode")
+    render_elements_to(data["body"]["content"], data["lists"], writer, cache, minify)
+    return data.get("documentId"), data.get("revisionId")
+
+
+def render_file(
+    path,
+    writer,
+    stream: Optional[bool] = None,
+    cache: Optional[ElementCache] = None,
+    minify: bool = False,
+):
+    """
+    Render the export at path into writer. By default the file is streamed
+    with parse_doc_stream when only the stdlib decoder is available (it is no
+    slower there, and memory stays bounded), and decoded whole with
+    load_document when a faster backend is installed. stream forces either.
+    cache is an optional ElementCache. minify renders minified HTML.
+
+    Inside track_memory with a budget, a decoded document that goes over it
+    is streamed instead, without the cache, provided writer is a seekable
+    file to truncate first; otherwise MemoryBudgetExceeded propagates.
+
+    Returns the export's (documentId, revisionId), either of which may be None.
+    """
+    if stream is None:
+        stream = json_backend() == "json"
+    if not stream:
+        try:
+            return _render_decoded(path, writer, cache, minify)
+        except MemoryBudgetExceeded:
+            if not (hasattr(writer, "seekable") and writer.seekable()):
+                raise
+        # the decoded document went with the exception; start over streaming
+        writer.seek(0)
+        writer.truncate()
+        memory = _active_memory.get()
+        memory.fallback = True
+        memory.restart()
+        cache = None
+    ids = {}
+    with open(path, "rb") as file:
+        parse_doc_stream(file, writer=writer, cache=cache, ids=ids, minify=minify)
+    return ids.get("documentId"), ids.get("revisionId")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert a Google Docs JSON export to HTML (or Markdown or text) on stdout.",
+        epilog="Use docs_to_md_batch.py to convert whole directories.",
+    )
+    parser.add_argument(
+        "input",
+        nargs="?",
+        default=os.path.join("inputs", "12b_notes_no_questions.json"),
+        help="path to the exported document JSON",
+    )
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default="html")
+    parser.add_argument(
+        "--minify",
+        action="store_true",
+        help="with --format html, leave out the newlines between tags and "
+        "redundant <p> and inline tags",
+    )
+    parser.add_argument(
+        "--stream",
+        action=argparse.BooleanOptionalAction,
+        help="decode the export incrementally in bounded memory, or whole from "
+        "a memory map (default: stream unless orjson or simdjson is installed)",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="print decode and render timings to stderr as JSON",
+    )
+    args = parser.parse_args(argv)
+
+    with instrumented(args.input) if args.stats else contextlib.nullcontext() as stats:
+        if args.format == "html":
+            render_file(args.input, sys.stdout, args.stream, minify=args.minify)
+        else:
+            data = load_document(args.input)
+            sys.stdout.write(parse_doc_body_formats(data, [args.format])[args.format])
+        sys.stdout.write("\n")
+    if stats is not None:
+        print(json.dumps(stats.to_record()), file=sys.stderr)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,1193 @@
+import abc
+import argparse
+import contextlib
+import functools
+import glob
+import gzip
+import hashlib
+import io
+import json
+import mmap
+import os
+import re
+import shutil
+import sys
+import tarfile
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, BrokenExecutor, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Optional
+
+from docs_to_md import (
+    CONVERTER_VERSION,
+    ElementCache,
+    instrumented,
+    read_document_ids,
+    render_file,
+    track_memory,
+)
+
+
+@dataclass
+class ConversionResult:
+    input_path: str
+    output_path: str
+    ok: bool
+    seconds: float
+    error: Optional[str] = None
+    cached: bool = False
+    stats: Optional[dict] = None
+    # lookups of this document in its worker's ElementCache
+    element_hits: int = 0
+    element_misses: int = 0
+    input_hash: Optional[str] = None
+    # set instead of writing output_path when converting for an OutputSink
+    html: Optional[str] = None
+    document_id: Optional[str] = None
+    revision_id: Optional[str] = None
+    # traced with track_memory, when asked for
+    peak_bytes: Optional[int] = None
+    retained_bytes: Optional[int] = None
+    memory_fallback: bool = False
+
+
+def _digest(*parts) -> str:
+    return hashlib.sha256("\0".join(map(str, parts)).encode()).hexdigest()
+
+
+def file_digest(path: str) -> str:
+    with open(path, "rb") as file:
+        return hashlib.file_digest(file, "sha256").hexdigest()
+
+
+def converter_version(minify: bool = False) -> str:
+    # what cached and recorded conversions must match: the converter and its output mode
+    return f"{CONVERTER_VERSION}-minified" if minify else CONVERTER_VERSION
+
+
+class ConversionCache:
+    """
+    Persistent cache of rendered HTML, shared by every worker of a batch run.
+
+    Entries are keyed by documentId + revisionId (or a hash of the export when
+    it carries no revision) together with the converter_version. Each input path
+    also gets a small reference file keyed by its size and mtime, so an
+    unchanged file is found again with one stat and one read, without opening
+    the export at all. Hits refresh the mtimes of the entry and of the
+    reference file used, and evict() removes the least recently used of
+    both once the cache grows past max_bytes.
+    Minified and regular output are cached separately.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 1 << 30, minify: bool = False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.minify = minify
+
+    @property
+    def version(self) -> str:
+        return converter_version(self.minify)
+
+    def _path(self, key: str, suffix: str) -> str:
+        return os.path.join(self.directory, key[:2], key + suffix)
+
+    def _stat_key(self, input_path: str) -> str:
+        st = os.stat(input_path)
+        return _digest(
+            self.version, "stat", os.path.realpath(input_path), st.st_size, st.st_mtime_ns
+        )
+
+    def entry_key(self, input_path: str) -> str:
+        with open(input_path, "rb") as file:
+            document_id, revision_id = read_document_ids(file)
+        if document_id is not None and revision_id is not None:
+            return _digest(self.version, "revision", document_id, revision_id)
+        return _digest(self.version, "content", file_digest(input_path))
+
+    def _touch(self, key: str) -> Optional[str]:
+        path = self._path(key, ".html")
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def _write_atomic(self, path: str, write):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        write(tmp_path)
+        os.replace(tmp_path, path)
+
+    def _link(self, input_path: str, key: str):
+        def write(tmp_path):
+            with open(tmp_path, "w") as file:
+                file.write(key)
+
+        self._write_atomic(self._path(self._stat_key(input_path), ".ref"), write)
+
+    def lookup(self, input_path: str) -> tuple[Optional[str], str]:
+        """
+        Return (path of the cached HTML or None, entry key for this input).
+        """
+        ref_path = self._path(self._stat_key(input_path), ".ref")
+        try:
+            with open(ref_path) as file:
+                key = file.read()
+        except FileNotFoundError:
+            key = None
+        if key is not None:
+            path = self._touch(key)
+            if path is not None:
+                with contextlib.suppress(FileNotFoundError):
+                    os.utime(ref_path)
+                return path, key
+
+        key = self.entry_key(input_path)
+        path = self._touch(key)
+        if path is not None:
+            self._link(input_path, key)
+        return path, key
+
+    def store(self, key: str, input_path: str, html_path: str):
+        self._write_atomic(
+            self._path(key, ".html"), lambda tmp_path: shutil.copyfile(html_path, tmp_path)
+        )
+        self._link(input_path, key)
+
+    def store_text(self, key: str, input_path: str, html: str):
+        def write(tmp_path):
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                file.write(html)
+
+        self._write_atomic(self._path(key, ".html"), write)
+        self._link(input_path, key)
+
+    def evict(self) -> int:
+        """
+        Drop least recently used entries and reference files until the cache
+        fits in max_bytes, then the references whose entry is gone. Returns
+        the number of entries removed. Workers on other hosts may be evicting
+        the same directory at the same time, so files that vanish midway are
+        skipped.
+        """
+        files = []
+        total = 0
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.endswith((".html", ".ref")):
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    files.append((st.st_mtime_ns, st.st_size, path))
+                    total += st.st_size
+
+        removed = 0
+        refs = []
+        for _, size, path in sorted(files):
+            if total > self.max_bytes:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+                    removed += path.endswith(".html")
+                total -= size
+            elif path.endswith(".ref"):
+                refs.append(path)
+        for path in refs:
+            with contextlib.suppress(FileNotFoundError):
+                with open(path) as file:
+                    key = file.read()
+                if not os.path.exists(self._path(key, ".html")):
+                    os.remove(path)
+        return removed
+
+
+def _glob_root(pattern: str) -> str:
+    # the directory part of the pattern before the first wildcard
+    parts = []
+    for part in pattern.split(os.sep):
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    return os.sep.join(parts) or "."
+
+
+def find_inputs(patterns, extension: str = ".json") -> list[tuple[str, str]]:
+    """
+    Expand files, directories (searched recursively) and glob patterns into
+    (input_path, relative_path) pairs. The relative path is what gets
+    mirrored under the output directory.
+    """
+    found = {}
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for dirpath, dirnames, filenames in os.walk(pattern):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if filename.endswith(extension):
+                        path = os.path.join(dirpath, filename)
+                        found.setdefault(path, os.path.relpath(path, pattern))
+        elif glob.has_magic(pattern):
+            root = _glob_root(pattern)
+            for path in sorted(glob.glob(pattern, recursive=True)):
+                if os.path.isfile(path):
+                    found.setdefault(path, os.path.relpath(path, root))
+        else:
+            found.setdefault(pattern, os.path.basename(pattern))
+    return list(found.items())
+
+
+def output_path_for(
+    input_path: str, relative_path: str, output_dir: Optional[str], suffix: str
+) -> str:
+    if output_dir is None:
+        # write next to the input
+        return os.path.splitext(input_path)[0] + suffix
+    return os.path.join(output_dir, os.path.splitext(relative_path)[0] + suffix)
+
+
+def check_outputs(jobs):
+    """
+    Raise ValueError if several (input_path, output_path) jobs would write
+    the same output, as exports of the same name given from different
+    directories do under one output directory.
+    """
+    inputs = {}
+    for input_path, output_path in jobs:
+        inputs.setdefault(output_path, []).append(input_path)
+    clashes = [
+        f"{output_path} <- {', '.join(paths)}"
+        for output_path, paths in inputs.items()
+        if len(paths) > 1
+    ]
+    if clashes:
+        raise ValueError(
+            "several inputs would be written to the same output:\n  " + "\n  ".join(clashes)
+        )
+
+
+class Manifest:
+    """
+    Append-only JSON-lines log of conversion attempts, one record per
+    finished document: input path, size, mtime and hash, output path,
+    status, error and timing. Reloading it lets an interrupted run resume
+    where it stopped; the latest record of an input is its state, and
+    failed attempts since its last success count towards a retry cap.
+    Outputs only count as done if they were made in the same output mode,
+    and with gzip_sidecar only if their .gz sidecar exists too.
+    """
+
+    def __init__(self, path: str, minify: bool = False, gzip_sidecar: bool = False):
+        self.path = path
+        self.minify = minify
+        self.gzip_sidecar = gzip_sidecar
+        self.records = {}
+        self.failures = {}
+        self._file = None
+        self._torn = False
+        if os.path.exists(path):
+            self._load()
+
+    @property
+    def converter(self) -> str:
+        return converter_version(self.minify)
+
+    def _load(self):
+        line = ""
+        with open(self.path, encoding="utf-8") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # a run killed mid-write leaves a torn last line
+                    continue
+                self._apply(record)
+            self._torn = bool(line) and not line.endswith("\n")
+
+    def _apply(self, record: dict):
+        input_path = record["input"]
+        self.records[input_path] = record
+        if record["status"] == "ok":
+            self.failures.pop(input_path, None)
+        else:
+            self.failures[input_path] = self.failures.get(input_path, 0) + 1
+
+    def append(self, record: dict):
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+            if self._torn:
+                self._file.write("\n")
+        self._file.write(json.dumps(record) + "\n")
+        # one line per document, so a crash loses at most the one in flight
+        self._file.flush()
+        self._apply(record)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def is_done(self, input_path: str, output_path: str, st: os.stat_result) -> bool:
+        """
+        Whether input_path was converted to output_path by this converter
+        version and has not changed since. Only inputs whose mtime moved are
+        hashed again.
+        """
+        record = self.records.get(input_path)
+        if (
+            record is None
+            or record["status"] != "ok"
+            or record["output"] != output_path
+            or record["converter"] != self.converter
+            or record["size"] != st.st_size
+            or not os.path.exists(output_path)
+            or (self.gzip_sidecar and not os.path.exists(output_path + ".gz"))
+        ):
+            return False
+        if record["mtime_ns"] == st.st_mtime_ns:
+            return True
+        return record["input_hash"] == file_digest(input_path)
+
+    def gave_up(self, input_path: str, st: os.stat_result, max_retries: int) -> bool:
+        """
+        Whether input_path failed more than max_retries times in a row and
+        has not changed since its last attempt.
+        """
+        record = self.records.get(input_path)
+        return (
+            self.failures.get(input_path, 0) > max_retries
+            and (record["size"], record["mtime_ns"]) == (st.st_size, st.st_mtime_ns)
+        )
+
+
+def manifest_record(
+    result: ConversionResult, st: Optional[os.stat_result], converter: str = CONVERTER_VERSION
+) -> dict:
+    return {
+        "input": result.input_path,
+        "output": result.output_path,
+        "status": "ok" if result.ok else "failed",
+        "error": result.error,
+        "cached": result.cached,
+        "seconds": round(result.seconds, 6),
+        "size": st.st_size if st else None,
+        "mtime_ns": st.st_mtime_ns if st else None,
+        "input_hash": result.input_hash,
+        "converter": converter,
+        "finished": time.time(),
+    }
+
+
+# one ElementCache per process, shared by every document the process converts
+_element_cache: Optional[ElementCache] = None
+
+
+def _process_element_cache(max_bytes: int) -> Optional[ElementCache]:
+    global _element_cache
+    if max_bytes <= 0:
+        return None
+    if _element_cache is None or _element_cache.max_bytes != max_bytes:
+        _element_cache = ElementCache(max_bytes)
+    return _element_cache
+
+
+def write_gzip_sidecar(path: str, level: int = 9):
+    """
+    Write a gzipped copy of path to path + ".gz", for web servers that serve
+    precompressed files (nginx's gzip_static, say): compressed once, at the
+    best level, instead of on every request. The gzip header carries no
+    name or timestamp, so unchanged output compresses to identical bytes.
+    """
+    sidecar_path = path + ".gz"
+    tmp_path = f"{sidecar_path}.{os.getpid()}.tmp"
+    try:
+        with open(path, "rb") as src, open(tmp_path, "wb") as raw:
+            with gzip.GzipFile("", "wb", level, raw, mtime=0) as compressed:
+                shutil.copyfileobj(src, compressed, SINK_BUFFER_BYTES)
+        os.replace(tmp_path, sidecar_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def publish_output(path: str, output_path: str, gzip_sidecar: bool = False):
+    """
+    Move a finished output from path to output_path, and with gzip_sidecar
+    its sidecar from path + ".gz" to output_path + ".gz". The sidecar goes
+    first and is removed again if the output can't follow it, so a sidecar
+    never sits next to an output it doesn't match. Without gzip_sidecar a
+    sidecar left by an earlier run is removed, or web servers would keep
+    serving it in place of the new output.
+    """
+    sidecar_path = output_path + ".gz"
+    if not gzip_sidecar:
+        try:
+            os.remove(sidecar_path)
+        except FileNotFoundError:
+            pass
+        os.replace(path, output_path)
+        return
+    os.replace(path + ".gz", sidecar_path)
+    try:
+        os.replace(path, output_path)
+    except BaseException:
+        os.remove(sidecar_path)
+        raise
+
+
+def _convert_to(
+    input_path: str,
+    tmp_path: str,
+    cache: Optional[ConversionCache],
+    element_cache: Optional[ElementCache] = None,
+    minify: bool = False,
+) -> bool:
+    cached_path = None
+    if cache is not None:
+        cached_path, key = cache.lookup(input_path)
+    if cached_path is not None:
+        try:
+            shutil.copyfile(cached_path, tmp_path)
+            return True
+        except FileNotFoundError:
+            # evicted by a worker sharing the cache since the lookup
+            pass
+
+    with open(tmp_path, "w", encoding="utf-8") as dst:
+        render_file(input_path, dst, cache=element_cache, minify=minify)
+    if cache is not None:
+        cache.store(key, input_path, tmp_path)
+    return False
+
+
+def _convert_text(
+    input_path: str,
+    result: ConversionResult,
+    cache: Optional[ConversionCache],
+    element_cache: Optional[ElementCache] = None,
+    minify: bool = False,
+) -> bool:
+    # like _convert_to, but keeps the HTML and ids on result instead of writing a file
+    cached_path = None
+    if cache is not None:
+        cached_path, key = cache.lookup(input_path)
+    if cached_path is not None:
+        try:
+            with open(cached_path, encoding="utf-8") as file:
+                result.html = file.read()
+        except FileNotFoundError:
+            # evicted by a worker sharing the cache since the lookup
+            cached_path = None
+    if cached_path is not None:
+        with open(input_path, "rb") as file:
+            result.document_id, result.revision_id = read_document_ids(file)
+        return True
+
+    out = io.StringIO()
+    result.document_id, result.revision_id = render_file(
+        input_path, out, cache=element_cache, minify=minify
+    )
+    result.html = out.getvalue()
+    if cache is not None:
+        cache.store_text(key, input_path, result.html)
+    return False
+
+
+def convert_file(
+    input_path: str,
+    output_path: str,
+    cache: Optional[ConversionCache] = None,
+    collect_stats: bool = False,
+    element_cache_bytes: int = 0,
+    hash_input: bool = False,
+    keep_html: bool = False,
+    trace_memory: bool = False,
+    document_memory: Optional[int] = None,
+    minify: bool = False,
+    gzip_sidecar: bool = False,
+) -> ConversionResult:
+    """
+    Convert one export. element_cache_bytes > 0 renders repeated tables from
+    a per-process ElementCache of that size, kept across calls. hash_input
+    also records the sha256 of the input, as a Manifest wants. keep_html
+    returns the HTML and document ids on the result for an OutputSink and
+    writes nothing; output_path is then only the name to file it under.
+
+    trace_memory records the conversion's peak and retained memory, traced
+    with tracemalloc. document_memory (which implies it) is a budget in
+    bytes: a document over it is retried with the streaming parser, and
+    fails with MemoryBudgetExceeded if that goes over too.
+
+    minify writes minified HTML; a cache must have been made with the same
+    minify. gzip_sidecar also writes output_path + ".gz".
+    """
+    start = time.perf_counter()
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    result = ConversionResult(
+        input_path=input_path, output_path=output_path, ok=False, seconds=0.0
+    )
+    element_cache = _process_element_cache(element_cache_bytes)
+    if element_cache is not None:
+        hits, misses = element_cache.hits, element_cache.misses
+    if keep_html:
+        convert = functools.partial(
+            _convert_text, input_path, result, cache, element_cache, minify
+        )
+    else:
+        convert = functools.partial(
+            _convert_to, input_path, tmp_path, cache, element_cache, minify
+        )
+    if trace_memory or document_memory:
+        memory = track_memory(document_memory)
+    else:
+        memory = contextlib.nullcontext()
+    usage = None
+    try:
+        if not keep_html:
+            os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        with memory as usage:
+            if collect_stats:
+                try:
+                    with instrumented(input_path) as stats:
+                        result.cached = convert()
+                finally:
+                    # failed documents are the ones whose stats matter most
+                    result.stats = stats.to_record()
+            else:
+                result.cached = convert()
+        if not keep_html:
+            if gzip_sidecar:
+                write_gzip_sidecar(tmp_path)
+            # never leave a half-written output behind
+            publish_output(tmp_path, output_path, gzip_sidecar)
+        if hash_input:
+            result.input_hash = file_digest(input_path)
+        result.ok = True
+    except Exception as exc:
+        for leftover in (tmp_path, tmp_path + ".gz"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        result.error = f"{type(exc).__name__}: {exc}"
+        if result.stats is not None:
+            result.stats["error"] = result.error
+    if usage is not None:
+        result.peak_bytes = usage.peak_bytes
+        result.retained_bytes = usage.retained_bytes
+        result.memory_fallback = usage.fallback
+        if result.stats is not None:
+            result.stats.update(usage.to_record())
+    if element_cache is not None:
+        result.element_hits = element_cache.hits - hits
+        result.element_misses = element_cache.misses - misses
+    result.seconds = time.perf_counter() - start
+    return result
+
+
+# a decoded export takes roughly this many bytes of memory per byte of JSON
+MEMORY_PER_INPUT_BYTE = 10
+# extra cost, in input bytes, of each paragraph counted by count_elements
+COST_PER_ELEMENT = 256
+
+_PARAGRAPH_KEY = re.compile(rb'"paragraph"')
+
+
+def count_elements(path: str) -> int:
+    """
+    Cheap count of the paragraphs in an export: a byte search over a memory
+    map, without decoding anything. Escaped quotes inside text can't match.
+    """
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return 0
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return len(_PARAGRAPH_KEY.findall(mapped))
+
+
+def estimate_cost(path: str, with_elements: bool = False, size: Optional[int] = None) -> int:
+    """
+    Relative cost of converting path, in input bytes. with_elements adds a
+    per-paragraph cost from count_elements. size is the file's size, when
+    the caller already knows it. Unreadable inputs cost nothing.
+    """
+    try:
+        cost = os.path.getsize(path) if size is None else size
+        if with_elements:
+            cost += COST_PER_ELEMENT * count_elements(path)
+    except OSError:
+        return 0
+    return cost
+
+
+@dataclass
+class Task:
+    # jobs one worker converts in a row, with their cost and peak memory estimates
+    jobs: list
+    cost: int
+    memory: int
+
+
+def plan_tasks(
+    jobs, workers: int, with_elements: bool = False, max_jobs: Optional[int] = None
+) -> list[Task]:
+    """
+    Order jobs largest first and group the small ones into chunks, using
+    guided self-scheduling: each chunk is worth about remaining / (2 *
+    workers) of the total cost, so chunks shrink towards the end of the run
+    and the last ones even out the workers. Anything at least that big is a
+    task of its own. max_jobs caps the jobs in one chunk.
+    """
+    costed = []
+    for job in jobs:
+        try:
+            size = os.path.getsize(job[0])
+        except OSError:
+            # unreadable inputs fail fast
+            size = 0
+        costed.append((estimate_cost(job[0], with_elements, size), size, job))
+    costed.sort(key=lambda item: item[0], reverse=True)
+
+    remaining = sum(cost for cost, _, _ in costed)
+    tasks = []
+    chunk = None
+    for cost, size, job in costed:
+        target = remaining / (2 * workers)
+        if chunk is None:
+            chunk = Task(jobs=[], cost=0, memory=0)
+            tasks.append(chunk)
+        chunk.jobs.append(job)
+        chunk.cost += cost
+        chunk.memory = max(chunk.memory, size * MEMORY_PER_INPUT_BYTE)
+        remaining -= cost
+        if chunk.cost >= target or len(chunk.jobs) == max_jobs:
+            chunk = None
+    return tasks
+
+
+def _convert_chunk(convert, jobs) -> list[ConversionResult]:
+    return [convert(input_path, output_path) for input_path, output_path in jobs]
+
+
+def _failed_result(job, exc) -> ConversionResult:
+    input_path, output_path = job
+    return ConversionResult(
+        input_path=input_path,
+        output_path=output_path,
+        ok=False,
+        seconds=0.0,
+        error=f"{type(exc).__name__}: {exc}",
+    )
+
+
+def run_scheduled(
+    executor, tasks, workers: int, run, memory_budget: Optional[int] = None, failed=None
+):
+    """
+    Run tasks (largest first) on executor, at most `workers` at a time, and
+    yield each task's results as it finishes. A task only starts while the
+    memory estimates of the running tasks plus its own fit in memory_budget,
+    so two giants never run together; smaller tasks fill the idle workers
+    meanwhile. A task that alone exceeds the budget runs on its own.
+
+    Once the executor breaks (a worker process died), the jobs of every task
+    it can no longer run are passed to failed(job, exc), whose results are
+    yielded instead. Without failed the BrokenExecutor is raised.
+    """
+
+    def broken(task, exc):
+        if failed is None:
+            raise exc
+        return [failed(job, exc) for job in task.jobs]
+
+    pending = list(tasks)
+    running = {}
+    in_use = 0
+    while pending or running:
+        while pending and len(running) < workers:
+            for position, task in enumerate(pending):
+                if not running or memory_budget is None or in_use + task.memory <= memory_budget:
+                    break
+            else:
+                break
+            del pending[position]
+            try:
+                future = executor.submit(run, task.jobs)
+            except BrokenExecutor as exc:
+                yield from broken(task, exc)
+                continue
+            running[future] = task
+            in_use += task.memory
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            task = running.pop(future)
+            in_use -= task.memory
+            try:
+                results = future.result()
+            except BrokenExecutor as exc:
+                results = broken(task, exc)
+            yield from results
+
+
+def _default_memory_budget() -> Optional[int]:
+    # half of physical memory, where the platform says how much that is
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // 2
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def convert_many(
+    jobs,
+    workers: Optional[int] = None,
+    cache=None,
+    collect_stats=False,
+    element_cache_bytes: int = 0,
+    hash_input: bool = False,
+    memory_budget: Optional[int] = None,
+    with_elements: bool = False,
+    keep_html: bool = False,
+    trace_memory: bool = False,
+    document_memory: Optional[int] = None,
+    minify: bool = False,
+    gzip_sidecar: bool = False,
+    max_chunk_jobs: Optional[int] = None,
+):
+    """
+    Convert (input_path, output_path) pairs, yielding a ConversionResult for
+    each as soon as it finishes. A failing document never stops the run.
+    workers=1 converts in this process, in order. Otherwise a process pool
+    runs the jobs largest first, in chunks planned by plan_tasks, keeping the
+    estimated memory of concurrent conversions within memory_budget. Results
+    come back a chunk at a time; max_chunk_jobs=1 returns every document's
+    result as soon as it is converted. If a worker process dies, the jobs
+    the pool could no longer run come back as failed.
+    """
+    convert = functools.partial(
+        convert_file,
+        cache=cache,
+        collect_stats=collect_stats,
+        element_cache_bytes=element_cache_bytes,
+        hash_input=hash_input,
+        keep_html=keep_html,
+        trace_memory=trace_memory,
+        document_memory=document_memory,
+        minify=minify,
+        gzip_sidecar=gzip_sidecar,
+    )
+    if workers == 1:
+        for input_path, output_path in jobs:
+            yield convert(input_path, output_path)
+        return
+
+    workers = workers or os.cpu_count() or 1
+    tasks = plan_tasks(jobs, workers, with_elements, max_chunk_jobs)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from run_scheduled(
+            executor,
+            tasks,
+            workers,
+            functools.partial(_convert_chunk, convert),
+            memory_budget,
+            _failed_result,
+        )
+
+
+# sinks write through buffers this large, so a run makes few, big writes
+SINK_BUFFER_BYTES = 1 << 20
+
+
+class OutputSink(abc.ABC):
+    """
+    Collects a batch run's documents into one file instead of one file per
+    document. The file is written under a temporary name and only moved into
+    place by close(), so readers never see a half-written archive.
+    Subclasses write one document in _add.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.count = 0
+        self._tmp_path = f"{path}.{os.getpid()}.tmp"
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = open(self._tmp_path, "wb", buffering=SINK_BUFFER_BYTES)
+
+    def add(self, result: ConversionResult):
+        self._add(result)
+        self.count += 1
+
+    @abc.abstractmethod
+    def _add(self, result: ConversionResult):
+        pass
+
+    def _finish(self):
+        pass
+
+    def close(self):
+        if self._file is None:
+            return
+        try:
+            self._finish()
+        finally:
+            self._file.close()
+            self._file = None
+        os.replace(self._tmp_path, self.path)
+
+
+class TarSink(OutputSink):
+    """
+    A tar archive with one member per document, gzipped for .tar.gz / .tgz.
+    """
+
+    def __init__(self, path: str, compress: bool = False):
+        super().__init__(path)
+        self._tar = tarfile.open(fileobj=self._file, mode="w:gz" if compress else "w")
+
+    def _add(self, result: ConversionResult):
+        data = result.html.encode("utf-8")
+        info = tarfile.TarInfo(result.output_path)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        self._tar.addfile(info, io.BytesIO(data))
+
+    def _finish(self):
+        self._tar.close()
+
+
+class ZipSink(OutputSink):
+    """
+    A deflated zip archive with one member per document.
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self._zip = zipfile.ZipFile(self._file, "w", zipfile.ZIP_DEFLATED)
+
+    def _add(self, result: ConversionResult):
+        self._zip.writestr(result.output_path, result.html)
+
+    def _finish(self):
+        self._zip.close()
+
+
+class JsonLinesSink(OutputSink):
+    """
+    One JSON record per line: documentId, revisionId, html and the path the
+    document would have been written to. Gzipped for .gz.
+    """
+
+    def __init__(self, path: str, compress: bool = False):
+        super().__init__(path)
+        self._stream = self._file
+        if compress:
+            self._stream = io.BufferedWriter(
+                gzip.GzipFile(fileobj=self._file, mode="wb", mtime=0), SINK_BUFFER_BYTES
+            )
+
+    def _add(self, result: ConversionResult):
+        record = {
+            "documentId": result.document_id,
+            "revisionId": result.revision_id,
+            "path": result.output_path,
+            "html": result.html,
+        }
+        self._stream.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+
+    def _finish(self):
+        if self._stream is not self._file:
+            self._stream.close()
+
+
+def open_sink(path: str) -> OutputSink:
+    """
+    Open the sink for path by its extension: .tar, .tar.gz, .tgz, .zip,
+    .jsonl or .ndjson, the last two optionally followed by .gz.
+    """
+    name = path.lower()
+    if name.endswith(".tar"):
+        return TarSink(path)
+    if name.endswith((".tar.gz", ".tgz")):
+        return TarSink(path, compress=True)
+    if name.endswith(".zip"):
+        return ZipSink(path)
+    if name.endswith((".jsonl", ".ndjson")):
+        return JsonLinesSink(path)
+    if name.endswith((".jsonl.gz", ".ndjson.gz")):
+        return JsonLinesSink(path, compress=True)
+    raise ValueError(f"Unsupported archive type: {path}")
+
+
+def archive_name(relative_path: str, suffix: str) -> str:
+    # archive members always use forward slashes
+    return os.path.splitext(relative_path)[0].replace(os.sep, "/") + suffix
+
+
+def report(result: ConversionResult, stream=None):
+    stream = stream or sys.stdout
+    if result.ok:
+        print(
+            f"{'cached' if result.cached else 'ok':<8}"
+            f"{result.input_path} -> {result.output_path} "
+            f"({result.seconds:.3f}s)",
+            file=stream,
+        )
+    else:
+        print(f"FAILED  {result.input_path}: {result.error}", file=stream)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Convert Google Docs JSON exports to HTML in parallel."
+    )
+    parser.add_argument(
+        "inputs", nargs="+", help="export files, directories or glob patterns"
+    )
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        help="mirror the input layout under this directory "
+        "(default: write next to each input)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="number of worker processes (default: CPU count)",
+    )
+    parser.add_argument("--suffix", default=".html", help="output file suffix")
+    parser.add_argument(
+        "--minify",
+        action="store_true",
+        help="write HTML without newlines between tags or redundant <p> and "
+        "inline tags",
+    )
+    parser.add_argument(
+        "--gzip-sidecars",
+        action="store_true",
+        help="also write a gzipped copy of every output next to it (.gz), for "
+        "web servers that serve precompressed files",
+    )
+    parser.add_argument(
+        "--count-elements",
+        action="store_true",
+        help="scan each input for its paragraph count to estimate conversion "
+        "cost better than by size alone",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=_default_memory_budget(),
+        help="bytes of estimated memory the concurrent conversions may use, so "
+        "large exports don't run together (default: half of physical memory; "
+        "0 disables)",
+    )
+    parser.add_argument(
+        "--archive",
+        help="write every document into this one file instead of one file each: "
+        "a .tar, .tar.gz, .tgz or .zip archive, or a .jsonl / .ndjson stream of "
+        "{documentId, revisionId, path, html} records, optionally .gz",
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="measure every document's peak and retained memory with tracemalloc "
+        "(slows conversion down); reported in the summary and with --stats",
+    )
+    parser.add_argument(
+        "--max-document-memory",
+        type=int,
+        help="bytes one document may allocate: a document over it is retried with "
+        "the streaming parser, then failed; implies --trace-memory",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="reuse conversions of unchanged documents from this directory",
+    )
+    parser.add_argument(
+        "--cache-max-bytes",
+        type=int,
+        default=1 << 30,
+        help="evict least recently used cache entries beyond this size",
+    )
+    parser.add_argument(
+        "--element-cache-bytes",
+        type=int,
+        default=64 << 20,
+        help="per-worker memory for rendered tables reused across documents "
+        "(0 disables)",
+    )
+    parser.add_argument(
+        "--manifest",
+        help="log every conversion to this JSON-lines file, and skip inputs it "
+        "records as done when the run is repeated",
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=2,
+        help="with --manifest, stop retrying an unchanged input after this many "
+        "failed reruns",
+    )
+    parser.add_argument(
+        "--stats",
+        help="append a JSON record of per-stage timings and counters "
+        "for every document to this file",
+    )
+    parser.add_argument(
+        "-q", "--quiet", action="store_true", help="only report failures"
+    )
+    return parser
+
+
+def _resume(jobs, manifest: Manifest, max_retries: int):
+    # split jobs into (still to do, with their input stats), done and given up
+    pending = []
+    input_stats = {}
+    done = 0
+    gave_up = []
+    for input_path, output_path in jobs:
+        try:
+            st = os.stat(input_path)
+        except OSError:
+            st = None
+        if st is not None:
+            if manifest.is_done(input_path, output_path, st):
+                done += 1
+                continue
+            if manifest.gave_up(input_path, st, max_retries):
+                gave_up.append(input_path)
+                continue
+        input_stats[input_path] = st
+        pending.append((input_path, output_path))
+    return pending, input_stats, done, gave_up
+
+
+def main(argv=None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.archive and (args.manifest or args.output_dir or args.gzip_sidecars):
+        parser.error(
+            "--archive can't be combined with --manifest, --output-dir or --gzip-sidecars"
+        )
+
+    if args.archive:
+        jobs = [(path, archive_name(rel, args.suffix)) for path, rel in find_inputs(args.inputs)]
+    else:
+        jobs = [
+            (path, output_path_for(path, rel, args.output_dir, args.suffix))
+            for path, rel in find_inputs(args.inputs)
+        ]
+    try:
+        # archive members are named by relative path, and collide the same way
+        check_outputs(jobs)
+        sink = open_sink(args.archive) if args.archive else None
+    except ValueError as exc:
+        parser.error(str(exc))
+
+    manifest = (
+        Manifest(args.manifest, args.minify, args.gzip_sidecars) if args.manifest else None
+    )
+    done = 0
+    gave_up = []
+    if manifest is not None:
+        jobs, input_stats, done, gave_up = _resume(jobs, manifest, args.max_retries)
+
+    cache = (
+        ConversionCache(args.cache_dir, args.cache_max_bytes, args.minify)
+        if args.cache_dir
+        else None
+    )
+
+    stats_file = open(args.stats, "a") if args.stats else None
+
+    converted = cached = failed = 0
+    element_hits = element_lookups = 0
+    largest = None
+    fallbacks = 0
+    start = time.perf_counter()
+    results = convert_many(
+        jobs,
+        workers=args.jobs,
+        cache=cache,
+        collect_stats=stats_file is not None,
+        element_cache_bytes=args.element_cache_bytes,
+        hash_input=manifest is not None,
+        memory_budget=args.memory_budget or None,
+        with_elements=args.count_elements,
+        keep_html=sink is not None,
+        trace_memory=args.trace_memory,
+        document_memory=args.max_document_memory,
+        minify=args.minify,
+        gzip_sidecar=args.gzip_sidecars,
+        # a manifest records each document as it finishes, which chunks would delay
+        max_chunk_jobs=1 if manifest is not None else None,
+    )
+    try:
+        for result in results:
+            if sink is not None and result.ok:
+                sink.add(result)
+                result.html = None
+            if manifest is not None:
+                manifest.append(
+                    manifest_record(result, input_stats[result.input_path], manifest.converter)
+                )
+            element_hits += result.element_hits
+            element_lookups += result.element_hits + result.element_misses
+            if result.peak_bytes is not None:
+                if largest is None or result.peak_bytes > largest.peak_bytes:
+                    largest = result
+                fallbacks += result.memory_fallback
+            if result.stats is not None:
+                stats_file.write(json.dumps(result.stats) + "\n")
+            if result.cached:
+                cached += 1
+            elif result.ok:
+                converted += 1
+            else:
+                failed += 1
+            if not (result.ok and args.quiet):
+                report(result)
+    finally:
+        # an interrupted run still leaves a valid archive of what finished
+        if sink is not None:
+            sink.close()
+        if manifest is not None:
+            manifest.close()
+        if stats_file is not None:
+            stats_file.close()
+
+    if cache is not None:
+        cache.evict()
+
+    for input_path in gave_up:
+        record = manifest.records[input_path]
+        print(
+            f"GAVE UP {input_path}: {record['error']} "
+            f"({manifest.failures[input_path]} attempts)"
+        )
+
+    resumed = f", {done} already done, {len(gave_up)} given up" if manifest else ""
+    print(
+        f"{converted} converted, {cached} cached, {failed} failed{resumed} "
+        f"in {time.perf_counter() - start:.2f}s",
+        file=sys.stderr,
+    )
+    if element_lookups:
+        print(
+            f"element cache: {element_hits} of {element_lookups} tables reused "
+            f"({element_hits / element_lookups:.0%})",
+            file=sys.stderr,
+        )
+    if largest is not None:
+        print(
+            f"memory: largest peak {largest.peak_bytes / (1 << 20):.1f} MiB "
+            f"({largest.input_path}), {fallbacks} streamed to stay within budget",
+            file=sys.stderr,
+        )
+    return 1 if failed or gave_up else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
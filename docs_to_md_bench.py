@@ -0,0 +1,353 @@
+import argparse
+import json
+import random
+import sys
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass
+
+from docs_to_md import decode_json, generate_html, json_backend, parse_content, parse_doc_body
+
+GLYPH_TYPES = ("DECIMAL", "ALPHA", "UPPER_ALPHA", "ROMAN", "UPPER_ROMAN", None)
+ALIGNMENTS = (None, "START", "CENTER", "END", "JUSTIFIED")
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+    "tempor incididunt ut labore et dolore magna aliqua"
+).split()
+
+
+def _text_styles(rng: random.Random, variety: int) -> list[dict]:
+    styles = [{}]
+    while len(styles) < max(variety, 1):
+        style = {}
+        for flag in ("bold", "italic", "underline", "strikethrough"):
+            if rng.random() < 0.3:
+                style[flag] = True
+        roll = rng.random()
+        if roll < 0.15:
+            style["link"] = {"url": f"https://example.com/{len(styles)}"}
+        elif roll < 0.25:
+            style["baselineOffset"] = rng.choice(["SUPERSCRIPT", "SUBSCRIPT"])
+        elif roll < 0.35:
+            style["backgroundColor"] = {
+                "color": {"rgbColor": {"red": rng.random(), "green": rng.random()}}
+            }
+        styles.append(style)
+    return styles
+
+
+class DocumentGenerator:
+    """
+    Deterministic generator of Google Docs JSON exports for benchmarks and
+    equivalence checks. Every knob maps to one dimension of real documents
+    that stresses a different part of the converter.
+    """
+
+    def __init__(
+        self,
+        paragraphs: int = 1000,
+        runs_per_paragraph: int = 4,
+        style_variety: int = 8,
+        list_ratio: float = 0.3,
+        list_depth: int = 3,
+        glyph_types=GLYPH_TYPES,
+        heading_ratio: float = 0.05,
+        tables: int = 2,
+        table_rows: int = 4,
+        table_cols: int = 3,
+        table_nesting: int = 1,
+        span_ratio: float = 0.1,
+        seed: int = 0,
+    ):
+        self.paragraphs = paragraphs
+        self.runs_per_paragraph = runs_per_paragraph
+        self.list_ratio = list_ratio
+        self.list_depth = max(list_depth, 1)
+        self.heading_ratio = heading_ratio
+        self.tables = tables
+        self.table_rows = table_rows
+        self.table_cols = table_cols
+        self.table_nesting = table_nesting
+        self.span_ratio = span_ratio
+        self.seed = seed
+        self._rng = random.Random(seed)
+        self._styles = _text_styles(self._rng, style_variety)
+        self._glyph_types = tuple(glyph_types)
+        self._lists = {}
+        for list_number in range(4):
+            levels = []
+            for _ in range(self.list_depth):
+                glyph_type = self._rng.choice(self._glyph_types)
+                levels.append({"glyphType": glyph_type} if glyph_type else {})
+            self._lists[f"kix.list{list_number}"] = {
+                "listProperties": {"nestingLevels": levels}
+            }
+        self._list_id = None
+        self._nesting_level = 0
+
+    def _runs(self) -> list[dict]:
+        rng = self._rng
+        runs = []
+        for _ in range(self.runs_per_paragraph):
+            words = rng.choices(WORDS, k=rng.randint(1, 6))
+            runs.append(
+                {
+                    "textRun": {
+                        "content": " ".join(words) + " ",
+                        "textStyle": dict(rng.choice(self._styles)),
+                    }
+                }
+            )
+        runs.append({"textRun": {"content": "\n", "textStyle": {}}})
+        return runs
+
+    def paragraph(self, allow_lists: bool = True) -> dict:
+        rng = self._rng
+        paragraph = {"paragraphStyle": {"namedStyleType": "NORMAL_TEXT"}}
+        roll = rng.random()
+        if allow_lists and roll < self.list_ratio:
+            if self._list_id is None or rng.random() < 0.1:
+                self._list_id = rng.choice(sorted(self._lists))
+                self._nesting_level = 0
+            else:
+                step = rng.choice([-1, 0, 0, 1])
+                self._nesting_level = min(
+                    max(self._nesting_level + step, 0), self.list_depth - 1
+                )
+            paragraph["bullet"] = {"listId": self._list_id}
+            if self._nesting_level:
+                paragraph["bullet"]["nestingLevel"] = self._nesting_level
+        else:
+            self._list_id = None
+            if roll < self.list_ratio + self.heading_ratio:
+                level = rng.randint(1, 6)
+                paragraph["paragraphStyle"]["namedStyleType"] = f"HEADING_{level}"
+            else:
+                alignment = rng.choice(ALIGNMENTS)
+                if alignment:
+                    paragraph["paragraphStyle"]["alignment"] = alignment
+        if rng.random() < 0.02:
+            # blank paragraphs are dropped by the converter
+            paragraph["elements"] = [{"textRun": {"content": "\n", "textStyle": {}}}]
+        else:
+            paragraph["elements"] = self._runs()
+        return {"paragraph": paragraph}
+
+    def table(self, depth: int = 0) -> dict:
+        rng = self._rng
+        rows = []
+        for _ in range(self.table_rows):
+            cells = []
+            for _ in range(self.table_cols):
+                content = [self.paragraph() for _ in range(rng.randint(1, 3))]
+                if depth < self.table_nesting and rng.random() < 0.25:
+                    content.insert(rng.randint(0, len(content)), self.table(depth + 1))
+                cell = {"content": content}
+                if rng.random() < self.span_ratio:
+                    cell["tableCellStyle"] = {
+                        "rowSpan": rng.randint(1, 2),
+                        "colSpan": rng.randint(1, 2),
+                    }
+                cells.append(cell)
+            rows.append({"tableCells": cells})
+        self._list_id = None
+        return {"table": {"rows": self.table_rows, "tableRows": rows}}
+
+    def document(self) -> dict:
+        rng = self._rng
+        slots = range(self.paragraphs + 1)
+        table_at = set(rng.sample(slots, min(self.tables, len(slots))))
+        content = [{"sectionBreak": {"sectionStyle": {}}}]
+        for index in range(self.paragraphs + 1):
+            if index in table_at:
+                content.append(self.table())
+            if index < self.paragraphs:
+                content.append(self.paragraph())
+        return {
+            "title": f"synthetic-{self.seed}",
+            "body": {"content": content},
+            "lists": self._lists,
+            "revisionId": f"rev-{self.seed}",
+            "documentId": f"doc-{self.seed}",
+        }
+
+
+def generate_document(seed: int = 0, **options) -> dict:
+    return DocumentGenerator(seed=seed, **options).document()
+
+
+SCENARIOS = {
+    "paragraphs": dict(paragraphs=5000, list_ratio=0.0, tables=0),
+    "run_heavy": dict(paragraphs=1000, runs_per_paragraph=40, style_variety=3, tables=0),
+    "style_variety": dict(paragraphs=2000, style_variety=200, tables=0),
+    "lists": dict(paragraphs=5000, list_ratio=0.9, list_depth=6, tables=0),
+    "tables": dict(paragraphs=200, tables=40, table_rows=10, table_cols=6, table_nesting=0),
+    "nested_tables": dict(paragraphs=100, tables=10, table_rows=3, table_cols=2, table_nesting=4),
+    "mixed": dict(paragraphs=3000, tables=20),
+}
+
+
+@dataclass
+class BenchResult:
+    name: str
+    input_bytes: int
+    decode_seconds: float
+    parse_seconds: float
+    render_seconds: float
+    peak_bytes: int
+    # parse_doc_body's single pass, what the CLI, batch runner and server use
+    body_seconds: float = 0.0
+
+    @property
+    def seconds(self) -> float:
+        return self.decode_seconds + self.parse_seconds + self.render_seconds
+
+    @property
+    def docs_per_second(self) -> float:
+        return 1 / self.seconds if self.seconds else float("inf")
+
+    @property
+    def mb_per_second(self) -> float:
+        return self.input_bytes / 1e6 * self.docs_per_second
+
+
+def run_benchmark(name: str, document: dict, repeat: int = 5) -> BenchResult:
+    """
+    Time decode (with decode_json, so whichever JSON backend is installed),
+    parse_content and generate_html separately, and parse_doc_body on the
+    decoded document, keeping the best of `repeat` runs, then measure peak
+    traced memory in one extra run.
+    """
+    payload = json.dumps(document).encode()
+    best = [float("inf")] * 4
+    for _ in range(repeat):
+        start = time.perf_counter()
+        data = decode_json(payload)
+        decoded = time.perf_counter()
+        nodes = parse_content(data["body"])
+        parsed = time.perf_counter()
+        generate_html(nodes, data["lists"])
+        rendered = time.perf_counter()
+        del nodes
+        parse_doc_body(data)
+        walked = time.perf_counter()
+        for stage, seconds in enumerate(
+            (decoded - start, parsed - decoded, rendered - parsed, walked - rendered)
+        ):
+            best[stage] = min(best[stage], seconds)
+        del data
+
+    tracemalloc.start()
+    try:
+        data = decode_json(payload)
+        generate_html(parse_content(data["body"]), data["lists"])
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return BenchResult(
+        name=name,
+        input_bytes=len(payload),
+        decode_seconds=best[0],
+        parse_seconds=best[1],
+        render_seconds=best[2],
+        peak_bytes=peak,
+        body_seconds=best[3],
+    )
+
+
+def compare_to_baseline(
+    results, baseline: dict, tolerance: float, min_seconds: float = 0.002
+) -> list[str]:
+    """
+    Return one message per metric that regressed past baseline * (1 + tolerance).
+    Timing differences under min_seconds are treated as noise, and metrics
+    the baseline predates are skipped.
+    """
+    regressions = []
+    for result in results:
+        reference = baseline.get(result.name)
+        if reference is None:
+            continue
+        for metric in ("parse_seconds", "render_seconds", "body_seconds", "peak_bytes"):
+            if metric not in reference:
+                continue
+            limit = reference[metric] * (1 + tolerance)
+            value = getattr(result, metric)
+            if metric.endswith("seconds") and value - reference[metric] < min_seconds:
+                continue
+            if value > limit:
+                regressions.append(
+                    f"{result.name}.{metric}: {value:.6g} > {reference[metric]:.6g} "
+                    f"(+{value / reference[metric] - 1:.0%})"
+                )
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Benchmark docs_to_md on synthetic Google Docs exports.",
+        epilog="Timings only compare on the same machine and Python. Before changing the "
+        "converter, record a baseline from the unchanged tree with --save-baseline "
+        "bench_baseline.json, then check the change with --baseline bench_baseline.json, "
+        "using the same --repeat (15 keeps a busy machine under the default tolerance). "
+        "The committed bench_baseline.json is the latest accepted tree on the reference "
+        "machine; re-record it, in the same commit, when a change is meant to move it.",
+    )
+    parser.add_argument(
+        "scenarios", nargs="*", default=sorted(SCENARIOS), help="scenarios to run"
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="multiply paragraph counts"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", help="fail if slower than this baseline file")
+    parser.add_argument(
+        "--save-baseline", help="write the results to this file as the new baseline"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="allowed relative slowdown against the baseline",
+    )
+    args = parser.parse_args(argv)
+
+    results = []
+    print(f"JSON backend: {json_backend()}")
+    print(
+        f"{'scenario':<16}{'MB':>8}{'docs/s':>10}{'MB/s':>9}"
+        f"{'decode':>10}{'parse':>10}{'render':>10}{'body':>10}{'peak MB':>10}"
+    )
+    for name in args.scenarios:
+        options = dict(SCENARIOS[name])
+        options["paragraphs"] = int(options["paragraphs"] * args.scale)
+        result = run_benchmark(
+            name, generate_document(seed=args.seed, **options), args.repeat
+        )
+        results.append(result)
+        print(
+            f"{name:<16}{result.input_bytes / 1e6:>8.2f}"
+            f"{result.docs_per_second:>10.2f}{result.mb_per_second:>9.2f}"
+            f"{result.decode_seconds:>10.4f}{result.parse_seconds:>10.4f}"
+            f"{result.render_seconds:>10.4f}{result.body_seconds:>10.4f}"
+            f"{result.peak_bytes / 1e6:>10.2f}"
+        )
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as file:
+            json.dump({result.name: asdict(result) for result in results}, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare_to_baseline(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,382 @@
+import argparse
+import copy
+import functools
+import glob
+import io
+import json
+import os
+import random
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+import docs_to_md_reference
+from docs_to_md import (
+    ElementCache,
+    IncrementalRenderer,
+    generate_html,
+    parse_content,
+    parse_doc_body,
+    parse_doc_body_formats,
+    parse_doc_body_parallel,
+    parse_doc_buffer,
+    parse_doc_stream,
+)
+from docs_to_md_bench import GLYPH_TYPES, generate_document
+
+
+class _UnseekableStream(io.RawIOBase):
+    def __init__(self, data: bytes):
+        self._data = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        return self._data.readinto(buffer)
+
+
+def _lists_last(data) -> bytes:
+    # the order of an export whose "lists" only arrive after "body"
+    reordered = {key: value for key, value in data.items() if key != "lists"}
+    reordered["lists"] = data["lists"]
+    return json.dumps(reordered).encode()
+
+
+def _with_toggled_glyphs(data) -> dict:
+    # the same document after every list level switched between ul and ol
+    lists = copy.deepcopy(data["lists"])
+    for list_entry in lists.values():
+        for level in list_entry.get("listProperties", {}).get("nestingLevels", []):
+            if level.pop("glyphType", None) is None:
+                level["glyphType"] = "DECIMAL"
+    return {**data, "lists": lists}
+
+
+def _incremental(data, revisions) -> str:
+    renderer = IncrementalRenderer()
+    for revision in revisions:
+        renderer.render(revision)
+    return renderer.render(data)
+
+
+def make_engines(executor=None) -> dict:
+    """
+    Every way docs_to_md renders a document, by name, each a function of the
+    decoded export that should return exactly what the frozen reference
+    renderer does. The cached engines share one ElementCache across
+    documents, made on first use, so later documents are rendered from
+    tables cached by earlier ones. parse_doc_body_parallel splits even small
+    documents, on executor (the caller's, or a thread pool of the harness).
+    """
+    element_cache = functools.cache(ElementCache)
+    return {
+        "parse_doc_body": parse_doc_body,
+        "tree": lambda data: generate_html(parse_content(data["body"]), data["lists"]),
+        "stream": lambda data: parse_doc_stream(
+            io.BytesIO(json.dumps(data).encode()), chunk_size=257
+        ),
+        "stream_lists_last": lambda data: parse_doc_stream(
+            io.BytesIO(_lists_last(data)), chunk_size=257
+        ),
+        "stream_unseekable": lambda data: parse_doc_stream(
+            _UnseekableStream(_lists_last(data)), chunk_size=257
+        ),
+        "stream_cached": lambda data: parse_doc_stream(
+            io.BytesIO(json.dumps(data).encode()), cache=element_cache()
+        ),
+        "element_cache": lambda data: parse_doc_body(data, element_cache()),
+        "incremental": lambda data: _incremental(data, [_with_toggled_glyphs(data)]),
+        "incremental_reuse": lambda data: _incremental(data, [data]),
+        "parallel": lambda data: parse_doc_body_parallel(
+            data, workers=4, min_chunk_elements=1, executor=executor
+        ),
+        "formats": lambda data: parse_doc_body_formats(data)["html"],
+        "buffer": lambda data: parse_doc_buffer(json.dumps(data).encode()),
+    }
+
+
+ENGINES = tuple(make_engines())
+
+
+@dataclass
+class Divergence:
+    engine: str
+    document: str
+    # offset of the first differing byte in the UTF-8 reference output
+    offset: Optional[int] = None
+    location: Optional[str] = None
+    expected: Optional[str] = None
+    actual: Optional[str] = None
+    error: Optional[str] = None
+
+    def __str__(self) -> str:
+        if self.error is not None:
+            return f"{self.document} [{self.engine}]: raised {self.error}"
+        return (
+            f"{self.document} [{self.engine}]: first difference at byte {self.offset}, "
+            f"in {self.location}\n"
+            f"  expected {self.expected!r}\n"
+            f"  actual   {self.actual!r}"
+        )
+
+
+def first_difference(expected, actual) -> Optional[int]:
+    """
+    Index of the first position where two str or bytes values differ (the
+    length of the shorter one if it is a prefix of the other), or None if
+    they are equal. Binary search over slice comparisons, which run in C.
+    """
+    if expected == actual:
+        return None
+    low, high = 0, min(len(expected), len(actual))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if expected[:middle] == actual[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _describe_element(element) -> str:
+    if "paragraph" in element:
+        paragraph = element["paragraph"]
+        text = "".join(
+            run.get("textRun", {}).get("content", "") for run in paragraph.get("elements", [])
+        )
+        description = f"paragraph {text.strip()[:40]!r}"
+        bullet = paragraph.get("bullet")
+        if bullet:
+            description += (
+                f", list {bullet.get('listId')} level {bullet.get('nestingLevel', 0)}"
+            )
+        return description
+    for kind in element:
+        if kind not in ("startIndex", "endIndex"):
+            return kind
+    return "element"
+
+
+def _table_path(lines) -> str:
+    # the row and cell of every table open after these lines, innermost last
+    tables = []
+    for line in lines:
+        if line == "<table>":
+            tables.append([0, 0])
+        elif line == "</table>":
+            tables.pop()
+        elif tables and line == "<tr>":
+            tables[-1] = [tables[-1][0] + 1, 0]
+        elif tables and line.startswith(("<td", "<th")) and line.endswith(">"):
+            tables[-1][1] += 1
+    return " > ".join(f"row {row}, cell {cell}" for row, cell in tables)
+
+
+_LIST_CLOSES = re.compile(r"(?:</[ou]l>\n?)+")
+_TRAILING_LIST_CLOSES = re.compile(r"(?:\n</[ou]l>)+\Z")
+
+
+def _reach(data, count: int, expected: str) -> int:
+    # where the first count body.content elements stop rendering expected,
+    # at the separator before the next element; the list tags closed after
+    # them belong to the element that closes them
+    content = data["body"]["content"][:count]
+    prefix = docs_to_md_reference.render({**data, "body": {**data["body"], "content": content}})
+    prefix = _TRAILING_LIST_CLOSES.sub("", prefix)
+    offset = first_difference(expected, prefix)
+    if offset is None:
+        return len(expected)
+    return max(expected.rfind("\n", 0, offset + 1), 0)
+
+
+def locate(data, offset: int) -> str:
+    """
+    Describe the structural element that rendered the reference output at
+    character offset: its body.content index and kind and, inside a table,
+    the row and cell (counting rendered cells) of every enclosing table.
+    The element is found by a binary search over how far renderings of
+    ever longer prefixes of body.content agree with the whole document.
+    """
+    expected = docs_to_md_reference.render(data)
+    if offset >= len(expected):
+        return "the end of the document"
+    line_start = expected.rfind("\n", 0, offset + 1) + 1
+    if _LIST_CLOSES.fullmatch(expected, line_start):
+        return "the list tags closed at the end of the document"
+
+    elements = data["body"]["content"]
+    # the last element whose rendering starts at or before offset
+    low, high = 0, len(elements) - 1
+    while low < high:
+        middle = (low + high + 1) // 2
+        if _reach(data, middle, expected) <= offset:
+            low = middle
+        else:
+            high = middle - 1
+    location = f"body.content[{low}] ({_describe_element(elements[low])})"
+    # the separator before a line belongs to it
+    line_end = expected.find("\n", offset + 1)
+    rendered = expected[_reach(data, low, expected) : line_end if line_end != -1 else None]
+    path = _table_path(rendered.split("\n"))
+    return f"{location} at {path}" if path else location
+
+
+def compare(engine: str, name: str, data, expected: str, actual: str) -> Optional[Divergence]:
+    """
+    A Divergence locating the first byte where actual differs from expected,
+    both renderings of data, or None if they are equal.
+    """
+    expected_bytes = expected.encode("utf-8")
+    offset = first_difference(expected_bytes, actual.encode("utf-8"))
+    if offset is None:
+        return None
+    # the character that contains the first differing byte
+    char = len(expected_bytes[:offset].decode("utf-8", "ignore"))
+    return Divergence(
+        engine,
+        name,
+        offset=offset,
+        location=locate(data, char),
+        expected=expected[max(char - 20, 0) : char + 40],
+        actual=actual[max(char - 20, 0) : char + 40],
+    )
+
+
+def check_document(name: str, data, engines: dict, golden: Optional[str] = None):
+    """
+    Render data with the frozen reference renderer and with each engine,
+    returning a Divergence for every engine whose output differs or that
+    raises. A golden output, if given, is checked against the reference,
+    reported as engine "golden".
+    """
+    reference = docs_to_md_reference.render(data)
+    comparisons = []
+    divergences = []
+    if golden is not None:
+        comparisons.append(("golden", golden, reference))
+    for engine, render in engines.items():
+        try:
+            comparisons.append((engine, reference, render(data)))
+        except Exception as exc:
+            divergences.append(Divergence(engine, name, error=f"{type(exc).__name__}: {exc}"))
+    for engine, expected, actual in comparisons:
+        divergence = compare(engine, name, data, expected, actual)
+        if divergence is not None:
+            divergences.append(divergence)
+    return divergences
+
+
+def random_documents(count: int, seed: int = 0):
+    """
+    Yield (name, document) for count generated exports whose knobs are
+    themselves drawn at random per seed: list density, depth and glyph
+    types, headings, run and style variety, table shapes, row/col spans and
+    table nesting.
+    """
+    for document_seed in range(seed, seed + count):
+        rng = random.Random(document_seed)
+        options = dict(
+            paragraphs=rng.randint(0, 150),
+            runs_per_paragraph=rng.randint(1, 6),
+            style_variety=rng.randint(1, 30),
+            list_ratio=rng.random() * 0.9,
+            list_depth=rng.randint(1, 6),
+            glyph_types=rng.sample(GLYPH_TYPES, rng.randint(1, len(GLYPH_TYPES))),
+            heading_ratio=rng.random() * 0.2,
+            tables=rng.randint(0, 6),
+            table_rows=rng.randint(1, 5),
+            table_cols=rng.randint(1, 4),
+            table_nesting=rng.randint(0, 3),
+            span_ratio=rng.random() * 0.5,
+        )
+        yield f"random-{document_seed}", generate_document(seed=document_seed, **options)
+
+
+def golden_path(path: str) -> str:
+    return os.path.splitext(path)[0] + ".html"
+
+
+def corpus_documents(paths):
+    """
+    Yield (path, document, golden HTML or None) for every .json export in
+    paths (files or directories, searched recursively). The golden HTML is
+    the .html file next to an export, when there is one.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(glob.glob(os.path.join(path, "**", "*.json"), recursive=True))
+        else:
+            files = [path]
+        for file_path in files:
+            with open(file_path, encoding="utf-8") as file:
+                data = json.load(file)
+            golden = None
+            if os.path.exists(golden_path(file_path)):
+                with open(golden_path(file_path), encoding="utf-8") as file:
+                    golden = file.read()
+            yield file_path, data, golden
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Check that every render path of docs_to_md produces exactly what "
+        "the frozen reference renderer does, over a golden corpus and generated documents."
+    )
+    parser.add_argument(
+        "corpus", nargs="*", help="export files or directories; a .html next to an "
+        "export is its golden output"
+    )
+    parser.add_argument(
+        "--random", type=int, default=50, help="generated documents to check as well"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--engines",
+        nargs="+",
+        choices=ENGINES,
+        default=list(ENGINES),
+        help="engines to compare (default: all)",
+    )
+    parser.add_argument(
+        "--write-golden",
+        action="store_true",
+        help="write the reference renderer's output next to every corpus export "
+        "that has no golden file yet",
+    )
+    args = parser.parse_args(argv)
+
+    documents = checked = 0
+    divergences = []
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        engines = {
+            name: engine
+            for name, engine in make_engines(executor).items()
+            if name in args.engines
+        }
+        generated = (
+            (name, data, None) for name, data in random_documents(args.random, args.seed)
+        )
+        for source in (corpus_documents(args.corpus), generated):
+            for name, data, golden in source:
+                if golden is None and args.write_golden and name.endswith(".json"):
+                    with open(golden_path(name), "w", encoding="utf-8") as file:
+                        file.write(docs_to_md_reference.render(data))
+                found = check_document(name, data, engines, golden)
+                for divergence in found:
+                    print(divergence)
+                divergences.extend(found)
+                documents += 1
+                checked += len(engines) + (golden is not None)
+
+    print(
+        f"{documents} documents, {checked} comparisons, {len(divergences)} divergent",
+        file=sys.stderr,
+    )
+    return 1 if divergences else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
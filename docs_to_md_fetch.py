@@ -0,0 +1,214 @@
+import argparse
+import asyncio
+import http.client
+import os
+import queue
+import sys
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+from docs_to_md import parse_doc_buffer
+
+# statuses worth retrying: rate limiting and transient server trouble
+RETRY_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+
+
+class FetchError(Exception):
+    pass
+
+
+@dataclass
+class FetchResult:
+    document_id: str
+    html: Optional[str] = None
+    error: Optional[str] = None
+
+
+class DocsSource:
+    """
+    Fetches document JSON from a Docs-API-compatible endpoint,
+    GET {base_url}/documents/{document_id}, over a pool of keep-alive
+    connections. At most `concurrency` requests are in flight, and failed
+    requests are retried with exponential backoff.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        concurrency: int = 8,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: float = 30.0,
+        headers: Optional[dict] = None,
+    ):
+        url = urllib.parse.urlsplit(base_url)
+        if url.scheme not in ("http", "https"):
+            raise ValueError(f"Unsupported URL scheme: {base_url}")
+        self._connection_class = (
+            http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+        )
+        self._netloc = url.netloc
+        self._path = url.path.rstrip("/")
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.headers = {"Accept": "application/json", **(headers or {})}
+        self._connections = queue.LifoQueue()
+        self._slots = None
+
+    def _request(self, path: str) -> tuple[int, bytes]:
+        # runs in a worker thread; reuses an idle connection when there is one
+        try:
+            connection = self._connections.get_nowait()
+        except queue.Empty:
+            connection = self._connection_class(self._netloc, timeout=self.timeout)
+        try:
+            connection.request("GET", path, headers=self.headers)
+            response = connection.getresponse()
+            body = response.read()
+        except BaseException:
+            connection.close()
+            raise
+        self._connections.put(connection)
+        return response.status, body
+
+    async def fetch(self, document_id: str) -> bytes:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+        path = f"{self._path}/documents/{urllib.parse.quote(document_id, safe='')}"
+
+        for attempt in range(self.retries + 1):
+            async with self._slots:
+                try:
+                    status, body = await asyncio.to_thread(self._request, path)
+                except (OSError, http.client.HTTPException) as exc:
+                    problem = f"{type(exc).__name__}: {exc}"
+                else:
+                    if status == 200:
+                        return body
+                    problem = f"HTTP {status}"
+                    if status not in RETRY_STATUSES:
+                        break
+            if attempt < self.retries:
+                await asyncio.sleep(self.backoff * 2**attempt)
+        raise FetchError(f"{document_id}: {problem}")
+
+    def close(self):
+        while True:
+            try:
+                self._connections.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def convert_payload(payload: bytes) -> str:
+    return parse_doc_buffer(payload)
+
+
+async def convert_documents(document_ids, source: DocsSource, executor=None, max_pending=None):
+    """
+    Fetch and convert documents, yielding a FetchResult for each as soon as
+    it is ready. Fetching overlaps with conversion, which runs in `executor`
+    (a process pool is best, as conversion is CPU bound). At most
+    `max_pending` documents are held in memory at once.
+    """
+    loop = asyncio.get_running_loop()
+    document_ids = iter(document_ids)
+    results = asyncio.Queue()
+
+    async def worker():
+        for document_id in document_ids:
+            try:
+                payload = await source.fetch(document_id)
+                html = await loop.run_in_executor(executor, convert_payload, payload)
+            except Exception as exc:
+                error = str(exc) if isinstance(exc, FetchError) else f"{type(exc).__name__}: {exc}"
+                await results.put(FetchResult(document_id, error=error))
+            else:
+                await results.put(FetchResult(document_id, html=html))
+        await results.put(None)
+
+    workers = [
+        asyncio.create_task(worker())
+        for _ in range(max_pending or source.concurrency * 2)
+    ]
+    running = len(workers)
+    try:
+        while running:
+            result = await results.get()
+            if result is None:
+                running -= 1
+            else:
+                yield result
+    finally:
+        for task in workers:
+            task.cancel()
+
+
+def _document_id(value: str) -> str:
+    # the id names the output file, so it must not reach outside the output directory
+    if value in ("", ".", "..") or any(sep in value for sep in (os.sep, os.altsep) if sep):
+        raise argparse.ArgumentTypeError(f"not a document id: {value!r}")
+    return value
+
+
+def _header(value: str) -> tuple[str, str]:
+    name, colon, header_value = value.partition(":")
+    if not colon or not name.strip():
+        raise argparse.ArgumentTypeError(f'expected "Name: value", got {value!r}')
+    return name.strip(), header_value.strip()
+
+
+async def _run(args) -> int:
+    source = DocsSource(
+        args.base_url,
+        concurrency=args.concurrency,
+        retries=args.retries,
+        headers=dict(args.header),
+    )
+    os.makedirs(args.output_dir, exist_ok=True)
+    failed = 0
+    try:
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            async for result in convert_documents(args.document_ids, source, executor):
+                if result.error:
+                    failed += 1
+                    print(f"FAILED  {result.document_id}: {result.error}")
+                    continue
+                output_path = os.path.join(args.output_dir, f"{result.document_id}.html")
+                with open(output_path, "w", encoding="utf-8") as file:
+                    file.write(result.html)
+                print(f"ok      {result.document_id} -> {output_path}")
+    finally:
+        source.close()
+    return 1 if failed else 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Fetch documents from a Docs-API-compatible endpoint and convert them."
+    )
+    parser.add_argument("document_ids", nargs="+", type=_document_id)
+    parser.add_argument(
+        "--base-url", required=True, help="e.g. https://docs.googleapis.com/v1"
+    )
+    parser.add_argument("-o", "--output-dir", default=".")
+    parser.add_argument(
+        "--header",
+        action="append",
+        type=_header,
+        default=[],
+        help='extra request header, e.g. "Authorization: Bearer TOKEN"',
+    )
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight")
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count())
+    args = parser.parse_args(argv)
+    return asyncio.run(_run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
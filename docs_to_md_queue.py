@@ -0,0 +1,489 @@
+import argparse
+import contextlib
+import functools
+import multiprocessing
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Optional
+
+from docs_to_md_batch import (
+    ConversionCache,
+    check_outputs,
+    convert_file,
+    estimate_cost,
+    find_inputs,
+    output_path_for,
+    publish_output,
+    report,
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    input TEXT NOT NULL UNIQUE,
+    output TEXT NOT NULL,
+    cost INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'pending',
+    token TEXT,
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    seconds REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_claimable ON jobs (status, cost DESC);
+"""
+
+
+@dataclass
+class Lease:
+    id: int
+    input_path: str
+    output_path: str
+    # changes with every claim, so a worker whose lease expired can't complete
+    token: str
+
+
+class WorkQueue:
+    """
+    A queue of (input_path, output_path) conversions in a sqlite file on
+    storage every node can reach, for running one conversion over several
+    hosts. Workers claim jobs under a lease that they renew with heartbeats;
+    a job whose lease expires (its worker died or hung) is claimed again by
+    the next worker, up to max_attempts times. A job is completed only by
+    the holder of its current lease, in the same transaction that moves its
+    output into place, so each document is converted into its output once.
+
+    Paths are stored as given, so every node must see them the same way.
+    Leases are compared against each node's clock, which must roughly agree;
+    keep lease_seconds well above the skew. The file must be on storage
+    with working POSIX locks, as sqlite's locking relies on them.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        lease_seconds: float = 60.0,
+        max_attempts: int = 3,
+        timeout: float = 60.0,
+    ):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._db = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self._db.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # IMMEDIATE takes the write lock up front, so two workers can never
+        # both see a job as claimable
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            yield self._db
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+
+    def close(self):
+        self._db.close()
+
+    def enqueue(self, jobs, with_elements: bool = False) -> int:
+        """
+        Add (input_path, output_path) jobs, skipping inputs already queued.
+        Returns the number added. Larger inputs are claimed first.
+        """
+        rows = [
+            (input_path, output_path, estimate_cost(input_path, with_elements))
+            for input_path, output_path in jobs
+        ]
+        with self._transaction() as db:
+            return db.executemany(
+                "INSERT OR IGNORE INTO jobs (input, output, cost) VALUES (?, ?, ?)", rows
+            ).rowcount
+
+    def claim(self, worker: str, count: int = 1) -> list[Lease]:
+        """
+        Lease up to count jobs to worker, largest first: pending jobs, and
+        jobs whose lease has expired. Jobs that used up max_attempts leases
+        without finishing are failed instead.
+        """
+        now = time.time()
+        leases = []
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE jobs SET status = 'failed', token = NULL, "
+                "error = 'lease expired ' || attempts || ' times' "
+                "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, self.max_attempts),
+            )
+            rows = db.execute(
+                "SELECT id, input, output FROM jobs "
+                "WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?) "
+                "ORDER BY cost DESC, id LIMIT ?",
+                (now, count),
+            ).fetchall()
+            for job_id, input_path, output_path in rows:
+                token = uuid.uuid4().hex
+                db.execute(
+                    "UPDATE jobs SET status = 'leased', token = ?, worker = ?, "
+                    "lease_expires = ?, attempts = attempts + 1 WHERE id = ?",
+                    (token, worker, now + self.lease_seconds, job_id),
+                )
+                leases.append(Lease(job_id, input_path, output_path, token))
+        return leases
+
+    def heartbeat(self, tokens) -> set:
+        """
+        Extend the leases with these tokens. Returns the tokens still held;
+        the others expired and were claimed by another worker.
+        """
+        expires = time.time() + self.lease_seconds
+        held = set()
+        with self._transaction() as db:
+            for token in tokens:
+                cursor = db.execute(
+                    "UPDATE jobs SET lease_expires = ? WHERE token = ? AND status = 'leased'",
+                    (expires, token),
+                )
+                if cursor.rowcount:
+                    held.add(token)
+        return held
+
+    def complete(
+        self,
+        lease: Lease,
+        ok: bool,
+        error: Optional[str] = None,
+        seconds: Optional[float] = None,
+        publish=None,
+    ) -> bool:
+        """
+        Record the outcome of a leased job, calling publish() (which moves
+        the output into place) while still holding the queue's write lock.
+        Returns False, without calling publish, if the lease was lost: the
+        job is someone else's now and this result must be discarded.
+        """
+        with self._transaction() as db:
+            cursor = db.execute(
+                "UPDATE jobs SET status = ?, error = ?, seconds = ?, finished = ?, token = NULL "
+                "WHERE id = ? AND token = ? AND status = 'leased'",
+                ("done" if ok else "failed", error, seconds, time.time(), lease.id, lease.token),
+            )
+            if cursor.rowcount != 1:
+                return False
+            if ok and publish is not None:
+                try:
+                    publish()
+                except OSError as exc:
+                    db.execute(
+                        "UPDATE jobs SET status = 'failed', error = ? WHERE id = ?",
+                        (f"{type(exc).__name__}: {exc}", lease.id),
+                    )
+        return True
+
+    def counts(self) -> dict[str, int]:
+        rows = self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+        return {status: count for status, count in rows}
+
+    def unfinished(self) -> int:
+        return self._db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status IN ('pending', 'leased')"
+        ).fetchone()[0]
+
+    def failures(self) -> list[tuple[str, str, int]]:
+        return self._db.execute(
+            "SELECT input, error, attempts FROM jobs WHERE status = 'failed' ORDER BY id"
+        ).fetchall()
+
+
+class _Heartbeat:
+    # renews the leases a worker holds from a thread of its own
+    def __init__(self, queue_path: str, lease_seconds: float):
+        self._queue_path = queue_path
+        self._lease_seconds = lease_seconds
+        self._tokens = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def hold(self, tokens):
+        with self._lock:
+            self._tokens.update(tokens)
+
+    def release(self, token: str):
+        with self._lock:
+            self._tokens.discard(token)
+
+    def _run(self):
+        # sqlite connections can't be shared between threads
+        queue = None
+        try:
+            while not self._stop.wait(self._lease_seconds / 3):
+                with self._lock:
+                    tokens = set(self._tokens)
+                if not tokens:
+                    continue
+                # a beat that fails (the database stayed locked past the
+                # timeout, say) mustn't stop the next ones, or the leases
+                # would expire under conversions that are still running
+                try:
+                    if queue is None:
+                        queue = WorkQueue(self._queue_path, self._lease_seconds)
+                    queue.heartbeat(tokens)
+                except sqlite3.OperationalError as exc:
+                    print(f"heartbeat failed, retrying: {exc}", file=sys.stderr)
+        finally:
+            if queue is not None:
+                queue.close()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_worker(
+    queue_path: str,
+    worker: Optional[str] = None,
+    batch: int = 4,
+    lease_seconds: float = 60.0,
+    max_attempts: int = 3,
+    poll_seconds: float = 1.0,
+    wait: bool = True,
+    cache_dir: Optional[str] = None,
+    cache_max_bytes: int = 1 << 30,
+    element_cache_bytes: int = 64 << 20,
+    minify: bool = False,
+    gzip_sidecar: bool = False,
+    quiet: bool = False,
+) -> dict[str, int]:
+    """
+    Claim and convert jobs from the queue at queue_path until none are left.
+    With wait, a worker that finds nothing to claim while other workers
+    still hold leases keeps polling, to take over any that expire. Each job
+    is converted into a private file that complete() moves into place, with
+    its .gz sidecar if gzip_sidecar, only if the lease is still ours.
+    A ConversionCache in cache_dir is evicted down to cache_max_bytes when
+    the worker is done. Returns counts of this worker's outcomes.
+    """
+    worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+    queue = WorkQueue(queue_path, lease_seconds, max_attempts)
+    cache = ConversionCache(cache_dir, cache_max_bytes, minify) if cache_dir else None
+    heartbeat = _Heartbeat(queue_path, lease_seconds)
+    outcomes = {"converted": 0, "failed": 0, "lost": 0}
+    try:
+        while True:
+            leases = queue.claim(worker, batch)
+            if not leases:
+                if not wait or not queue.unfinished():
+                    break
+                time.sleep(poll_seconds)
+                continue
+            heartbeat.hold(lease.token for lease in leases)
+            for lease in leases:
+                part_path = f"{lease.output_path}.{lease.token}.part"
+                result = convert_file(
+                    lease.input_path,
+                    part_path,
+                    cache,
+                    element_cache_bytes=element_cache_bytes,
+                    minify=minify,
+                    gzip_sidecar=gzip_sidecar,
+                )
+                result.output_path = lease.output_path
+                publish = functools.partial(
+                    publish_output, part_path, lease.output_path, gzip_sidecar
+                )
+                if queue.complete(lease, result.ok, result.error, result.seconds, publish):
+                    outcomes["converted" if result.ok else "failed"] += 1
+                    if not (result.ok and quiet):
+                        report(result)
+                else:
+                    outcomes["lost"] += 1
+                for leftover in (part_path, part_path + ".gz"):
+                    if os.path.exists(leftover):
+                        os.remove(leftover)
+                heartbeat.release(lease.token)
+    finally:
+        heartbeat.stop()
+        queue.close()
+    if cache is not None:
+        cache.evict()
+    return outcomes
+
+
+def _enqueue(args) -> int:
+    jobs = [
+        (path, output_path_for(path, rel, args.output_dir, args.suffix))
+        for path, rel in find_inputs(args.inputs)
+    ]
+    try:
+        check_outputs(jobs)
+    except ValueError as exc:
+        print(exc, file=sys.stderr)
+        return 2
+    queue = WorkQueue(args.queue)
+    try:
+        added = queue.enqueue(jobs, args.count_elements)
+    finally:
+        queue.close()
+    print(f"{added} queued, {len(jobs) - added} already in the queue", file=sys.stderr)
+    return 0
+
+
+def _status(args) -> int:
+    queue = WorkQueue(args.queue)
+    try:
+        counts = queue.counts()
+        failures = queue.failures()
+    finally:
+        queue.close()
+    for input_path, error, attempts in failures:
+        print(f"FAILED  {input_path}: {error} ({attempts} attempts)")
+    print(
+        ", ".join(
+            f"{counts.get(status, 0)} {status}"
+            for status in ("pending", "leased", "done", "failed")
+        ),
+        file=sys.stderr,
+    )
+    return 1 if failures else 0
+
+
+def _work(args) -> int:
+    options = dict(
+        batch=args.batch,
+        lease_seconds=args.lease_seconds,
+        max_attempts=args.max_attempts,
+        wait=args.wait,
+        cache_dir=args.cache_dir,
+        cache_max_bytes=args.cache_max_bytes,
+        element_cache_bytes=args.element_cache_bytes,
+        minify=args.minify,
+        gzip_sidecar=args.gzip_sidecars,
+        quiet=args.quiet,
+    )
+    start = time.perf_counter()
+    crashed = []
+    if args.jobs == 1:
+        run_worker(args.queue, **options)
+    else:
+        processes = [
+            multiprocessing.Process(target=run_worker, args=(args.queue,), kwargs=options)
+            for _ in range(args.jobs)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        crashed = [process.exitcode for process in processes if process.exitcode != 0]
+    for exitcode in crashed:
+        print(f"a worker process crashed with exit code {exitcode}", file=sys.stderr)
+    print(f"worked for {time.perf_counter() - start:.2f}s", file=sys.stderr)
+    status = _status(args)
+    return 1 if crashed else status
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Convert exports on several hosts from one work queue on shared "
+        "storage: enqueue the inputs once, then run `work` on every host."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    enqueue = commands.add_parser("enqueue", help="add inputs to the queue")
+    enqueue.add_argument("queue", help="the queue's sqlite file")
+    enqueue.add_argument("inputs", nargs="+", help="export files, directories or glob patterns")
+    enqueue.add_argument(
+        "-o",
+        "--output-dir",
+        help="mirror the input layout under this directory "
+        "(default: write next to each input)",
+    )
+    enqueue.add_argument("--suffix", default=".html", help="output file suffix")
+    enqueue.add_argument(
+        "--count-elements",
+        action="store_true",
+        help="order the queue by paragraph counts as well as sizes",
+    )
+    enqueue.set_defaults(run=_enqueue)
+
+    work = commands.add_parser("work", help="convert queued inputs until none are left")
+    work.add_argument("queue", help="the queue's sqlite file")
+    work.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="worker processes on this host (default: CPU count)",
+    )
+    work.add_argument("--batch", type=int, default=4, help="jobs claimed at a time")
+    work.add_argument(
+        "--lease-seconds",
+        type=float,
+        default=60.0,
+        help="how long a claim lasts without a heartbeat before others take over",
+    )
+    work.add_argument(
+        "--max-attempts",
+        type=int,
+        default=3,
+        help="give up on a job whose lease expired this many times",
+    )
+    work.add_argument(
+        "--wait",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="keep polling while other workers hold leases, to take over any "
+        "that expire",
+    )
+    work.add_argument(
+        "--cache-dir",
+        help="reuse conversions of unchanged documents from this directory",
+    )
+    work.add_argument(
+        "--cache-max-bytes",
+        type=int,
+        default=1 << 30,
+        help="evict least recently used cache entries beyond this size when "
+        "the worker is done",
+    )
+    work.add_argument(
+        "--element-cache-bytes",
+        type=int,
+        default=64 << 20,
+        help="per-worker memory for rendered tables reused across documents "
+        "(0 disables)",
+    )
+    work.add_argument(
+        "--minify",
+        action="store_true",
+        help="write HTML without newlines between tags or redundant <p> and "
+        "inline tags",
+    )
+    work.add_argument(
+        "--gzip-sidecars",
+        action="store_true",
+        help="also write a gzipped copy of every output next to it (.gz)",
+    )
+    work.add_argument("-q", "--quiet", action="store_true", help="only report failures")
+    work.set_defaults(run=_work)
+
+    status = commands.add_parser("status", help="show the queue's progress and failures")
+    status.add_argument("queue", help="the queue's sqlite file")
+    status.set_defaults(run=_status)
+
+    args = parser.parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,254 @@
+import argparse
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+from docs_to_md import IncrementalRenderer, compile_style_key, decode_json, parse_doc_body
+
+
+class Overloaded(Exception):
+    pass
+
+
+class ConversionService:
+    """
+    The state a long-running converter keeps between requests: the style
+    cache (module level, so it simply stays warm), an IncrementalRenderer per
+    recently converted documentId so repeated saves of one document only
+    re-render what changed, a concurrency cap and latency statistics.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: Optional[int] = None,
+        queue_timeout: float = 5.0,
+        incremental_documents: int = 64,
+        latency_window: int = 1000,
+    ):
+        self.max_concurrency = max_concurrency or os.cpu_count() or 1
+        self.queue_timeout = queue_timeout
+        self.incremental_documents = incremental_documents
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self._lock = threading.Lock()
+        self._renderers = OrderedDict()
+        self._latencies = deque(maxlen=latency_window)
+        self._started = time.monotonic()
+        self.requests = 0
+        self.errors = 0
+        self.rejected = 0
+        self.in_flight = 0
+
+    def _renderer_for(self, document_id):
+        with self._lock:
+            entry = self._renderers.pop(document_id, None)
+            if entry is None:
+                entry = (IncrementalRenderer(), threading.Lock())
+            self._renderers[document_id] = entry
+            while len(self._renderers) > self.incremental_documents:
+                self._renderers.popitem(last=False)
+        return entry
+
+    def _render(self, data) -> str:
+        document_id = data.get("documentId")
+        if document_id is None or not self.incremental_documents:
+            return parse_doc_body(data)
+        renderer, lock = self._renderer_for(document_id)
+        with lock:
+            return renderer.render(data)
+
+    def convert(self, payload: bytes) -> str:
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            with self._lock:
+                self.rejected += 1
+            raise Overloaded(f"more than {self.max_concurrency} conversions running")
+
+        start = time.perf_counter()
+        with self._lock:
+            self.in_flight += 1
+        try:
+            return self._render(decode_json(payload))
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.requests += 1
+                self._latencies.append(time.perf_counter() - start)
+            self._slots.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            latencies = sorted(self._latencies)
+            stats = {
+                "uptime_seconds": round(time.monotonic() - self._started, 3),
+                "requests": self.requests,
+                "errors": self.errors,
+                "rejected": self.rejected,
+                "in_flight": self.in_flight,
+                "max_concurrency": self.max_concurrency,
+                "cached_documents": len(self._renderers),
+            }
+        if latencies:
+            stats["latency_ms"] = {
+                "mean": round(sum(latencies) / len(latencies) * 1000, 3),
+                **{
+                    f"p{percentile}": round(
+                        latencies[min(len(latencies) * percentile // 100, len(latencies) - 1)]
+                        * 1000,
+                        3,
+                    )
+                    for percentile in (50, 95, 99)
+                },
+            }
+        cache_info = compile_style_key.cache_info()
+        stats["style_cache"] = {
+            "hits": cache_info.hits,
+            "misses": cache_info.misses,
+            "size": cache_info.currsize,
+        }
+        return stats
+
+
+class ConversionRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, body: str, content_type: str = "text/plain"):
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_json(self, status: int, value):
+        self._send(status, json.dumps(value), "application/json")
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        elif self.path == "/stats":
+            self._send_json(200, service.stats())
+        else:
+            self._send_json(404, {"error": f"no such endpoint: {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/convert":
+            self._send_json(404, {"error": f"no such endpoint: {self.path}"})
+            return
+        length = self.headers.get("Content-Length")
+        if length is None:
+            # without a length there is no telling where the body ends
+            self.close_connection = True
+            self._send_json(411, {"error": "Content-Length required"})
+            return
+        try:
+            length = int(length)
+            if length < 0:
+                raise ValueError
+        except ValueError:
+            self.close_connection = True
+            self._send_json(400, {"error": f"invalid Content-Length: {length!r}"})
+            return
+        payload = self.rfile.read(length)
+        try:
+            html = self.server.service.convert(payload)
+        except Overloaded as exc:
+            self._send_json(503, {"error": str(exc)})
+        except json.JSONDecodeError as exc:
+            self._send_json(400, {"error": f"invalid JSON: {exc}"})
+        except Exception as exc:
+            self._send_json(422, {"error": f"{type(exc).__name__}: {exc}"})
+        else:
+            self._send(200, html, "text/html")
+
+
+class ConversionHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service: ConversionService):
+        super().__init__(address, ConversionRequestHandler)
+        self.service = service
+
+
+class _UnixRequestHandler(ConversionRequestHandler):
+    def address_string(self):
+        return "unix"
+
+
+class ConversionUnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, service: ConversionService):
+        super().__init__(path, _UnixRequestHandler)
+        self.service = service
+
+
+def make_server(
+    service: ConversionService,
+    host: str = "127.0.0.1",
+    port: int = 8750,
+    unix_socket: Optional[str] = None,
+):
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        return ConversionUnixServer(unix_socket, service)
+    return ConversionHTTPServer((host, port), service)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Serve docs_to_md conversions: POST document JSON to /convert, "
+        "GET /health and /stats."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8750)
+    parser.add_argument("--unix-socket", help="listen on this Unix socket instead")
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        help="conversions running at once (default: CPU count)",
+    )
+    parser.add_argument(
+        "--queue-timeout",
+        type=float,
+        default=5.0,
+        help="seconds a request waits for a free slot before a 503",
+    )
+    parser.add_argument(
+        "--incremental-documents",
+        type=int,
+        default=64,
+        help="documents to keep incremental render state for (0 disables)",
+    )
+    args = parser.parse_args(argv)
+
+    service = ConversionService(
+        max_concurrency=args.max_concurrency,
+        queue_timeout=args.queue_timeout,
+        incremental_documents=args.incremental_documents,
+    )
+    server = make_server(service, args.host, args.port, args.unix_socket)
+    print(f"docs_to_md serving on {args.unix_socket or f'{args.host}:{args.port}'}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
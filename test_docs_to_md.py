@@ -1,11 +1,47 @@
+import io
+import json
+import sys
+
 import pytest
 
+import docs_to_md
+
 from docs_to_md import (
+    ElementCache,
+    FragmentWriter,
+    IncrementalRenderer,
+    JsonLinesCollector,
+    JsonStreamReader,
+    ListIndex,
+    MemoryBudgetExceeded,
     ParagraphNode,
+    TableCellNode,
+    TableNode,
+    TableRowNode,
     apply_inline_text_styles,
+    apply_markdown_text_styles,
+    compile_style_key,
+    compile_text_style,
+    decode_json,
+    element_fingerprint,
     generate_html,
+    instrumented,
+    load_document,
+    parse_content,
+    parse_doc_body,
+    parse_doc_body_formats,
+    parse_doc_body_parallel,
+    parse_doc_stream,
     parse_paragraph,
+    read_document_ids,
+    register_collector,
+    render_file,
+    render_to,
+    split_content,
+    track_memory,
+    unregister_collector,
 )
+from docs_to_md_bench import generate_document
 
 
 @pytest.fixture
@@ -95,6 +131,48 @@ class TestApplyInlineTextStyles:
     def test_text_links(self, text_str, text_styles, expected):
         assert apply_inline_text_styles(text_str, text_styles) == expected
 
+    def test_all_styles_nest_in_order(self, text_str):
+        text_styles = {
+            "link": {"url": "https://hello-world.com"},
+            "baselineOffset": "SUPERSCRIPT",
+            "backgroundColor": {"color": {"rgbColor": {"blue": 0.5}}},
+            "underline": True,
+            "bold": True,
+            "italic": True,
+            "strikethrough": True,
+        }
+        assert apply_inline_text_styles(text_str, text_styles) == (
+            '<s><i><b><ins><mark style="background-color: rgb(0% 0% 50%)"><sup>'
+            '<a href="https://hello-world.com">Hello world</a>'
+            "</sup></mark></ins></b></i></s>"
+        )
+
+    def test_compiled_styles_are_cached(self, text_str):
+        compile_style_key.cache_clear()
+        compile_text_style.cache_clear()
+        link = {"url": "https://hello-world.com"}
+        for _ in range(3):
+            apply_inline_text_styles(text_str, {"bold": True, "link": link, "fontSize": {}})
+            apply_inline_text_styles(text_str, {"bold": True, "link": link})
+        info = compile_style_key.cache_info()
+        assert (info.misses, info.hits) == (1, 5)
+        # flag-only styles never reach the cache
+        assert apply_inline_text_styles(text_str, {"bold": True, "italic": False}) == (
+            "<b>Hello world</b>"
+        )
+        assert compile_style_key.cache_info().misses == 1
+
+    def test_signatures_are_derived_per_key(self, text_str):
+        compile_text_style.cache_clear()
+        for red in (0.501, 0.502):
+            style = {"backgroundColor": {"color": {"rgbColor": {"red": red}}}}
+            assert apply_inline_text_styles(text_str, style) == (
+                '<mark style="background-color: rgb(50% 0% 0%)">Hello world</mark>'
+            )
+        # two keys, one rendering
+        info = compile_text_style.cache_info()
+        assert (info.misses, info.hits) == (1, 1)
+
 
 class TestParseParagraph:
     @pytest.fixture
@@ -149,6 +227,42 @@ class TestParseParagraph:
             text="", is_list_item=False, list_id=None, nesting_level=0
         )
 
+    def test_nodes_have_no_instance_dict(self, paragraph_element):
+        assert not hasattr(parse_paragraph(paragraph_element), "__dict__")
+        assert not hasattr(TableNode(rows=[]), "__dict__")
+
+    def test_runs_with_equal_styles_are_merged(self):
+        elem = {
+            "paragraphStyle": {"namedStyleType": "NORMAL_TEXT"},
+            "elements": [
+                {"textRun": {"content": "Hel", "textStyle": {"bold": True}}},
+                {"textRun": {"content": "lo", "textStyle": {"bold": True}}},
+                {"textRun": {"content": " ", "textStyle": {}}},
+                {"textRun": {"content": "World", "textStyle": {"bold": True}}},
+                {"textRun": {"content": ".\n", "textStyle": {"bold": True}}},
+            ],
+        }
+
+        assert parse_paragraph(elem).text == "<p><b>Hello</b> <b>World.</b></p>"
+
+    def test_runs_that_render_the_same_are_merged(self):
+        def mark(red):
+            return {"color": {"rgbColor": {"red": red}}}
+
+        elem = {
+            "paragraphStyle": {"namedStyleType": "NORMAL_TEXT"},
+            "elements": [
+                {"textRun": {"content": "Hel", "textStyle": {"bold": True, "fontSize": 11}}},
+                {"textRun": {"content": "lo", "textStyle": {"bold": True, "italic": False}}},
+                {"textRun": {"content": " ", "textStyle": {"backgroundColor": mark(0.501)}}},
+                {"textRun": {"content": "W\n", "textStyle": {"backgroundColor": mark(0.509)}}},
+            ],
+        }
+
+        assert parse_paragraph(elem).text == (
+            '<p><b>Hello</b><mark style="background-color: rgb(50% 0% 0%)"> W</mark></p>'
+        )
+
     def test_parse_headings(self):
         elem = {
             "paragraphStyle": {"namedStyleType": "HEADING_1"},
@@ -237,6 +351,49 @@ class TestParseParagraph:
         )
 
 
+class TestNestedTables:
+    def nest(self, depth):
+        element = {
+            "paragraph": {
+                "paragraphStyle": {"namedStyleType": "NORMAL_TEXT"},
+                "elements": [{"textRun": {"content": "deep\n", "textStyle": {}}}],
+            }
+        }
+        for _ in range(depth):
+            element = {"table": {"tableRows": [{"tableCells": [{"content": [element]}]}]}}
+        return element
+
+    def test_deep_nesting_needs_no_recursion(self):
+        depth = sys.getrecursionlimit() * 2
+        html = parse_doc_body({"body": {"content": [self.nest(depth)]}, "lists": {}})
+        assert html.count("<table>") == depth
+        assert html.count("<th>") == depth
+        assert "<p>deep</p>" in html
+
+    def test_single_pass_matches_node_tree(self, document):
+        table = document["body"]["content"][6]
+        cell = table["table"]["tableRows"][1]["tableCells"][2]
+        cell["content"].insert(1, self.nest(3))
+        assert parse_doc_body(document) == generate_html(
+            parse_content(document["body"]), document["lists"]
+        )
+
+
+class TestListIndex:
+    def test_resolves_tags_per_level(self, document):
+        index = ListIndex(document["lists"])
+        assert sorted(index.ids) == [("1", 0), ("1", 1), ("2", 0), ("2", 1)]
+        level_id = index.ids[("2", 1)]
+        assert index.open_tags[level_id] == '<ol style="list-style-type: lower-alpha;">'
+        assert index.close_tags[level_id] == "</ol>"
+        assert index.open_tags[index.ids[("1", 0)]] == "<ul>"
+
+    def test_render_accepts_prebuilt_index(self, document):
+        nodes = parse_content(document["body"])
+        index = ListIndex(document["lists"])
+        assert generate_html(nodes, index) == generate_html(nodes, document["lists"])
+
+
 class TestBuildHTML:
     @pytest.fixture
     def lists(self):
@@ -426,3 +583,492 @@ class TestBuildHTML:
 </li>
 </ol>"""
         )
+
+
+class NonSeekableStream(io.RawIOBase):
+    def __init__(self, payload):
+        self._inner = io.BytesIO(payload)
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        return self._inner.read(size)
+
+
+class TestParseDocStream:
+    @pytest.mark.parametrize("chunk_size", [1, 7, 1 << 16])
+    def test_matches_parse_doc_body(self, document, chunk_size):
+        stream = io.StringIO(json.dumps(document, indent=2))
+        assert parse_doc_stream(stream, chunk_size) == parse_doc_body(document)
+
+    @pytest.mark.parametrize("chunk_size", [3, 1 << 16])
+    def test_lists_after_body_in_byte_stream(self, document, chunk_size):
+        reordered = {"body": document["body"], "lists": document["lists"]}
+        stream = io.BytesIO(json.dumps(reordered, ensure_ascii=False).encode())
+        assert parse_doc_stream(stream, chunk_size) == parse_doc_body(document)
+
+    def test_lists_after_body_in_non_seekable_stream(self, document):
+        reordered = {"body": document["body"], "lists": document["lists"]}
+        stream = NonSeekableStream(json.dumps(reordered).encode())
+        assert parse_doc_stream(stream, 5) == parse_doc_body(document)
+
+    def test_reader_skips_nested_values(self):
+        reader = JsonStreamReader(
+            io.StringIO('{"a": {"b": ["}", "\\"", [1]]}, "c": 12345}'), chunk_size=2
+        )
+        seen = {}
+        for key in reader.iter_keys():
+            if key == "c":
+                seen[key] = reader.read_value()
+            else:
+                reader.skip_value()
+        assert seen == {"c": 12345}
+
+    def test_document_ids_are_read_from_the_tail(self, document):
+        class CountingStream(io.BytesIO):
+            consumed = 0
+
+            def read(self, size=-1):
+                data = super().read(size)
+                self.consumed += len(data)
+                return data
+
+        body = {"content": document["body"]["content"] * 50}
+        exported = {"body": body, "lists": {}, "revisionId": "r1", "documentId": "d1"}
+        stream = CountingStream(json.dumps(exported).encode())
+        assert read_document_ids(stream, tail_bytes=256) == ("d1", "r1")
+        assert stream.consumed <= 256
+
+        # ids ahead of the body, or lookalikes quoted in text or nested in
+        # another object, send the reader through the whole export
+        run = {"content": '"revisionId": "r2", "documentId": "d2"}', "textStyle": {}}
+        decoy = {"content": [{"paragraph": {"elements": [{"textRun": run}]}}]}
+        cases = [
+            ({"revisionId": "r1", "documentId": "d1", "body": body}, ("d1", "r1")),
+            ({"documentId": "d1", "revisionId": "r1", "body": decoy}, ("d1", "r1")),
+            ({"body": body, "inlineObjects": {"revisionId": "r2", "documentId": "d2"}},
+             (None, None)),
+        ]
+        for exported, ids in cases:
+            assert read_document_ids(io.BytesIO(json.dumps(exported).encode())) == ids
+            assert read_document_ids(io.StringIO(json.dumps(exported))) == ids
+
+    def test_reader_rejects_truncated_input(self):
+        with pytest.raises(json.JSONDecodeError):
+            parse_doc_stream(io.StringIO('{"body": {"content": [{"paragraph": '))
+
+
+class TestRenderTo:
+    def test_writes_same_html_as_generate_html(self, document):
+        nodes = parse_content(document["body"])
+        sink = io.StringIO()
+        render_to(nodes, document["lists"], sink)
+        assert sink.getvalue() == generate_html(nodes, document["lists"])
+
+    def test_streams_fragments_to_callable(self, document):
+        chunks = []
+        render_to(parse_content(document["body"]), document["lists"], chunks.append)
+        assert "".join(chunks) == parse_doc_body(document)
+        # nothing larger than a single fragment is ever handed to the sink
+        assert max(len(chunk) for chunk in chunks) < 50
+
+    def test_empty_cell_keeps_blank_line(self):
+        table = TableNode(rows=[TableRowNode(cells=[TableCellNode(nodes=[])])])
+        assert generate_html([table], {}) == "<table>\n<tr>\n<th>\n\n</th>\n</tr>\n</table>"
+
+    def test_fragment_writer_separator(self):
+        sink = io.StringIO()
+        out = FragmentWriter(sink, separator="|")
+        for text in ["a", "", "b"]:
+            out.fragment(text)
+        assert sink.getvalue() == "a||b"
+        assert out.count == 3
+
+    def test_parse_doc_stream_into_writer(self, document):
+        sink = io.StringIO()
+        stream = io.StringIO(json.dumps(document))
+        assert parse_doc_stream(stream, writer=sink) is None
+        assert sink.getvalue() == parse_doc_body(document)
+
+
+class TestIncrementalRenderer:
+    def test_unchanged_document_is_fully_reused(self, document):
+        renderer = IncrementalRenderer()
+        assert renderer.render(document) == parse_doc_body(document)
+        rendered = renderer.rendered
+        assert renderer.render(document) == parse_doc_body(document)
+        assert renderer.rendered == rendered
+
+    def test_only_edited_element_is_rendered(self, document):
+        renderer = IncrementalRenderer()
+        renderer.render(document)
+        before = renderer.rendered
+
+        content = document["body"]["content"]
+        content[-1]["paragraph"]["elements"][0]["textRun"]["content"] = "Edited\n"
+        assert renderer.render(document) == parse_doc_body(document)
+        assert renderer.rendered - before == 1
+
+    def test_list_boundary_change_rerenders_neighbour(self, document):
+        renderer = IncrementalRenderer()
+        renderer.render(document)
+        before = renderer.rendered
+
+        # "two" leaves the list, so the blank paragraph after it and "three"
+        # now start with no list open
+        del document["body"]["content"][3]["paragraph"]["bullet"]
+        assert renderer.render(document) == parse_doc_body(document)
+        assert renderer.rendered - before == 3
+
+    def test_list_definition_change_rerenders_users(self, document):
+        renderer = IncrementalRenderer()
+        renderer.render(document)
+        before = renderer.rendered
+
+        document["lists"]["1"]["listProperties"]["nestingLevels"][0] = {
+            "glyphType": "ROMAN"
+        }
+        assert renderer.render(document) == parse_doc_body(document)
+        # the "three" bullet and the table holding the "x" bullet
+        assert renderer.rendered - before == 2
+
+
+class TestInstrumentation:
+    def test_counts_document_structure(self, document):
+        with instrumented("doc-1") as stats:
+            parse_doc_stream(io.StringIO(json.dumps(document)))
+
+        record = stats.to_record()
+        assert record["document"] == "doc-1"
+        assert (record["paragraphs"], record["runs"]) == (12, 12)
+        assert (record["list_items"], record["tables"], record["cells"]) == (4, 1, 5)
+        assert record["max_table_depth"] == 1
+        # tables are parsed while they are rendered, so there is no parse_table
+        assert set(record["stage_seconds"]) == {
+            "decode",
+            "parse_paragraph",
+            "list_html",
+            "table_html",
+            "render",
+            "total",
+        }
+
+    def test_node_tree_stages(self, document):
+        with instrumented() as stats:
+            generate_html(parse_content(document["body"]), document["lists"])
+        assert {"parse_table", "table_html"} <= set(stats.stage_seconds)
+        assert (stats.tables, stats.cells, stats.max_table_depth) == (1, 5, 1)
+
+    def test_nested_table_depth(self, document):
+        table = document["body"]["content"][6]
+        cell = table["table"]["tableRows"][0]["tableCells"][0]
+        cell["content"].append(json.loads(json.dumps(table)))
+        with instrumented() as stats:
+            parse_doc_body(document)
+        assert (stats.tables, stats.max_table_depth) == (2, 2)
+
+    def test_failed_tables_leave_depth_balanced(self, document):
+        del document["body"]["content"][6]["table"]["tableRows"][1]["tableCells"][1]["content"]
+        with instrumented() as stats:
+            for render in (
+                lambda: parse_content(document["body"]),
+                lambda: parse_doc_body(document),
+            ):
+                with pytest.raises(KeyError):
+                    render()
+                assert stats.table_depth == 0
+
+    def test_records_go_to_registered_collectors(self, document):
+        sink = io.StringIO()
+        collector = JsonLinesCollector(sink)
+        register_collector(collector)
+        try:
+            with instrumented("a"):
+                parse_doc_body(document)
+        finally:
+            unregister_collector(collector)
+        with instrumented("b"):
+            parse_doc_body(document)
+
+        records = [json.loads(line) for line in sink.getvalue().splitlines()]
+        assert [record["document"] for record in records] == ["a"]
+
+    def test_nothing_is_recorded_when_disabled(self, document):
+        with instrumented() as stats:
+            pass
+        parse_doc_body(document)
+        assert stats.paragraphs == 0
+
+
+class TestParallelRendering:
+    def test_chunks_only_start_where_lists_are_closed(self):
+        document = generate_document(paragraphs=300, list_ratio=0.6, tables=5)
+        runs = split_content(document["body"]["content"], 10)
+        assert len(runs) > 2
+        assert sum(map(len, runs)) == len(document["body"]["content"])
+        for run in runs[1:]:
+            first = run[0]
+            assert "table" in first or "bullet" not in first["paragraph"]
+
+    @pytest.mark.parametrize("seed", [0, 1])
+    def test_matches_serial_output(self, seed):
+        document = generate_document(
+            seed=seed, paragraphs=400, list_ratio=0.5, tables=6, table_nesting=2
+        )
+        html = parse_doc_body_parallel(document, workers=2, min_chunk_elements=20)
+        assert html == parse_doc_body(document)
+
+    def test_small_documents_stay_serial(self, document):
+        assert parse_doc_body_parallel(document, workers=4) == parse_doc_body(document)
+
+
+class TestMultipleFormats:
+    def test_renders_every_format(self, document):
+        output = parse_doc_body_formats(document)
+        assert output["html"] == parse_doc_body(document)
+        assert output["markdown"] == (
+            "**Intro \u00e9\u4e2d**\n\n"
+            "1. one\n"
+            "    1. two\n"
+            "- three\n\n"
+            "| head | wide |  |\n"
+            "| --- | --- | --- |\n"
+            "| a |  | - x<br>y 1.5e3 |\n\n"
+            "Outro"
+        )
+        assert output["text"] == (
+            "Intro \u00e9\u4e2d\none\ntwo\nthree\nhead\twide\na\tx y 1.5e3\nOutro"
+        )
+
+    def test_paragraphs_are_parsed_once(self, document):
+        with instrumented() as single:
+            parse_doc_body(document)
+        with instrumented() as multiple:
+            parse_doc_body_formats(document)
+        assert multiple.paragraphs == single.paragraphs
+
+    def test_selected_formats_only(self, document):
+        assert list(parse_doc_body_formats(document, ["text"])) == ["text"]
+        with pytest.raises(ValueError, match="pdf"):
+            parse_doc_body_formats(document, ["html", "pdf"])
+
+    def test_markdown_styles(self):
+        assert apply_markdown_text_styles(" a*b \n", {"bold": True}) == " **a\\*b** "
+        assert (
+            apply_markdown_text_styles("x", {"italic": True, "link": {"url": "https://e.com"}})
+            == "_[x](https://e.com)_"
+        )
+        assert apply_markdown_text_styles("under", {"underline": True}) == "under"
+
+    def test_markdown_escapes_block_syntax(self, document):
+        outro = document["body"]["content"][-1]["paragraph"]["elements"][0]["textRun"]
+        outro["content"] = "# note\n- item\n  > quote\n+ more\n1. first\n2) second\n1.5e3\n"
+        markdown = parse_doc_body_formats(document, ["markdown"])["markdown"]
+        assert markdown.endswith(
+            "\n\n\\# note\n\\- item\n  \\> quote\n\\+ more\n1\\. first\n2\\) second\n1.5e3"
+        )
+
+
+class TestDecodeJson:
+    @pytest.fixture(params=["orjson", "simdjson", "json"])
+    def backend(self, request, monkeypatch):
+        # run each case with every installed backend, and the stdlib alone
+        if request.param == "json":
+            monkeypatch.setattr(docs_to_md, "orjson", None)
+            monkeypatch.setattr(docs_to_md, "simdjson", None)
+        else:
+            pytest.importorskip(request.param)
+            if request.param == "simdjson":
+                monkeypatch.setattr(docs_to_md, "orjson", None)
+        return request.param
+
+    def test_accepts_buffers_without_copying(self, backend, document):
+        payload = json.dumps(document, ensure_ascii=False).encode()
+        assert docs_to_md.json_backend() == backend
+        for value in (payload, bytearray(payload), memoryview(payload), payload.decode()):
+            assert decode_json(value) == document
+        assert decode_json(b"\xef\xbb\xbf" + payload) == document
+
+    def test_load_document_maps_file(self, backend, document, tmp_path):
+        path = tmp_path / "doc.json"
+        path.write_text(json.dumps(document, indent=2), encoding="utf-8")
+        assert load_document(path) == document
+
+        for payload in ("", '{"body": '):
+            path.write_text(payload)
+            with pytest.raises(json.JSONDecodeError):
+                load_document(path)
+
+    @pytest.mark.parametrize("stream", [True, False])
+    def test_render_file(self, document, tmp_path, stream):
+        path = tmp_path / "doc.json"
+        path.write_text(json.dumps(document))
+        sink = io.StringIO()
+        with instrumented() as stats:
+            render_file(path, sink, stream=stream)
+        assert sink.getvalue() == parse_doc_body(document)
+        assert {"decode", "render"} <= set(stats.stage_seconds)
+
+
+class TestElementCache:
+    def test_repeated_tables_render_once(self, document):
+        cache = ElementCache()
+        expected = parse_doc_body(document)
+        assert parse_doc_body(document, cache) == expected
+        assert parse_doc_body(document, cache) == expected
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_stream_keys_on_exported_text(self, document):
+        cache = ElementCache()
+        for indent in (None, None, 2):
+            stream = io.StringIO(json.dumps(document, indent=indent))
+            assert parse_doc_stream(stream, chunk_size=16, cache=cache) == parse_doc_body(
+                document
+            )
+        # differently formatted exports of one table are different entries
+        assert (cache.hits, cache.misses) == (1, 2)
+
+    @pytest.mark.parametrize("seed", [0, 1, 2])
+    def test_output_is_unchanged(self, seed):
+        cache = ElementCache()
+        for offset in range(3):
+            document = generate_document(
+                seed=seed + offset, paragraphs=60, list_ratio=0.5, tables=4, table_nesting=2
+            )
+            expected = parse_doc_body(document)
+            assert parse_doc_body(document, cache) == expected
+            stream = io.StringIO(json.dumps(document))
+            assert parse_doc_stream(stream, cache=cache) == expected
+
+    def test_key_covers_referenced_lists(self, document):
+        table = document["body"]["content"][6]
+        before = element_fingerprint(table, document["lists"])
+        document["lists"]["2"]["listProperties"]["nestingLevels"][0] = {}
+        assert element_fingerprint(table, document["lists"]) == before
+        document["lists"]["1"]["listProperties"]["nestingLevels"][0] = {"glyphType": "ROMAN"}
+        assert element_fingerprint(table, document["lists"]) != before
+
+    def test_evicts_least_recently_used(self):
+        # each entry is 10 bytes: key plus HTML
+        cache = ElementCache(max_bytes=25)
+        cache.put("a", "x" * 9)
+        cache.put("b", "x" * 9)
+        assert cache.get("a") is not None
+        cache.put("c", "x" * 9)
+        assert (cache.get("a"), cache.get("b")) == ("x" * 9, None)
+        assert cache.info()["bytes"] == 20 and cache.evictions == 1
+        cache.put("huge", "x" * 100)
+        assert cache.get("huge") is None
+
+
+class TestMemoryBudget:
+    @pytest.fixture
+    def export(self, tmp_path):
+        path = tmp_path / "large.json"
+        document = generate_document(paragraphs=300, tables=2)
+        path.write_text(json.dumps(document))
+        return str(path), parse_doc_body(document)
+
+    def peak(self, path, stream):
+        with track_memory() as usage:
+            render_file(path, io.StringIO(), stream=stream)
+        return usage.peak_bytes
+
+    def test_reports_peak_and_retained(self, export):
+        path, expected = export
+        with track_memory() as usage:
+            data = load_document(path)
+            html = generate_html(parse_content(data["body"]), data["lists"])
+        assert usage.peak_bytes > len(html) > 0
+        assert 0 <= usage.retained_bytes < usage.peak_bytes
+        assert usage.budget is None and not usage.fallback
+
+    def test_over_budget_documents_are_streamed(self, export):
+        path, expected = export
+        streamed, decoded = self.peak(path, True), self.peak(path, False)
+        assert streamed < decoded
+
+        out = io.StringIO()
+        with track_memory((streamed + decoded) // 2) as usage:
+            render_file(path, out, stream=False, cache=ElementCache())
+        assert out.getvalue() == expected
+        assert usage.fallback
+
+    def test_aborts_when_streaming_is_over_budget_too(self, export):
+        path, _ = export
+        with pytest.raises(MemoryBudgetExceeded, match="during render of body item"):
+            with track_memory(self.peak(path, True) // 4) as usage:
+                render_file(path, io.StringIO(), stream=False)
+        assert usage.fallback and usage.peak_bytes > usage.budget
+
+    def test_spikes_between_checks_count(self):
+        with track_memory(1 << 20) as usage:
+            spike = bytearray(4 << 20)
+            del spike
+            with pytest.raises(MemoryBudgetExceeded, match="during decode"):
+                usage.check("decode")
+        assert usage.peak_bytes >= 4 << 20 > usage.retained_bytes
+
+    def test_unseekable_writers_are_not_retried(self, export):
+        path, _ = export
+        with pytest.raises(MemoryBudgetExceeded, match="during decode"):
+            with track_memory(1000):
+                render_file(path, [].append, stream=False)
+        with pytest.raises(MemoryBudgetExceeded, match="during parse of body item 1"):
+            with track_memory(0):
+                parse_content({"content": [{"paragraph": {"elements": []}}]})
+
+
+class TestMinifiedOutput:
+    def paragraph(self, runs, style="NORMAL_TEXT"):
+        return {
+            "paragraph": {
+                "paragraphStyle": {"namedStyleType": style},
+                "elements": [
+                    {"textRun": {"content": text, "textStyle": text_style}}
+                    for text, text_style in runs
+                ],
+            }
+        }
+
+    def test_fixture(self, document):
+        assert parse_doc_body(document, minify=True) == (
+            '<p><b>Intro é中</b></p><ol style="list-style-type: decimal;">'
+            '<li>one</li><ol style="list-style-type: lower-alpha;"><li>two</li></ol></ol>'
+            "<ul><li>three</li></ul><table><tr><th>head</th><th colspan=\"2\">wide</th>"
+            "</tr><tr><td>a</td><td><ul><li>x</li></ul><p>y 1.5e3</p></td></tr></table>"
+            "<p>Outro</p>"
+        )
+
+    def test_merges_tags_and_keeps_heading_lines(self):
+        document = {
+            "lists": {},
+            "body": {
+                "content": [
+                    self.paragraph(
+                        [("a", {"italic": True}), ("b\n", {"bold": True, "italic": True})]
+                    ),
+                    self.paragraph([("Title\n", {})], style="HEADING_2"),
+                    self.paragraph([("after\n", {})]),
+                ]
+            },
+        }
+        assert parse_doc_body(document, minify=True) == (
+            "<p><i>a<b>b</b></i></p>\n## Title\n<p>after</p>"
+        )
+
+    @pytest.mark.parametrize("seed", [0, 1, 2])
+    def test_render_paths_agree(self, seed):
+        document = generate_document(
+            seed=seed, paragraphs=80, list_ratio=0.5, heading_ratio=0.1, tables=4, table_nesting=2
+        )
+        expected = parse_doc_body(document, minify=True)
+        assert len(expected) < len(parse_doc_body(document))
+        cache = ElementCache()
+        for _ in range(2):
+            assert parse_doc_body(document, cache, minify=True) == expected
+            stream = io.StringIO(json.dumps(document))
+            assert parse_doc_stream(stream, chunk_size=64, cache=cache, minify=True) == expected
+        # minified and regular renderings of a table are separate cache entries
+        assert parse_doc_body(document, cache) == parse_doc_body(document)
@@ -0,0 +1,515 @@
+import gzip
+import json
+import multiprocessing
+import os
+import tarfile
+import threading
+import time
+import zipfile
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
+
+import pytest
+
+from docs_to_md import parse_doc_body
+import docs_to_md_batch
+from docs_to_md_batch import (
+    ConversionCache,
+    Manifest,
+    OutputSink,
+    Task,
+    convert_file,
+    convert_many,
+    count_elements,
+    find_inputs,
+    main,
+    output_path_for,
+    plan_tasks,
+    publish_output,
+    run_scheduled,
+    write_gzip_sidecar,
+)
+
+
+@pytest.fixture
+def corpus(tmp_path, document):
+    root = tmp_path / "exports"
+    (root / "team" / "notes").mkdir(parents=True)
+    (root / "a.json").write_text(json.dumps(document))
+    (root / "team" / "notes" / "b.json").write_text(json.dumps(document))
+    (root / "team" / "broken.json").write_text('{"body": ')
+    (root / "team" / "readme.txt").write_text("not an export")
+    return root
+
+
+class TestFindInputs:
+    def test_directory_is_searched_recursively(self, corpus):
+        found = dict(find_inputs([str(corpus)]))
+        assert sorted(found.values()) == [
+            "a.json",
+            os.path.join("team", "broken.json"),
+            os.path.join("team", "notes", "b.json"),
+        ]
+
+    def test_glob_is_relative_to_its_root(self, corpus):
+        found = find_inputs([str(corpus / "team" / "**" / "b.json")])
+        assert [rel for _, rel in found] == [os.path.join("notes", "b.json")]
+
+    def test_same_named_files_cant_share_an_output(self, corpus, tmp_path, capsys):
+        other = tmp_path / "other"
+        other.mkdir()
+        (other / "a.json").write_text((corpus / "a.json").read_text())
+        args = [str(corpus / "a.json"), str(other / "a.json"), "-j", "1"]
+        with pytest.raises(SystemExit):
+            main(args + ["-o", str(tmp_path / "out")])
+        assert f"{tmp_path / 'out' / 'a.html'} <- " in capsys.readouterr().err
+        assert not (tmp_path / "out").exists()
+        # next to their inputs they don't collide
+        assert main(args + ["-q"]) == 0
+
+    def test_output_path_mirrors_layout(self):
+        assert output_path_for("in/x/a.json", "x/a.json", "out", ".html") == os.path.join(
+            "out", "x", "a.html"
+        )
+        assert output_path_for("in/x/a.json", "x/a.json", None, ".html") == "in/x/a.html"
+
+
+class TestBatchMain:
+    @pytest.mark.parametrize("jobs", ["1", "2"])
+    def test_bad_document_does_not_stop_run(self, corpus, tmp_path, document, jobs, capsys):
+        out = tmp_path / "out"
+        assert main([str(corpus), "-o", str(out), "-j", jobs]) == 1
+
+        expected = parse_doc_body(document)
+        assert (out / "a.html").read_text() == expected
+        assert (out / "team" / "notes" / "b.html").read_text() == expected
+        assert not (out / "team" / "broken.html").exists()
+        assert list(out.rglob("*.tmp")) == []
+
+        stdout = capsys.readouterr().out
+        assert stdout.count("ok ") == 2
+        assert "FAILED" in stdout and "broken.json" in stdout
+
+    def test_results_report_errors(self, corpus, tmp_path):
+        results = list(
+            convert_many(
+                [(str(corpus / "team" / "broken.json"), str(tmp_path / "x.html"))],
+                workers=1,
+            )
+        )
+        assert not results[0].ok
+        assert results[0].error.startswith("JSONDecodeError")
+
+
+class TestConversionCache:
+    @pytest.fixture
+    def export(self, tmp_path, document):
+        path = tmp_path / "doc.json"
+        path.write_text(json.dumps(document))
+        return path
+
+    def test_unchanged_file_is_served_from_cache(self, tmp_path, export, document):
+        cache = ConversionCache(str(tmp_path / "cache"))
+        first = convert_file(str(export), str(tmp_path / "1.html"), cache)
+        second = convert_file(str(export), str(tmp_path / "2.html"), cache)
+        assert (first.cached, second.cached) == (False, True)
+        assert (tmp_path / "2.html").read_text() == parse_doc_body(document)
+
+    def test_same_revision_elsewhere_is_a_hit(self, tmp_path, export, document):
+        cache = ConversionCache(str(tmp_path / "cache"))
+        convert_file(str(export), str(tmp_path / "1.html"), cache)
+        copy = tmp_path / "copy.json"
+        copy.write_text(json.dumps(document, indent=1))
+        assert convert_file(str(copy), str(tmp_path / "2.html"), cache).cached
+
+    def test_new_revision_or_converter_version_is_a_miss(
+        self, tmp_path, export, document, monkeypatch
+    ):
+        cache = ConversionCache(str(tmp_path / "cache"))
+        convert_file(str(export), str(tmp_path / "1.html"), cache)
+
+        document["revisionId"] = "rev-2"
+        edited = tmp_path / "edited.json"
+        edited.write_text(json.dumps(document))
+        assert not convert_file(str(edited), str(tmp_path / "2.html"), cache).cached
+
+        monkeypatch.setattr(docs_to_md_batch, "CONVERTER_VERSION", "next")
+        assert not convert_file(str(export), str(tmp_path / "3.html"), cache).cached
+
+    def test_exports_without_revision_use_content_hash(self, tmp_path, document):
+        del document["revisionId"]
+        cache = ConversionCache(str(tmp_path / "cache"))
+        for name in ["a", "b"]:
+            (tmp_path / f"{name}.json").write_text(json.dumps(document))
+        convert_file(str(tmp_path / "a.json"), str(tmp_path / "a.html"), cache)
+        assert convert_file(str(tmp_path / "b.json"), str(tmp_path / "b.html"), cache).cached
+
+    def test_evicts_least_recently_used(self, tmp_path, document):
+        cache = ConversionCache(str(tmp_path / "cache"), max_bytes=1)
+        paths = []
+        for revision in ["r1", "r2", "r3"]:
+            document["revisionId"] = revision
+            path = tmp_path / f"{revision}.json"
+            path.write_text(json.dumps(document))
+            convert_file(str(path), str(tmp_path / f"{revision}.html"), cache)
+            paths.append(path)
+        size = len(parse_doc_body(document).encode())
+        # two entries and their reference files
+        cache.max_bytes = 2 * size + 2 * 64
+        # r1 becomes the most recently used entry, then r3, then r2
+        for path, used in zip(paths, [3, 1, 2]):
+            entry = cache._path(cache.entry_key(str(path)), ".html")
+            ref = cache._path(cache._stat_key(str(path)), ".ref")
+            for cached in (entry, ref):
+                os.utime(cached, ns=(used, used))
+
+        assert cache.evict() == 1
+        assert cache.lookup(str(paths[0]))[0] is not None
+        assert cache.lookup(str(paths[1]))[0] is None
+        assert cache.lookup(str(paths[2]))[0] is not None
+
+    def test_evicts_stale_references(self, tmp_path, export, document):
+        cache = ConversionCache(str(tmp_path / "cache"))
+        convert_file(str(export), str(tmp_path / "out.html"), cache)
+        # every touch of the input links it again, under a new stat key
+        for mtime in range(1, 4):
+            os.utime(export, ns=(mtime, mtime))
+            assert cache.lookup(str(export))[0] is not None
+        current = cache._path(cache._stat_key(str(export)), ".ref")
+        refs = list((tmp_path / "cache").rglob("*.ref"))
+        assert len(refs) == 4
+        for ref in refs:
+            if str(ref) != current:
+                os.utime(ref, ns=(0, 0))
+
+        cache.max_bytes = len(parse_doc_body(document).encode()) + 64
+        assert cache.evict() == 0
+        assert [str(ref) for ref in (tmp_path / "cache").rglob("*.ref")] == [current]
+        assert convert_file(str(export), str(tmp_path / "again.html"), cache).cached
+
+    def test_drops_references_to_evicted_entries(self, tmp_path, export):
+        cache = ConversionCache(str(tmp_path / "cache"))
+        convert_file(str(export), str(tmp_path / "out.html"), cache)
+        for html in (tmp_path / "cache").rglob("*.html"):
+            html.unlink()
+        assert cache.evict() == 0
+        assert list((tmp_path / "cache").rglob("*.ref")) == []
+
+    @pytest.mark.parametrize("keep_html", [False, True])
+    def test_entry_evicted_after_lookup_is_converted(
+        self, tmp_path, export, document, monkeypatch, keep_html
+    ):
+        cache = ConversionCache(str(tmp_path / "cache"))
+        convert_file(str(export), str(tmp_path / "1.html"), cache)
+        lookup = cache.lookup
+
+        def evicted_meanwhile(input_path):
+            path, key = lookup(input_path)
+            os.remove(path)
+            return path, key
+
+        monkeypatch.setattr(cache, "lookup", evicted_meanwhile)
+        result = convert_file(str(export), str(tmp_path / "2.html"), cache, keep_html=keep_html)
+        assert result.ok and not result.cached
+        html = result.html if keep_html else (tmp_path / "2.html").read_text()
+        assert html == parse_doc_body(document)
+        assert cache._touch(cache.entry_key(str(export))) is not None
+
+    def test_cli_rerun_reports_cached(self, corpus, tmp_path, capsys):
+        args = [str(corpus), "-o", str(tmp_path / "out"), "-j", "1"]
+        args += ["--cache-dir", str(tmp_path / "cache")]
+        main(args)
+        capsys.readouterr()
+        main(args)
+        assert "0 converted, 2 cached, 1 failed" in capsys.readouterr().err
+
+
+def test_cli_writes_stats_records(corpus, tmp_path):
+    stats_path = tmp_path / "stats.jsonl"
+    # with reused tables disabled, every record counts the full structure
+    args = [str(corpus), "-o", str(tmp_path / "out"), "-j", "2", "--stats", str(stats_path)]
+    main(args + ["--element-cache-bytes", "0"])
+    records = [json.loads(line) for line in stats_path.read_text().splitlines()]
+    failed = [record for record in records if "error" in record]
+    assert len(records) == 3 and len(failed) == 1
+    assert failed[0]["document"].endswith("broken.json")
+    assert failed[0]["error"].startswith("JSONDecodeError")
+    assert all(record["paragraphs"] == 12 for record in records if record not in failed)
+
+
+def test_cli_reuses_tables_across_documents(corpus, tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(docs_to_md_batch, "_element_cache", None)
+    main([str(corpus), "-o", str(tmp_path / "out"), "-j", "1"])
+    assert "element cache: 1 of 2 tables reused (50%)" in capsys.readouterr().err
+
+
+def test_cli_reports_document_memory(corpus, tmp_path, capsys):
+    stats_path = tmp_path / "stats.jsonl"
+    args = [str(corpus), "-o", str(tmp_path / "out"), "-j", "1", "--stats", str(stats_path)]
+    main(args + ["--trace-memory"])
+    records = [json.loads(line) for line in stats_path.read_text().splitlines()]
+    assert all(record["peak_bytes"] > 0 for record in records)
+    assert all(record["memory_budget"] is None for record in records)
+    assert "memory: largest peak" in capsys.readouterr().err
+
+    main(args + ["--max-document-memory", "1000"])
+    stdout = capsys.readouterr().out
+    assert stdout.count("MemoryBudgetExceeded") == 2
+    assert "over the budget of 1000" in stdout
+
+
+class TestManifest:
+    def run(self, corpus, tmp_path, capsys, *extra):
+        manifest = tmp_path / "manifest.jsonl"
+        args = [str(corpus), "-o", str(tmp_path / "out"), "-j", "1"]
+        code = main(args + ["--manifest", str(manifest), *extra])
+        captured = capsys.readouterr()
+        return code, captured.out, captured.err, manifest
+
+    def test_rerun_skips_completed_work(self, corpus, tmp_path, capsys):
+        code, _, err, manifest = self.run(corpus, tmp_path, capsys)
+        assert code == 1 and "2 converted, 0 cached, 1 failed, 0 already done" in err
+        records = [json.loads(line) for line in manifest.read_text().splitlines()]
+        assert sorted(record["status"] for record in records) == ["failed", "ok", "ok"]
+        assert all(record["input_hash"] for record in records if record["status"] == "ok")
+
+        _, _, err, _ = self.run(corpus, tmp_path, capsys)
+        assert "0 converted, 0 cached, 1 failed, 2 already done, 0 given up" in err
+
+    def test_changed_inputs_and_missing_outputs_are_redone(self, corpus, tmp_path, capsys):
+        self.run(corpus, tmp_path, capsys)
+        # a touch alone is recognised by the input hash
+        os.utime(corpus / "a.json", ns=(0, 0))
+        (tmp_path / "out" / "team" / "notes" / "b.html").unlink()
+        _, _, err, _ = self.run(corpus, tmp_path, capsys)
+        assert "1 converted, 0 cached, 1 failed, 1 already done" in err
+
+        (corpus / "a.json").write_text((corpus / "a.json").read_text() + " ")
+        _, _, err, _ = self.run(corpus, tmp_path, capsys)
+        assert "1 converted, 0 cached, 1 failed, 1 already done" in err
+
+    def test_gives_up_after_retries(self, corpus, tmp_path, capsys):
+        self.run(corpus, tmp_path, capsys, "--max-retries", "1")
+        self.run(corpus, tmp_path, capsys, "--max-retries", "1")
+        code, out, err, _ = self.run(corpus, tmp_path, capsys, "--max-retries", "1")
+        assert code == 1
+        assert "0 converted, 0 cached, 0 failed, 2 already done, 1 given up" in err
+        assert "GAVE UP" in out and "broken.json" in out and "(2 attempts)" in out
+
+        # fixing the input makes it eligible again
+        fixed = {"body": {"content": []}, "lists": {}}
+        (corpus / "team" / "broken.json").write_text(json.dumps(fixed))
+        code, _, err, _ = self.run(corpus, tmp_path, capsys, "--max-retries", "1")
+        assert code == 0 and "1 converted" in err
+
+    def test_switching_output_mode_redoes_work(self, corpus, tmp_path, capsys):
+        self.run(corpus, tmp_path, capsys)
+        _, _, err, _ = self.run(corpus, tmp_path, capsys, "--minify")
+        assert "2 converted, 0 cached, 1 failed, 0 already done" in err
+        _, _, err, _ = self.run(corpus, tmp_path, capsys, "--minify")
+        assert "2 already done" in err
+
+    def test_missing_sidecars_are_redone(self, corpus, tmp_path, capsys):
+        self.run(corpus, tmp_path, capsys)
+        _, _, err, _ = self.run(corpus, tmp_path, capsys, "--gzip-sidecars")
+        assert "2 converted, 0 cached, 1 failed, 0 already done" in err
+        (tmp_path / "out" / "a.html.gz").unlink()
+        _, _, err, _ = self.run(corpus, tmp_path, capsys, "--gzip-sidecars")
+        assert "1 converted, 0 cached, 1 failed, 1 already done" in err
+
+    def test_torn_last_line_is_ignored(self, corpus, tmp_path, capsys):
+        _, _, _, manifest = self.run(corpus, tmp_path, capsys)
+        with open(manifest, "a") as file:
+            file.write('{"input": "half a rec')
+        _, _, err, _ = self.run(corpus, tmp_path, capsys)
+        assert "2 already done" in err
+        lines = manifest.read_text().splitlines()
+        assert json.loads(lines[-1])["status"] == "failed"
+
+
+    def test_empty_manifest_starts_afresh(self, corpus, tmp_path, capsys):
+        # e.g. created by hand, or a crash right after it was opened
+        (tmp_path / "manifest.jsonl").touch()
+        assert Manifest(str(tmp_path / "manifest.jsonl")).records == {}
+        code, _, err, manifest = self.run(corpus, tmp_path, capsys)
+        assert code == 1 and "2 converted, 0 cached, 1 failed, 0 already done" in err
+        assert len(manifest.read_text().splitlines()) == 3
+
+
+class TestScheduling:
+    def test_largest_first_and_small_inputs_chunked(self, tmp_path):
+        jobs = []
+        for name, size in [("small0", 10), ("giant", 10_000), ("mid", 2_000)] + [
+            (f"small{i}", 10) for i in range(1, 40)
+        ]:
+            path = tmp_path / f"{name}.json"
+            path.write_text("x" * size)
+            jobs.append((str(path), str(tmp_path / f"{name}.html")))
+
+        tasks = plan_tasks(jobs, workers=2)
+        assert [os.path.basename(path) for path, _ in tasks[0].jobs] == ["giant.json"]
+        assert tasks[0].memory > tasks[-1].memory
+        assert sorted(job for task in tasks for job in task.jobs) == sorted(jobs)
+        # the small inputs are grouped, not one task each
+        assert len(tasks) < len(jobs) / 2
+
+        capped = plan_tasks(jobs, workers=2, max_jobs=1)
+        assert [len(task.jobs) for task in capped] == [1] * len(jobs)
+
+    def test_counts_paragraphs_without_decoding(self, tmp_path, document):
+        path = tmp_path / "doc.json"
+        path.write_text(json.dumps(document, indent=1))
+        assert count_elements(str(path)) == 12
+
+    def test_giants_never_run_together(self):
+        running = []
+        overlap = []
+        lock = threading.Lock()
+
+        def run(jobs):
+            with lock:
+                running.extend(jobs)
+                overlap.append(sum(job.startswith("giant") for job in running))
+            time.sleep(0.02)
+            with lock:
+                for job in jobs:
+                    running.remove(job)
+            return jobs
+
+        tasks = [Task(jobs=[f"giant{i}"], cost=100, memory=60) for i in range(3)]
+        tasks += [Task(jobs=[f"small{i}"], cost=1, memory=1) for i in range(6)]
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            results = list(run_scheduled(executor, tasks, 3, run, memory_budget=100))
+        assert sorted(results) == sorted(job for task in tasks for job in task.jobs)
+        assert max(overlap) == 1
+
+
+def exit_on_crash(jobs):
+    if "crash" in jobs:
+        os._exit(1)
+    return jobs
+
+
+def test_dead_worker_fails_its_jobs_instead_of_the_run():
+    tasks = [Task(jobs=["crash", "crash-neighbour"], cost=2, memory=1)]
+    tasks += [Task(jobs=[f"small{i}"], cost=1, memory=1) for i in range(4)]
+    # spawned, not forked: other tests leave threads behind in this process
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=2, mp_context=context) as executor:
+        results = list(
+            run_scheduled(executor, tasks, 2, exit_on_crash, failed=lambda job, exc: (job, exc))
+        )
+    failed = dict(result for result in results if isinstance(result, tuple))
+    assert {"crash", "crash-neighbour"} <= failed.keys()
+    assert all(isinstance(exc, BrokenExecutor) for exc in failed.values())
+    assert sorted(job if isinstance(job, str) else job[0] for job in results) == sorted(
+        job for task in tasks for job in task.jobs
+    )
+
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        with pytest.raises(BrokenExecutor):
+            list(run_scheduled(executor, tasks[:1], 1, exit_on_crash))
+
+
+class TestOutputSinks:
+    def members(self, archive):
+        name = str(archive)
+        if name.endswith((".tar", ".tgz")):
+            with tarfile.open(archive) as tar:
+                return {
+                    member.name: tar.extractfile(member).read().decode()
+                    for member in tar.getmembers()
+                }
+        if name.endswith(".zip"):
+            with zipfile.ZipFile(archive) as archive_file:
+                return {
+                    member: archive_file.read(member).decode()
+                    for member in archive_file.namelist()
+                }
+        opener = gzip.open if name.endswith(".gz") else open
+        with opener(archive, "rt", encoding="utf-8") as file:
+            records = [json.loads(line) for line in file]
+        assert {(r["documentId"], r["revisionId"]) for r in records} == {("doc-1", "rev-1")}
+        return {record["path"]: record["html"] for record in records}
+
+    @pytest.mark.parametrize("jobs", ["1", "2"])
+    @pytest.mark.parametrize(
+        "archive", ["out.tar", "out.tgz", "out.zip", "out.jsonl", "out.ndjson.gz"]
+    )
+    def test_documents_go_into_one_file(self, corpus, tmp_path, document, archive, jobs):
+        archive = tmp_path / archive
+        assert main([str(corpus), "--archive", str(archive), "-j", jobs, "-q"]) == 1
+
+        expected = parse_doc_body(document)
+        assert self.members(archive) == {"a.html": expected, "team/notes/b.html": expected}
+        assert [path.name for path in tmp_path.iterdir() if path.suffix == ".tmp"] == []
+        assert not (corpus / "a.html").exists()
+
+    def test_cached_documents_keep_their_ids(self, corpus, tmp_path, document):
+        cache_dir = str(tmp_path / "cache")
+        for run in range(2):
+            archive = tmp_path / f"run{run}.jsonl"
+            main([str(corpus), "--archive", str(archive), "--cache-dir", cache_dir, "-j", "1"])
+            assert self.members(archive)["a.html"] == parse_doc_body(document)
+
+    def test_rejects_inputs_with_the_same_member_name(self, corpus, tmp_path, capsys):
+        other = tmp_path / "other"
+        other.mkdir()
+        (other / "a.json").write_text((corpus / "a.json").read_text())
+        archive = tmp_path / "out.zip"
+        with pytest.raises(SystemExit):
+            main([str(corpus / "a.json"), str(other / "a.json"), "--archive", str(archive)])
+        assert "a.html <- " in capsys.readouterr().err
+        assert list(tmp_path.glob("out.zip*")) == []
+
+    def test_sinks_must_write_documents(self, tmp_path):
+        class Incomplete(OutputSink):
+            pass
+
+        with pytest.raises(TypeError):
+            Incomplete(str(tmp_path / "out"))
+
+    def test_rejects_unknown_archive_types(self, corpus, tmp_path):
+        with pytest.raises(SystemExit):
+            main([str(corpus), "--archive", str(tmp_path / "out.rar")])
+        with pytest.raises(SystemExit):
+            main([str(corpus), "--archive", str(tmp_path / "out.zip"), "--manifest", "m"])
+
+
+class TestMinifiedOutput:
+    def test_sidecars_hold_the_minified_html(self, corpus, tmp_path, document):
+        cache_dir = str(tmp_path / "cache")
+        main([str(corpus), "--cache-dir", cache_dir, "-j", "1", "-q"])
+        assert (corpus / "a.html").read_text() == parse_doc_body(document)
+        assert not (corpus / "a.html.gz").exists()
+
+        sidecars = []
+        for _ in range(2):
+            args = [str(corpus), "--cache-dir", cache_dir, "--minify", "--gzip-sidecars"]
+            assert main(args + ["-j", "1", "-q"]) == 1
+            sidecars.append((corpus / "a.html.gz").read_bytes())
+            expected = parse_doc_body(document, minify=True)
+            assert (corpus / "a.html").read_text() == expected
+            assert gzip.decompress(sidecars[-1]).decode() == expected
+        # served from the cache the second time, byte for byte the same
+        assert sidecars[0] == sidecars[1]
+        assert [path.name for path in corpus.rglob("*.tmp*")] == []
+
+    def test_runs_without_sidecars_remove_stale_ones(self, corpus, document):
+        main([str(corpus), "--gzip-sidecars", "-j", "1", "-q"])
+        (corpus / "a.json").write_text(json.dumps({**document, "revisionId": "rev-2"}))
+        main([str(corpus), "-j", "1", "-q"])
+        assert (corpus / "a.html").exists() and not (corpus / "a.html.gz").exists()
+
+    def test_sidecar_is_taken_back_if_the_output_cant_follow(self, tmp_path):
+        (tmp_path / "out.tmp").write_text("<p>new</p>")
+        write_gzip_sidecar(str(tmp_path / "out.tmp"))
+        # a directory in the way makes replacing the output fail
+        (tmp_path / "out.html").mkdir()
+        (tmp_path / "out.html" / "child").write_text("")
+        with pytest.raises(OSError):
+            publish_output(str(tmp_path / "out.tmp"), str(tmp_path / "out.html"), True)
+        assert not (tmp_path / "out.html.gz").exists()
+
+    def test_sidecars_do_not_go_into_archives(self, corpus, tmp_path):
+        with pytest.raises(SystemExit):
+            main([str(corpus), "--archive", str(tmp_path / "out.zip"), "--gzip-sidecars"])
@@ -0,0 +1,92 @@
+import io
+import json
+import os
+
+from docs_to_md import parse_doc_body, parse_doc_stream
+from docs_to_md_bench import (
+    SCENARIOS,
+    BenchResult,
+    compare_to_baseline,
+    generate_document,
+    run_benchmark,
+)
+
+
+def _max_table_depth(elements, depth=0):
+    deepest = depth
+    for element in elements:
+        for row in element.get("table", {}).get("tableRows", []):
+            for cell in row["tableCells"]:
+                deepest = max(deepest, _max_table_depth(cell["content"], depth + 1))
+    return deepest
+
+
+class TestGenerateDocument:
+    def test_is_deterministic(self):
+        assert generate_document(seed=3, paragraphs=50) == generate_document(
+            seed=3, paragraphs=50
+        )
+        assert generate_document(seed=3, paragraphs=50) != generate_document(
+            seed=4, paragraphs=50
+        )
+
+    def test_honours_knobs(self):
+        document = generate_document(
+            paragraphs=40,
+            runs_per_paragraph=5,
+            list_ratio=1.0,
+            list_depth=2,
+            glyph_types=["ROMAN"],
+            tables=3,
+            table_nesting=2,
+        )
+        content = document["body"]["content"]
+        top_level = [element for element in content if "paragraph" in element]
+        assert len(top_level) == 40
+        assert all("bullet" in element["paragraph"] for element in top_level)
+        assert 2 <= _max_table_depth(content) <= 3
+        for list_entry in document["lists"].values():
+            levels = list_entry["listProperties"]["nestingLevels"]
+            assert levels == [{"glyphType": "ROMAN"}] * 2
+
+    def test_output_converts(self):
+        document = generate_document(paragraphs=200, tables=4, table_nesting=2)
+        html = parse_doc_body(document)
+        assert "<table>" in html and "<li>" in html
+        assert parse_doc_stream(io.StringIO(json.dumps(document))) == html
+
+
+class TestBenchmark:
+    def test_measures_every_stage(self):
+        result = run_benchmark("tiny", generate_document(paragraphs=20), repeat=1)
+        assert result.input_bytes > 0 and result.peak_bytes > 0 and result.body_seconds > 0
+        assert result.seconds == (
+            result.decode_seconds + result.parse_seconds + result.render_seconds
+        )
+
+    def test_regressions_are_reported(self):
+        baseline = {
+            "tiny": dict(
+                parse_seconds=0.1, render_seconds=0.1, body_seconds=0.1, peak_bytes=1000
+            )
+        }
+        fast = BenchResult("tiny", 10, 0.0, 0.1, 0.101, 1000, 0.1)
+        slow = BenchResult("tiny", 10, 0.0, 0.2, 0.1, 2000, 0.2)
+        assert compare_to_baseline([fast], baseline, tolerance=0.05) == []
+        regressions = compare_to_baseline([slow], baseline, tolerance=0.05)
+        assert [message.split(":")[0] for message in regressions] == [
+            "tiny.parse_seconds",
+            "tiny.body_seconds",
+            "tiny.peak_bytes",
+        ]
+        # baselines recorded before body_seconds existed still compare
+        del baseline["tiny"]["body_seconds"]
+        assert len(compare_to_baseline([slow], baseline, tolerance=0.05)) == 2
+
+    def test_committed_baseline_covers_every_scenario(self):
+        path = os.path.join(os.path.dirname(__file__), "bench_baseline.json")
+        with open(path) as file:
+            baseline = json.load(file)
+        assert sorted(baseline) == sorted(SCENARIOS)
+        fields = set(BenchResult.__dataclass_fields__)
+        assert all(set(reference) == fields for reference in baseline.values())
@@ -0,0 +1,88 @@
+import json
+
+import pytest
+
+import docs_to_md
+from docs_to_md import parse_doc_body
+from docs_to_md_equivalence import (
+    check_document,
+    first_difference,
+    locate,
+    main,
+    make_engines,
+    random_documents,
+)
+
+
+class TestFirstDifference:
+    @pytest.mark.parametrize(
+        "expected, actual, offset",
+        [("abc", "abc", None), ("abc", "abd", 2), ("abc", "ab", 2), ("", "x", 0)],
+    )
+    def test_offsets(self, expected, actual, offset):
+        assert first_difference(expected, actual) == offset
+        assert first_difference(expected.encode(), actual.encode()) == offset
+
+
+class TestCheckDocument:
+    def test_engines_agree(self, document):
+        engines = make_engines()
+        assert check_document("fixture", document, engines) == []
+        for name, data in random_documents(4, seed=100):
+            assert check_document(name, data, engines) == []
+
+    def test_reports_first_divergent_byte_and_element(self, document):
+        reference = parse_doc_body(document)
+        engines = {"broken": lambda data: parse_doc_body(data).replace("1.5e3", "1.6e3")}
+        [divergence] = check_document("fixture", document, engines)
+
+        # the intro's multi-byte characters count as bytes, not characters
+        assert divergence.offset == reference.encode().index(b"1.5e3") + 2
+        assert divergence.location == "body.content[6] (table) at row 2, cell 2"
+        assert "y 1.5e3" in divergence.expected and "y 1.6e3" in divergence.actual
+
+    def test_locates_paragraphs(self, document):
+        reference = parse_doc_body(document)
+        assert locate(document, reference.index("one")) == (
+            "body.content[2] (paragraph 'one', list 2 level 0)"
+        )
+        assert locate(document, len(reference)) == "the end of the document"
+
+    def test_catches_regressions_shared_by_every_engine(self, document, monkeypatch):
+        engines = make_engines()
+        monkeypatch.setattr(docs_to_md, "text_style_tags", lambda *args: ("", ""))
+        divergences = check_document("fixture", document, engines)
+        assert {divergence.engine for divergence in divergences} == set(engines)
+        assert all("<b>" in divergence.expected for divergence in divergences)
+
+    def test_locates_list_tags(self, document):
+        reference = parse_doc_body(document)
+        # the empty paragraph renders nothing, the next list item closes the list
+        assert locate(document, reference.index("</ol>")) == (
+            "body.content[5] (paragraph 'three', list 1 level 0)"
+        )
+        assert locate(document, reference.index("</ul>")) == "body.content[6] (table)"
+
+    def test_reports_engines_that_raise(self, document):
+        def broken(data):
+            raise KeyError("lists")
+
+        [divergence] = check_document("fixture", document, {"broken": broken})
+        assert "raised KeyError" in str(divergence)
+
+
+class TestEquivalenceMain:
+    def test_random_documents_pass(self, capsys):
+        assert main(["--random", "3", "--engines", "tree", "stream", "parallel"]) == 0
+        assert "3 documents, 9 comparisons, 0 divergent" in capsys.readouterr().err
+
+    def test_golden_corpus(self, tmp_path, document, capsys):
+        export = tmp_path / "doc.json"
+        export.write_text(json.dumps(document))
+        assert main([str(tmp_path), "--random", "0", "--write-golden"]) == 0
+        assert (tmp_path / "doc.html").read_text() == parse_doc_body(document)
+
+        (tmp_path / "doc.html").write_text(parse_doc_body(document).replace("Outro", "Out"))
+        assert main([str(tmp_path), "--random", "0", "--engines", "tree"]) == 1
+        stdout = capsys.readouterr().out
+        assert "[golden]" in stdout and "body.content[7]" in stdout
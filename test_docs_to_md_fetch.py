@@ -0,0 +1,140 @@
+import asyncio
+import functools
+import json
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import docs_to_md_fetch
+from docs_to_md import parse_doc_body
+from docs_to_md_fetch import DocsSource, FetchError, convert_documents, main
+
+
+class StubDocsServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, documents, failures=None):
+        super().__init__(("127.0.0.1", 0), StubDocsHandler)
+        self.documents = documents
+        # document id -> number of 503s to return before succeeding
+        self.failures = dict(failures or {})
+        self.requests = []
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+
+class StubDocsHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=b""):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        document_id = self.path.rsplit("/", 1)[-1]
+        with self.server.lock:
+            self.server.requests.append((document_id, self.client_address))
+            failures = self.server.failures.get(document_id, 0)
+            if failures:
+                self.server.failures[document_id] = failures - 1
+        if failures:
+            self._send(503)
+        elif document_id in self.server.documents:
+            self._send(200, json.dumps(self.server.documents[document_id]).encode())
+        else:
+            self._send(404)
+
+
+@pytest.fixture
+def server(document):
+    broken = {"body": {"content": [{"paragraph": {}}]}, "lists": {}}
+    server = StubDocsServer(
+        {"doc-1": document, "doc-2": document, "broken": broken},
+        failures={"doc-2": 2},
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def collect(document_ids, source, **kwargs):
+    async def run():
+        return [result async for result in convert_documents(document_ids, source, **kwargs)]
+
+    try:
+        return {result.document_id: result for result in asyncio.run(run())}
+    finally:
+        source.close()
+
+
+class TestConvertDocuments:
+    def test_fetches_retries_and_converts(self, server, document):
+        source = DocsSource(server.base_url, concurrency=2, backoff=0.01)
+        results = collect(["doc-1", "doc-2", "missing", "broken"], source)
+
+        expected = parse_doc_body(document)
+        assert results["doc-1"].html == expected
+        assert results["doc-2"].html == expected
+        assert results["missing"].error == "missing: HTTP 404"
+        assert results["broken"].error.startswith("KeyError")
+        # two 503s then success; the 404 is not retried
+        requested = [document_id for document_id, _ in server.requests]
+        assert requested.count("doc-2") == 3
+        assert requested.count("missing") == 1
+
+    def test_gives_up_after_retries(self, server):
+        server.failures["doc-1"] = 10
+        source = DocsSource(server.base_url, retries=1, backoff=0.01)
+        assert collect(["doc-1"], source)["doc-1"].error == "doc-1: HTTP 503"
+
+    def test_connections_are_reused(self, server):
+        source = DocsSource(server.base_url, concurrency=1)
+        collect(["doc-1"] * 5, source, max_pending=1)
+        assert len({address for _, address in server.requests}) == 1
+
+    def test_unreachable_endpoint(self):
+        source = DocsSource("http://127.0.0.1:9/v1", retries=0)
+        with pytest.raises(FetchError):
+            asyncio.run(source.fetch("doc-1"))
+        source.close()
+
+
+class TestCli:
+    def test_writes_each_document(self, server, document, tmp_path, capsys, monkeypatch):
+        # forking while the stub server's threads run could deadlock the child
+        spawn = multiprocessing.get_context("spawn")
+        executor = functools.partial(ProcessPoolExecutor, mp_context=spawn)
+        monkeypatch.setattr(docs_to_md_fetch, "ProcessPoolExecutor", executor)
+        args = ["doc-1", "missing", "--base-url", server.base_url, "-o", str(tmp_path), "-j", "1"]
+        assert main([*args, "--header", "X-Trace: 1"]) == 1
+        assert (tmp_path / "doc-1.html").read_text() == parse_doc_body(document)
+        assert "FAILED  missing: missing: HTTP 404" in capsys.readouterr().out
+
+    @pytest.mark.parametrize(
+        "argument, message",
+        [
+            (["../escape"], "not a document id"),
+            (["a/b"], "not a document id"),
+            ([".."], "not a document id"),
+            (["doc-1", "--header", "no colon"], '"Name: value"'),
+        ],
+    )
+    def test_rejects_bad_arguments(self, server, tmp_path, argument, message, capsys):
+        with pytest.raises(SystemExit) as exit_info:
+            main([*argument, "--base-url", server.base_url, "-o", str(tmp_path / "out")])
+        assert exit_info.value.code == 2
+        assert message in capsys.readouterr().err
+        assert not (tmp_path / "out").exists()
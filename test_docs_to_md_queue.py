@@ -0,0 +1,203 @@
+import gzip
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+
+import pytest
+
+import docs_to_md_queue
+from docs_to_md import parse_doc_body
+from docs_to_md_queue import WorkQueue, _Heartbeat, main, run_worker
+
+
+@pytest.fixture
+def jobs(tmp_path, document):
+    inputs = tmp_path / "exports"
+    inputs.mkdir()
+    jobs = []
+    for number in range(24):
+        document["body"]["content"][1]["paragraph"]["elements"][0]["textRun"][
+            "content"
+        ] = f"Document {number}\n" * (number + 1)
+        document["revisionId"] = f"rev-{number}"
+        path = inputs / f"doc{number}.json"
+        path.write_text(json.dumps(document))
+        jobs.append((str(path), str(tmp_path / "out" / f"doc{number}.html")))
+    return jobs
+
+
+@pytest.fixture
+def queue_path(tmp_path, jobs):
+    path = str(tmp_path / "queue.sqlite")
+    queue = WorkQueue(path)
+    queue.enqueue(jobs)
+    queue.close()
+    return path
+
+
+def expire_leases(queue):
+    # rather than sleeping past the lease, which is timing-sensitive on a busy machine
+    queue._db.execute("UPDATE jobs SET lease_expires = 0 WHERE status = 'leased'")
+
+
+def crash(*args, **kwargs):
+    os._exit(3)
+
+
+def expected_html(input_path):
+    with open(input_path) as file:
+        return parse_doc_body(json.load(file))
+
+
+class TestWorkQueue:
+    def test_claims_largest_first_without_duplicates(self, queue_path, jobs):
+        queue = WorkQueue(queue_path)
+        assert queue.enqueue(jobs[:3]) == 0
+        first, second = queue.claim("a", 2), queue.claim("b", 30)
+        assert [lease.input_path for lease in first] == [jobs[23][0], jobs[22][0]]
+        assert len(second) == 22
+        assert not {lease.id for lease in first} & {lease.id for lease in second}
+        assert queue.claim("c") == []
+        assert queue.counts() == {"leased": 24}
+
+    def test_expired_leases_are_reclaimed(self, queue_path, tmp_path):
+        queue = WorkQueue(queue_path)
+        [stale] = queue.claim("dead")
+        expire_leases(queue)
+        [fresh] = queue.claim("alive")
+        assert fresh.id == stale.id and fresh.token != stale.token
+
+        published = []
+        assert not queue.complete(stale, True, publish=lambda: published.append("stale"))
+        assert queue.complete(fresh, True, publish=lambda: published.append("fresh"))
+        assert published == ["fresh"]
+
+    def test_heartbeats_keep_leases(self, queue_path):
+        queue = WorkQueue(queue_path)
+        leases = queue.claim("a", 2)
+        expire_leases(queue)
+        assert queue.heartbeat([lease.token for lease in leases]) == {
+            lease.token for lease in leases
+        }
+        held = {lease.id for lease in leases}
+        assert not held & {lease.id for lease in queue.claim("b", 2)}
+
+    def test_gives_up_after_max_attempts(self, queue_path):
+        queue = WorkQueue(queue_path, max_attempts=2)
+        for _ in range(2):
+            [lease] = queue.claim("crashing")
+            expire_leases(queue)
+        queue.claim("next")
+        [(input_path, error, attempts)] = queue.failures()
+        assert (input_path, error, attempts) == (lease.input_path, "lease expired 2 times", 2)
+
+
+class TestWorkers:
+    def test_processes_convert_each_document_once(self, queue_path, jobs, tmp_path):
+        workers = [
+            multiprocessing.Process(
+                target=run_worker,
+                args=(queue_path,),
+                kwargs=dict(worker=f"host{number}", batch=2, quiet=True),
+            )
+            for number in range(3)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        assert all(worker.exitcode == 0 for worker in workers)
+
+        queue = WorkQueue(queue_path)
+        assert queue.counts() == {"done": 24}
+        rows = queue._db.execute("SELECT attempts, worker FROM jobs").fetchall()
+        assert {attempts for attempts, _ in rows} == {1}
+        for input_path, output_path in jobs:
+            with open(output_path) as file:
+                assert file.read() == expected_html(input_path)
+        assert list((tmp_path / "out").glob("*.part")) == []
+
+    def test_work_of_a_dead_worker_is_taken_over(self, queue_path, jobs):
+        queue = WorkQueue(queue_path)
+        abandoned = queue.claim("dead", 3)
+        expire_leases(queue)
+        outcomes = run_worker(queue_path, "alive", poll_seconds=0.01)
+        assert outcomes == {"converted": 24, "failed": 0, "lost": 0}
+        assert not queue.complete(abandoned[0], True)
+        assert queue.counts() == {"done": 24}
+
+    def test_heartbeat_survives_a_locked_database(self, queue_path, monkeypatch, capsys):
+        beats = []
+        renewed = threading.Event()
+
+        def heartbeat(queue, tokens):
+            beats.append(tokens)
+            if len(beats) == 1:
+                raise sqlite3.OperationalError("database is locked")
+            renewed.set()
+            return set(tokens)
+
+        monkeypatch.setattr(WorkQueue, "heartbeat", heartbeat)
+        heartbeat = _Heartbeat(queue_path, lease_seconds=0.03)
+        heartbeat.hold(["token"])
+        try:
+            assert renewed.wait(30)
+        finally:
+            heartbeat.stop()
+        assert "heartbeat failed, retrying: database is locked" in capsys.readouterr().err
+
+    def test_crashed_worker_processes_are_reported(self, queue_path, monkeypatch, capsys):
+        monkeypatch.setattr(docs_to_md_queue, "run_worker", crash)
+        assert main(["work", queue_path, "-j", "2"]) == 1
+        captured = capsys.readouterr()
+        assert captured.err.count("crashed with exit code 3") == 2
+        assert "24 pending" in captured.err
+
+    def test_minified_outputs_are_published_with_sidecars(self, queue_path, jobs, tmp_path):
+        outcomes = run_worker(queue_path, "a", minify=True, gzip_sidecar=True, quiet=True)
+        assert outcomes == {"converted": 24, "failed": 0, "lost": 0}
+        for input_path, output_path in jobs:
+            with open(input_path) as file:
+                expected = parse_doc_body(json.load(file), minify=True)
+            with open(output_path) as file:
+                assert file.read() == expected
+            with gzip.open(output_path + ".gz", "rt") as file:
+                assert file.read() == expected
+        assert list((tmp_path / "out").glob("*.part*")) == []
+
+    def test_shared_cache_is_kept_within_its_bound(self, queue_path, jobs, tmp_path):
+        cache_dir = tmp_path / "cache"
+        bound = 4 * len(expected_html(jobs[-1][0]).encode())
+        outcomes = run_worker(
+            queue_path, "a", cache_dir=str(cache_dir), cache_max_bytes=bound, quiet=True
+        )
+        assert outcomes == {"converted": 24, "failed": 0, "lost": 0}
+        cached = [path for path in cache_dir.rglob("*") if path.suffix in (".html", ".ref")]
+        assert 0 < sum(path.stat().st_size for path in cached) <= bound
+        assert len([path for path in cached if path.suffix == ".html"]) < 24
+
+    def test_cli(self, tmp_path, jobs, capsys):
+        queue_path = str(tmp_path / "cli.sqlite")
+        broken = tmp_path / "exports" / "broken.json"
+        broken.write_text('{"body": ')
+        assert main(["enqueue", queue_path, str(tmp_path / "exports")]) == 0
+        assert main(["enqueue", queue_path, str(tmp_path / "exports")]) == 0
+        assert "0 queued, 25 already in the queue" in capsys.readouterr().err
+        same_name = tmp_path / "elsewhere" / "doc0.json"
+        same_name.parent.mkdir()
+        same_name.write_text("{}")
+        args = [jobs[0][0], str(same_name), "-o", str(tmp_path / "out")]
+        assert main(["enqueue", queue_path, *args]) == 2
+        assert "same output" in capsys.readouterr().err
+
+        cache = ["--cache-dir", str(tmp_path / "cache"), "--cache-max-bytes", "0"]
+        assert main(["work", queue_path, "-j", "2", "-q", *cache]) == 1
+        captured = capsys.readouterr()
+        assert "24 done, 1 failed" in captured.err
+        assert "FAILED" in captured.out and "broken.json" in captured.out
+        input_path, _ = jobs[0]
+        with open(input_path[: -len(".json")] + ".html") as file:
+            assert file.read() == expected_html(input_path)
+        assert [path for path in (tmp_path / "cache").rglob("*") if path.is_file()] == []
@@ -0,0 +1,112 @@
+import http.client
+import json
+import socket
+import threading
+
+import pytest
+
+from docs_to_md import parse_doc_body
+from docs_to_md_server import ConversionService, Overloaded, make_server
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super().__init__("localhost")
+        self._path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self._path)
+
+
+def serve(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+@pytest.fixture
+def service():
+    return ConversionService(max_concurrency=2)
+
+
+@pytest.fixture
+def connection(service):
+    server = serve(make_server(service, port=0))
+    connection = http.client.HTTPConnection(*server.server_address)
+    yield connection
+    connection.close()
+    server.shutdown()
+    server.server_close()
+
+
+def request(connection, method, path, body=None):
+    connection.request(method, path, body=body)
+    response = connection.getresponse()
+    return response.status, response.read().decode()
+
+
+class TestConversionServer:
+    def test_converts_documents(self, connection, document):
+        for _ in range(3):
+            status, body = request(connection, "POST", "/convert", json.dumps(document))
+            assert (status, body) == (200, parse_doc_body(document))
+
+    def test_health_and_stats(self, connection, document):
+        request(connection, "POST", "/convert", json.dumps(document))
+        request(connection, "POST", "/convert", b"{not json")
+
+        assert request(connection, "GET", "/health") == (200, '{"status": "ok"}')
+        status, body = request(connection, "GET", "/stats")
+        stats = json.loads(body)
+        assert status == 200
+        assert (stats["requests"], stats["errors"], stats["in_flight"]) == (2, 1, 0)
+        assert set(stats["latency_ms"]) == {"mean", "p50", "p95", "p99"}
+        assert set(stats["style_cache"]) == {"hits", "misses", "size"}
+
+    def test_reports_bad_requests(self, connection):
+        assert request(connection, "POST", "/convert", b"{not json")[0] == 400
+        status, body = request(connection, "POST", "/convert", b'{"body": {}}')
+        assert status == 422 and "KeyError" in body
+        assert request(connection, "GET", "/nope")[0] == 404
+
+    @pytest.mark.parametrize(
+        "length, status",
+        [(None, 411), ("ten", 400), ("-1", 400)],
+    )
+    def test_reports_bad_content_lengths(self, connection, length, status):
+        connection.putrequest("POST", "/convert")
+        if length is not None:
+            connection.putheader("Content-Length", length)
+        connection.endheaders()
+        response = connection.getresponse()
+        assert response.status == status
+        assert "Content-Length" in json.loads(response.read())["error"]
+
+    def test_edited_documents_render_incrementally(self, service, document):
+        service.convert(json.dumps(document).encode())
+        document["body"]["content"][1]["paragraph"]["elements"][0]["textRun"][
+            "content"
+        ] = "Changed\n"
+        assert service.convert(json.dumps(document).encode()) == parse_doc_body(document)
+        renderer, _ = service._renderer_for("doc-1")
+        assert renderer.rendered == len(document["body"]["content"]) + 1
+
+    def test_rejects_when_saturated(self, document):
+        service = ConversionService(max_concurrency=1, queue_timeout=0.01)
+        service._slots.acquire()
+        with pytest.raises(Overloaded):
+            service.convert(json.dumps(document).encode())
+        assert service.stats()["rejected"] == 1
+
+    def test_unix_socket(self, service, document, tmp_path):
+        path = str(tmp_path / "convert.sock")
+        server = serve(make_server(service, unix_socket=path))
+        connection = UnixHTTPConnection(path)
+        try:
+            status, body = request(connection, "POST", "/convert", json.dumps(document))
+            assert (status, body) == (200, parse_doc_body(document))
+        finally:
+            connection.close()
+            server.shutdown()
+            server.server_close()